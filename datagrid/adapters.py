@@ -1,7 +1,14 @@
 """Adapters to use different data source with grid.Datagrid besides
 django.db.models.query.QuerySet"""
 
+import hashlib
+import itertools
 import logging
+import operator
+
+from django.utils.encoding import smart_str
+
+from .records import dict_record, record_class
 
 
 def cmp_to_key(mycmp):
@@ -24,6 +31,73 @@ def cmp_to_key(mycmp):
     return K
 
 
+LOOKUP_OPERATORS = ('exact', 'iexact', 'gt', 'gte', 'lt', 'lte', 'ne', 'in',
+                    'contains', 'icontains', 'startswith', 'istartswith')
+
+
+def split_lookup(lookup):
+    """Splits a Django style lookup in field and operator
+    >>> split_lookup('created_on__gte')
+    ('created_on', 'gte')
+    >>> split_lookup('name')
+    ('name', 'exact')
+    """
+    field, sep, lookup_operator = lookup.rpartition('__')
+    if not sep or lookup_operator not in LOOKUP_OPERATORS:
+        return lookup, 'exact'
+    return field, lookup_operator
+
+
+def _coerce(value, other):
+    """Converts a value given as string (usually from the request) to the
+    type of the value it is compared to."""
+    if isinstance(other, basestring) and value is not None and \
+       not isinstance(value, basestring):
+        try:
+            return type(value)(other)
+        except (TypeError, ValueError):
+            pass
+    return other
+
+
+def _ordered(compare):
+    return lambda value, other: value is not None and \
+        compare(value, _coerce(value, other))
+
+
+LOOKUP_TESTS = {
+    'exact': lambda value, other: value == _coerce(value, other),
+    'iexact': lambda value, other:
+        unicode(value).lower() == unicode(other).lower(),
+    'gt': _ordered(operator.gt),
+    'gte': _ordered(operator.ge),
+    'lt': _ordered(operator.lt),
+    'lte': _ordered(operator.le),
+    'ne': lambda value, other: value != _coerce(value, other),
+    'in': lambda value, other: value in other,
+    'contains': lambda value, other: unicode(other) in unicode(value),
+    'icontains': lambda value, other:
+        unicode(other).lower() in unicode(value).lower(),
+    'startswith': lambda value, other:
+        unicode(value).startswith(unicode(other)),
+    'istartswith': lambda value, other:
+        unicode(value).lower().startswith(unicode(other).lower()),
+}
+
+
+def _average(values):
+    return sum(values) / float(len(values))
+
+
+AGGREGATE_FUNCTIONS = {
+    'Sum': sum,
+    'Avg': _average,
+    'Min': min,
+    'Max': max,
+    'Count': len,
+}
+
+
 class ManagerAdapter(object):
     """Adapter for Django model Manager. Used in DictionaryQuerySetAdapter"""
 
@@ -32,7 +106,21 @@ class ManagerAdapter(object):
 
 class QuerySetAdapter(object):
     """Base class for all adapters. Used in __init__ of grid.Datagrid """
-    pass
+
+    def cache_key(self):
+        """Returns a string identifying the query, so results computed from
+        it can be shared between requests, or None if it can't be told."""
+        return None
+
+    def iterate_chunks(self, chunk_size, fields=None):
+        """Streams the rows in the order of the query, in lists of at most
+        chunk_size rows."""
+        rows = (row for pk, row in self.iterate(fields))
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            yield chunk
 
 
 class DjangoQuerySetAdapter(QuerySetAdapter):
@@ -44,22 +132,64 @@ class DjangoQuerySetAdapter(QuerySetAdapter):
     def __getattr__(self, name):
         return getattr(self.__subject, name)
 
-    def filter_pk(self, ids_list):
-        return self.__subject.model.objects.filter(pk__in=ids_list).order_by()
+    def filter(self, *args, **kwargs):
+        return DjangoQuerySetAdapter(self.__subject.filter(*args, **kwargs))
+
+    def exclude(self, *args, **kwargs):
+        return DjangoQuerySetAdapter(self.__subject.exclude(*args, **kwargs))
+
+    def annotate(self, *args, **kwargs):
+        return DjangoQuerySetAdapter(self.__subject.annotate(*args, **kwargs))
+
+    def filter_pk(self, ids_list, fields=None):
+        queryset = self.__subject.model.objects.filter(pk__in=ids_list)
+        if fields:
+            queryset = queryset.only(*fields)
+        return queryset.order_by()
+
+    def distinct_values(self, field):
+        return self.__subject.order_by().values_list(field,
+                                                     flat=True).distinct()
+
+    def prefix_values(self, field, prefix, limit=20):
+        """Returns up to limit distinct values of field starting with
+        prefix, case insensitively, in their order."""
+        return list(self.__subject.filter(**{
+            '%s__istartswith' % field: prefix,
+            '%s__isnull' % field: False,
+        }).order_by(field).values_list(field, flat=True).distinct()[:limit])
+
+    def iterate(self, fields=None):
+        """Streams (pk, row) pairs without caching the rows. When fields
+        are given, only those are fetched instead of whole objects."""
+        if fields is None:
+            for obj in self.__subject.iterator():
+                yield obj.pk, obj
+        else:
+            Record = record_class(['pk'] + list(fields))
+            for row in self.__subject.values_list('pk', *fields).iterator():
+                yield row[0], Record._make(row)
+
+    def cache_key(self):
+        return hashlib.md5(smart_str(self.__subject.query)).hexdigest()
+
+    def group_by(self, field, descending=False, **aggregates):
+        return self.__subject.values(field).annotate(**aggregates).order_by(
+            descending and "-" + field or field)
 
     def extra_sort(self, *field_names):
+        """Sorts by raw SQL, given as {"-name": "sql"} dictionaries, in
+        order. Prefer grids.ComputedColumn, which the ORM can check."""
         if not field_names:
             return self
-        field = field_names[0]
-        if field.keys()[0].startswith("-"):
-            f = field.keys()[0]
-            select = {f[1:]: field[f]}
-            self.__subject = self.__subject.extra(select=select)
-        else:
-            self.__subject = self.__subject.extra(select=field)
-
-        self.__subject = self.__subject.extra(order_by=field.keys())
-        return self.__subject
+        select = {}
+        order_by = []
+        for field in field_names:
+            for name, sql in field.items():
+                select[name.lstrip("-")] = sql
+                order_by.append(name)
+        return DjangoQuerySetAdapter(
+            self.__subject.extra(select=select, order_by=order_by))
 
 
 class DictionaryQuerySetAdapter(QuerySetAdapter):
@@ -72,8 +202,7 @@ class DictionaryQuerySetAdapter(QuerySetAdapter):
 
     def __getitem__(self, items):
         if isinstance(items, int):
-            i = self.objects_list[items]
-            return Struct(**i)
+            return dict_record(self.objects_list[items])
         self.objects_list = self.objects_list.__getitem__(items)
         return self
 
@@ -83,8 +212,71 @@ class DictionaryQuerySetAdapter(QuerySetAdapter):
     def count(self):
         return len(self.objects_list)
 
-    def filter_pk(self, ids_list):
-        return self
+    def filter_pk(self, ids_list, fields=None):
+        ids = set(ids_list)
+        return DictionaryQuerySetAdapter(
+            [i for i in self.objects_list if i["id"] in ids])
+
+    def _match(self, lookups):
+        tests = [(field, LOOKUP_TESTS[lookup_operator], value)
+                 for (field, lookup_operator), value in
+                 [(split_lookup(lookup), value)
+                  for lookup, value in lookups.items()]]
+        return lambda row: all(test(row.get(field), value)
+                               for field, test, value in tests)
+
+    def filter(self, *args, **kwargs):
+        if args:
+            logging.error("""Q objects with DictionaryQuerySetAdapter
+                             not supported""")
+        match = self._match(kwargs)
+        return DictionaryQuerySetAdapter(
+            [row for row in self.objects_list if match(row)])
+
+    def exclude(self, *args, **kwargs):
+        if args:
+            logging.error("""Q objects with DictionaryQuerySetAdapter
+                             not supported""")
+        match = self._match(kwargs)
+        return DictionaryQuerySetAdapter(
+            [row for row in self.objects_list if not match(row)])
+
+    def distinct_values(self, field):
+        return set(i.get(field) for i in self.objects_list)
+
+    def iterate(self, fields=None):
+        for i in self.objects_list:
+            yield i["id"], dict_record(i)
+
+    def aggregate(self, **aggregates):
+        """Computes Django aggregates (Sum, Avg, Min, Max, Count) over the
+        rows, extracting each field once and reducing it with builtins."""
+        result = {}
+        for name, aggregate in aggregates.items():
+            field = aggregate.lookup
+            if field == "pk":
+                field = "id"
+            values = [i.get(field) for i in self.objects_list]
+            values = [value for value in values if value is not None]
+            if values or aggregate.name == 'Count':
+                result[name] = AGGREGATE_FUNCTIONS[aggregate.name](values)
+            else:
+                result[name] = None
+        return result
+
+    def group_by(self, field, descending=False, **aggregates):
+        """Groups the rows by the value of field, returning a dictionary
+        with the value and the aggregates of each group."""
+        groups = {}
+        for i in self.objects_list:
+            groups.setdefault(i.get(field), []).append(i)
+        result = []
+        for value in sorted(groups, reverse=descending):
+            group = DictionaryQuerySetAdapter(groups[value]).aggregate(
+                **aggregates)
+            group[field] = value
+            result.append(group)
+        return result
 
     def values_list(self, *fields, **kwargs):
         if fields:
@@ -147,15 +339,8 @@ class DictionaryQuerySetAdapter(QuerySetAdapter):
                          not supported. Please add with row to dictionary """)
         return self
 
+    def annotate(self, *args, **kwargs):
+        logging.error("""Aggregate columns with DictionaryQuerySetAdapter
+                         not supported. Please add with row to dictionary """)
+        return self
 
-class Struct:
-    """Object presentation of dictionaries
-    >>> d = {'a+b': 'c', 'c': 3}
-    >>> s = Struct(**d)
-    >>> getattr(s,'a+b')
-    'c'
-    >>> s.c
-    3
-    """
-    def __init__(self, **entries):
-        self.__dict__.update(entries)
@@ -0,0 +1,86 @@
+"""Prefix index used to answer autocomplete queries of the filter form
+without rendering every distinct value of a field into a <select>."""
+
+import bisect
+import hashlib
+
+from django.core.cache import cache
+from django.utils.encoding import force_unicode, smart_str
+
+from .caching import LRUCache
+
+
+class PrefixIndex(object):
+    """Sorted array of the distinct values of a field.
+
+    Lookups are case insensitive: the values are sorted on their lowercased
+    form, so every value starting with a prefix sits in one contiguous slice
+    that is found with a binary search.
+    >>> index = PrefixIndex([u'Group 10', u'group 2', u'Other', None])
+    >>> index.lookup(u'gro')
+    [u'Group 10', u'group 2']
+    >>> index.lookup(u'x')
+    []
+    """
+    def __init__(self, values):
+        pairs = sorted(set((force_unicode(value).lower(), force_unicode(value))
+                           for value in values if value is not None))
+        self.keys = [key for key, value in pairs]
+        self.values = [value for key, value in pairs]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, prefix, limit=20):
+        prefix = force_unicode(prefix).lower()
+        start = bisect.bisect_left(self.keys, prefix)
+        matches = []
+        for position in xrange(start, min(start + limit, len(self.keys))):
+            if not self.keys[position].startswith(prefix):
+                break
+            matches.append(self.values[position])
+        return matches
+
+
+# The indexes live in the process: pickled whole they can outgrow the items
+# of a shared cache such as memcached (1MB).
+_indexes = LRUCache(100)
+
+
+def get_prefix_index(queryset, field, key=None, timeout=300):
+    """Returns the PrefixIndex of ``field`` over ``queryset``.
+
+    The index is kept in the process for ``timeout`` seconds under ``key``.
+    Without a key it is rebuilt from the adapter on every call.
+    """
+    if key:
+        index = _indexes.get(key)
+        if index is not None:
+            return index
+    index = PrefixIndex(queryset.distinct_values(field))
+    if key:
+        _indexes.set(key, index, timeout)
+    return index
+
+
+def autocomplete(queryset, field, prefix, key=None, limit=20, timeout=300):
+    """Returns up to ``limit`` distinct values of ``field`` starting with
+    ``prefix``. Results are cached per prefix when a cache key is given.
+
+    Django querysets are asked for the values with a query limited to the
+    prefix, the other adapters look them up in a PrefixIndex.
+    """
+    if key:
+        prefix_key = "%s:%s:%s" % (key, limit,
+            hashlib.md5(smart_str(force_unicode(prefix).lower())).hexdigest())
+        matches = cache.get(prefix_key)
+        if matches is not None:
+            return matches
+    if hasattr(queryset, 'prefix_values'):
+        matches = queryset.prefix_values(field, prefix, limit)
+    else:
+        index = get_prefix_index(queryset, field, key, timeout)
+        matches = index.lookup(prefix, limit)
+    if key:
+        cache.set(prefix_key, matches, timeout)
+    return matches
@@ -0,0 +1,143 @@
+"""Caching helpers of the grids: versions of the data of models, used in
+the keys of what the grids cache so that saving or deleting an object
+invalidates it, and an in-process LRU cache."""
+
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+
+
+VERSION_TIMEOUT = getattr(settings, 'DATAGRID_VERSION_TIMEOUT',
+                          60 * 60 * 24 * 30)
+
+_missing = object()
+
+
+def get_version_key(model):
+    return 'datagrid-version:%s.%s' % (model._meta.app_label,
+                                       model._meta.object_name)
+
+
+def _new_version():
+    # Versions start from the clock rather than 1, so a version key evicted
+    # from the cache never comes back with a value used before.
+    return int(time.time() * 1000)
+
+
+def get_model_version(model):
+    """Returns the current version of the data of model."""
+    key = get_version_key(model)
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        if not cache.add(key, version, VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_model_version(sender, **kwargs):
+    """Signal receiver changing the version of the saved or deleted model."""
+    key = get_version_key(sender)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), VERSION_TIMEOUT)
+
+
+def track_model(model):
+    """Bumps the version of model whenever one of its objects is saved or
+    deleted. Tracking a model more than once has no effect."""
+    uid = 'datagrid-version:%s' % get_version_key(model)
+    post_save.connect(bump_model_version, sender=model, dispatch_uid=uid)
+    post_delete.connect(bump_model_version, sender=model, dispatch_uid=uid)
+
+
+class LRUCache(object):
+    """Mapping of at most size of the most recently used keys, whose
+    entries expire timeout seconds after being set (never when None).
+    It lives in the process, shared between the threads serving requests.
+    >>> cache = LRUCache(2)
+    >>> cache.set('a', 1); cache.set('b', 2); cache.get('a')
+    1
+    >>> cache.set('c', 3); cache.get('b') is None
+    True
+    """
+    PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+    def __init__(self, size=1000, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        # Entries are links of a circular list ordered from the least to the
+        # most recently used, around the root.
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+        self.links = {}
+
+    def __len__(self):
+        return len(self.links)
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _append(self, link):
+        last = self.root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = self.root
+        last[self.NEXT] = self.root[self.PREV] = link
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.links.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            if link[self.EXPIRES] is not None and \
+               link[self.EXPIRES] < time.time():
+                del self.links[key]
+                return default
+            self._append(link)
+            return link[self.VALUE]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, timeout=_missing):
+        """Sets the value of key, expiring after timeout seconds when given
+        instead of the timeout of the cache."""
+        if timeout is _missing:
+            timeout = self.timeout
+        if timeout is None:
+            expires = None
+        else:
+            expires = time.time() + timeout
+        self.lock.acquire()
+        try:
+            link = self.links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            link = [None, None, key, value, expires]
+            self._append(link)
+            self.links[key] = link
+            if len(self.links) > self.size:
+                oldest = self.root[self.NEXT]
+                self._unlink(oldest)
+                del self.links[oldest[self.KEY]]
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            link = self.links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self.lock.release()
@@ -0,0 +1,389 @@
+"""Exports of the whole filtered and sorted data of a grid. The rows are
+streamed in chunks from the data source and written out as they come, so an
+export uses constant memory whatever the number of rows (but for the pks of
+the grids sorted in Python).
+
+CSV and PDF export the text the columns render. The typed formats, NDJSON,
+XLSX and, when pyarrow is installed, Arrow and Parquet, keep the values of
+the columns showing a model field as they are, typed after the field."""
+
+import csv
+import itertools
+import shutil
+import StringIO
+import tempfile
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.template.loader import render_to_string
+from django.utils.encoding import force_unicode, smart_str
+
+from .adapters import DjangoQuerySetAdapter
+from .xlsx import HEADER_STYLE, XLSXWriter
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Before Django 1.5 an HttpResponse streams the iterator it is given.
+    StreamingHttpResponse = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # The Arrow and Parquet formats are only offered with pyarrow.
+    pyarrow = None
+
+
+EXPORT_CHUNK_SIZE = getattr(settings, 'DATAGRID_EXPORT_CHUNK_SIZE', 1000)
+
+
+def get_labels(datagrid):
+    """Returns the labels of the active columns of the grid."""
+    return [column.label or ' '.join(column.id.split('_')).title()
+            for column in datagrid.columns]
+
+
+def iter_rows(datagrid, chunk_size=EXPORT_CHUNK_SIZE, chunks=None):
+    """
+    Streams the data of the active columns for all the rows of the grid,
+    in lists of at most chunk_size rows, or for the rows of the given
+    chunks of objects. The data of each column is rendered once per chunk,
+    batched like for a page.
+    """
+    if chunks is None:
+        chunks = datagrid.iter_export_chunks(chunk_size)
+    for objects in chunks:
+        yield zip(*[column.render_data_batch(objects)
+                    for column in datagrid.columns])
+
+
+def encode_value(value):
+    if value is None:
+        return ''
+    return smart_str(value)
+
+
+def iter_csv(datagrid, chunk_size=EXPORT_CHUNK_SIZE, header=True,
+             chunks=None):
+    """
+    Streams the grid as CSV encoded in UTF-8, the header row first and
+    then the text of a chunk of rows at a time. Like the other streamed
+    formats, it can also stream the rows of given chunks of objects,
+    with or without header, which exports the grid in parts.
+    """
+    buffer = StringIO.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow([encode_value(label)
+                         for label in get_labels(datagrid)])
+        yield buffer.getvalue()
+    for rows in iter_rows(datagrid, chunk_size, chunks):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([[encode_value(value) for value in row]
+                          for row in rows])
+        yield buffer.getvalue()
+
+
+def write_csv(datagrid, file):
+    for chunk in iter_csv(datagrid):
+        file.write(chunk)
+
+
+def write_pdf(datagrid, file):
+    """Writes all the rows of the grid as a PDF table, with pisa."""
+    import ho.pisa as pisa
+    html = render_to_string('datagrid/as_pdf.pdf', {
+        'datagrid': datagrid,
+        'labels': get_labels(datagrid),
+        'rows': itertools.chain.from_iterable(iter_rows(datagrid)),
+    })
+    pisa.CreatePDF(html, file)
+
+
+def get_export_fields(datagrid):
+    """
+    Returns the model field each active column shows as is, None for the
+    columns computing their data and for all the columns of the grids not
+    over a Django model.
+    """
+    if not isinstance(datagrid.queryset, DjangoQuerySetAdapter):
+        return [None] * len(datagrid.columns)
+    model = datagrid.queryset.model
+    return [column.get_export_field(model) for column in datagrid.columns]
+
+
+def iter_typed_columns(datagrid, chunk_size=EXPORT_CHUNK_SIZE, chunks=None):
+    """
+    Streams the data of the active columns like iter_rows, as a list of
+    values per column for each chunk. The columns showing a model field
+    give its values rather than their text, such as a datetime rather than
+    the formatted date.
+    """
+    fields = get_export_fields(datagrid)
+    if chunks is None:
+        chunks = datagrid.iter_export_chunks(chunk_size)
+    for objects in chunks:
+        yield [[column.get_value(obj) for obj in objects]
+               if field is not None else column.render_data_batch(objects)
+               for column, field in zip(datagrid.columns, fields)]
+
+
+class ExportJSONEncoder(DjangoJSONEncoder):
+    """Encodes dates and decimals like Django, and anything else, such as
+    a lazy translation, as its text."""
+    def default(self, o):
+        try:
+            return DjangoJSONEncoder.default(self, o)
+        except TypeError:
+            return force_unicode(o)
+
+
+def iter_ndjson(datagrid, chunk_size=EXPORT_CHUNK_SIZE, header=True,
+                chunks=None):
+    """
+    Streams the grid as newline delimited JSON, an object per row whose
+    keys are the ids of the columns, a chunk of rows at a time. There's no
+    header, each row names its values.
+    """
+    encoder = ExportJSONEncoder(separators=(',', ':'))
+    keys = [encoder.encode(column.id) + ':' for column in datagrid.columns]
+    for columns in iter_typed_columns(datagrid, chunk_size, chunks):
+        yield ''.join(['{%s}\n' % ','.join([key + encoder.encode(value)
+                                             for key, value in zip(keys, row)])
+                       for row in zip(*columns)])
+
+
+def write_ndjson(datagrid, file):
+    for chunk in iter_ndjson(datagrid):
+        file.write(chunk)
+
+
+def write_xlsx(datagrid, file):
+    """
+    Writes all the rows of the grid as an Excel workbook, with a header row
+    of the labels. The numbers, booleans and dates of the columns showing
+    a model field are written as such, the other data as text.
+    """
+    try:
+        file.tell()
+        output = file
+    except (AttributeError, IOError):
+        # zipfile seeks back in what it writes, the workbook is written to
+        # a temporary file and copied when file is a pipe.
+        output = tempfile.TemporaryFile()
+    writer = XLSXWriter(output, force_unicode(datagrid.grid_header or ''))
+    try:
+        writer.write_row(get_labels(datagrid), HEADER_STYLE)
+        for columns in iter_typed_columns(datagrid):
+            writer.write_rows(zip(*columns))
+    finally:
+        writer.close()
+    if output is not file:
+        output.seek(0)
+        shutil.copyfileobj(output, file)
+        output.close()
+
+
+# The Arrow types of the model fields, by internal type. The values of the
+# other fields and of the columns computing their data are exported as
+# strings.
+ARROW_TYPES = {
+    'AutoField': ('int64',),
+    'BigIntegerField': ('int64',),
+    'BooleanField': ('bool_',),
+    'DateField': ('date32',),
+    'DateTimeField': ('timestamp', 'us'),
+    'FloatField': ('float64',),
+    'IntegerField': ('int64',),
+    'NullBooleanField': ('bool_',),
+    'PositiveIntegerField': ('int64',),
+    'PositiveSmallIntegerField': ('int32',),
+    'SmallIntegerField': ('int16',),
+    'TimeField': ('time64', 'us'),
+}
+
+
+def get_arrow_type(field):
+    """Returns the Arrow type of the values of a model field, or of the
+    text of a column computing its data when field is None."""
+    if field is None:
+        return pyarrow.string()
+    internal_type = field.get_internal_type()
+    if internal_type == 'DecimalField':
+        return pyarrow.decimal128(field.max_digits, field.decimal_places)
+    if internal_type == 'DateTimeField' and getattr(settings, 'USE_TZ', False):
+        return pyarrow.timestamp('us', tz='UTC')
+    spec = ARROW_TYPES.get(internal_type)
+    if spec is None:
+        return pyarrow.string()
+    return getattr(pyarrow, spec[0])(*spec[1:])
+
+
+def iter_record_batches(datagrid, schema, chunk_size=EXPORT_CHUNK_SIZE,
+                        chunks=None):
+    """Streams the rows of the grid as Arrow record batches of schema, a
+    batch per chunk of rows."""
+    texts = [field.type == pyarrow.string() for field in schema]
+    for columns in iter_typed_columns(datagrid, chunk_size, chunks):
+        arrays = []
+        for values, field, text in zip(columns, schema, texts):
+            if text:
+                values = [force_unicode(value) if value is not None else None
+                          for value in values]
+            arrays.append(pyarrow.array(values, type=field.type))
+        yield pyarrow.RecordBatch.from_arrays(arrays, schema.names)
+
+
+class OutputBuffer(object):
+    """
+    A file keeping what's written to it until it's drained, through which
+    the output of the Arrow writers is streamed.
+    """
+    def __init__(self):
+        self.data = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = str(data)
+        self.data.append(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = ''.join(self.data)
+        self.data = []
+        return data
+
+
+def iter_arrow_output(datagrid, writer_class, chunk_size=EXPORT_CHUNK_SIZE,
+                      chunks=None):
+    """Streams what a writer_class(sink, schema) of pyarrow writes for the
+    rows of the grid, a table per chunk of rows."""
+    schema = pyarrow.schema([
+        pyarrow.field(column.id, get_arrow_type(field))
+        for column, field in zip(datagrid.columns,
+                                 get_export_fields(datagrid))])
+    buffer = OutputBuffer()
+    writer = writer_class(pyarrow.PythonFile(buffer, mode='w'), schema)
+    for batch in iter_record_batches(datagrid, schema, chunk_size, chunks):
+        writer.write_table(pyarrow.Table.from_batches([batch]))
+        yield buffer.drain()
+    writer.close()
+    yield buffer.drain()
+
+
+def iter_arrow(datagrid, chunk_size=EXPORT_CHUNK_SIZE, header=True,
+               chunks=None):
+    """Streams the grid as an Arrow IPC stream, with a record batch per
+    chunk of rows."""
+    return iter_arrow_output(datagrid, pyarrow.RecordBatchStreamWriter,
+                             chunk_size, chunks)
+
+
+def iter_parquet(datagrid, chunk_size=EXPORT_CHUNK_SIZE, header=True,
+                 chunks=None):
+    """Streams the grid as a Parquet file, with a row group per chunk of
+    rows."""
+    return iter_arrow_output(datagrid, pyarrow.parquet.ParquetWriter,
+                             chunk_size, chunks)
+
+
+def write_arrow(datagrid, file):
+    for chunk in iter_arrow(datagrid):
+        file.write(chunk)
+
+
+def write_parquet(datagrid, file):
+    for chunk in iter_parquet(datagrid):
+        file.write(chunk)
+
+
+# The content type, file extension, writer(datagrid, file) and streaming
+# iterator(datagrid, chunk_size, header, chunks), if any, of the export
+# formats.
+EXPORT_FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv', write_csv, iter_csv),
+    'ndjson': ('application/x-ndjson', 'ndjson', write_ndjson, iter_ndjson),
+    'pdf': ('application/pdf', 'pdf', write_pdf, None),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml'
+             '.sheet', 'xlsx', write_xlsx, None),
+}
+
+if pyarrow is not None:
+    EXPORT_FORMATS.update({
+        'arrow': ('application/vnd.apache.arrow.stream', 'arrows',
+                  write_arrow, iter_arrow),
+        'parquet': ('application/vnd.apache.parquet', 'parquet',
+                    write_parquet, iter_parquet),
+    })
+
+# The streamed formats whose parts, the header and the rows of consecutive
+# chunks streamed separately, are concatenated into the whole export.
+PARTITIONED_FORMATS = ('csv', 'ndjson')
+
+
+def iter_export(datagrid, format):
+    """
+    Streams the export of the grid in format, written to memory first when
+    the format can't be streamed.
+    """
+    content_type, extension, write, iterate = EXPORT_FORMATS[format]
+    if iterate is not None:
+        return iterate(datagrid)
+    buffer = StringIO.StringIO()
+    write(datagrid, buffer)
+    return iter([buffer.getvalue()])
+
+
+def streaming_response(content, content_type, filename=None):
+    """
+    Returns a response streaming the strings of the content iterator, as an
+    attachment named filename when given.
+    """
+    if StreamingHttpResponse is not None:
+        response = StreamingHttpResponse(content, content_type=content_type)
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    if filename:
+        response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+
+def iter_then(content, callback):
+    """Yields the strings of the content iterator, then calls callback
+    once they were all yielded. content is closed in any case."""
+    try:
+        for data in content:
+            yield data
+        callback()
+    finally:
+        if hasattr(content, 'close'):
+            content.close()
+
+
+def call_when_sent(response, callback):
+    """
+    Calls callback once the whole content of the response was sent, when
+    it's streamed by an iterator, or else right away as the content is
+    complete.
+    """
+    if getattr(response, 'streaming', False):
+        response.streaming_content = iter_then(response.streaming_content,
+                                               callback)
+    elif not getattr(response, '_is_string', True):
+        # Before Django 1.5, the iterators are streamed by HttpResponse.
+        response._container = iter_then(response._container, callback)
+    else:
+        callback()
@@ -0,0 +1,115 @@
+"""Formatting of the dates of a whole column at once. The format strings are
+parsed once instead of for every cell, a page takes a single reference time
+for the relative dates, and the text of a date shown repeatedly is only
+computed once."""
+
+import datetime
+
+from django.conf import settings
+from django.utils import formats
+from django.utils.dateformat import DateFormat, re_escaped, re_formatchars
+from django.utils.encoding import force_unicode
+from django.utils.timesince import timesince
+from django.utils.translation import get_language, ugettext as _
+
+from .caching import LRUCache
+
+_formatters = {}
+
+
+class DateFormatter(object):
+    """
+    A date format, split once into its literal text and the DateFormat
+    methods of its specifiers. Formats like the date template filter.
+    >>> DateFormatter('Y-m-d').format(datetime.date(2010, 3, 4))
+    u'2010-03-04'
+    >>> DateFormatter(r'\\Y Y').format(datetime.date(2010, 3, 4))
+    u'Y 2010'
+    """
+    def __init__(self, format, cache_size=1000):
+        self.pieces = []
+        for i, piece in enumerate(re_formatchars.split(force_unicode(format))):
+            if i % 2:
+                self.pieces.append((True, piece))
+            elif piece:
+                self.pieces.append((False, re_escaped.sub(r'\1', piece)))
+        self.cache = LRUCache(cache_size)
+
+    def format(self, value):
+        if not value:
+            return u''
+        formatter = DateFormat(value)
+        try:
+            return u''.join([is_specifier and
+                             force_unicode(getattr(formatter, piece)()) or
+                             piece
+                             for is_specifier, piece in self.pieces])
+        except AttributeError:
+            # Time specifiers applied to a date.
+            return u''
+
+    def format_batch(self, values):
+        """Formats all the values, each distinct value once."""
+        memo = {}
+        texts = []
+        for value in values:
+            text = memo.get(value)
+            if text is None:
+                text = self.cache.get(value)
+                if text is None:
+                    text = self.format(value)
+                    self.cache.set(value, text)
+                memo[value] = text
+            texts.append(text)
+        return texts
+
+
+def get_date_formatter(format=None):
+    """
+    Returns the DateFormatter of a format string or of the name of a
+    localized format such as "SHORT_DATE_FORMAT", settings.DATE_FORMAT by
+    default. Formatters are created once per format and language.
+    """
+    format = format or settings.DATE_FORMAT
+    key = (format, get_language())
+    formatter = _formatters.get(key)
+    if formatter is None:
+        try:
+            resolved = formats.get_format(format)
+        except AttributeError:
+            resolved = format
+        formatter = _formatters[key] = DateFormatter(resolved)
+    return formatter
+
+
+def format_dates(values, format=None):
+    """Formats the values like the date filter does with format."""
+    return get_date_formatter(format).format_batch(values)
+
+
+def format_timesince(values, now=None):
+    """
+    Formats the values like "%s ago" of the timesince filter, all relative
+    to the same now.
+    >>> now = datetime.datetime(2010, 3, 4, 12, 0)
+    >>> format_timesince([now - datetime.timedelta(days=5), None], now)
+    [u'5 days ago', u' ago']
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    template = _("%s ago")
+    memo = {}
+    texts = []
+    for value in values:
+        text = memo.get(value)
+        if text is None:
+            if value:
+                try:
+                    since = timesince(value, now)
+                except (ValueError, TypeError):
+                    since = u''
+            else:
+                since = u''
+            text = memo[value] = template % since
+        texts.append(text)
+    return texts
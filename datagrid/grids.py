@@ -1,19 +1,74 @@
+import django
 from django.conf import settings
 from django.contrib.auth.models import SiteProfileNotAvailable
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.paginator import InvalidPage, Paginator
+from django.core.urlresolvers import get_script_prefix, get_urlconf
 from django.http import Http404, HttpResponse
 from django.shortcuts import render_to_response
 from django.template.context import RequestContext
-from django.template.defaultfilters import date, timesince
 from django.template.loader import render_to_string
+from django.utils.encoding import force_unicode, smart_str
 from django.utils.safestring import mark_safe
-from django.utils.translation import ugettext as _
+from django.utils.translation import get_language, ugettext as _, ugettext_lazy
+from django.utils.tzinfo import FixedOffset
 from django.views.decorators.cache import cache_control
-from django.db.models import Q
+from django.db.models import Count, Max, Q
+from django.db.models.signals import post_delete, post_save
 from django.db.models.query import QuerySet, ValuesQuerySet
+from django.utils import simplejson
 from .adapters import *
-import StringIO
+from .autocomplete import autocomplete
+from .caching import (VERSION_TIMEOUT, LRUCache, get_model_version,
+                      track_model)
+from .exports import (EXPORT_FORMATS, call_when_sent, iter_export,
+                      streaming_response)
+from .formatting import format_dates, format_timesince, get_date_formatter
+from .jobs import export_to_response
+from .links import URLTemplate
+from .querystring import QueryState
+from .records import record_class, records_from_dicts
+from .relations import (apply_plan, get_forward_models, get_path_field,
+                        get_relation, get_value_path, is_nullable_path,
+                        plan_queryset)
+from .sorting import PythonSortedList, ReverseKey
+import datetime
+import hashlib
+import itertools
+import operator
+import re
+
+
+_missing = object()
+
+
+def memoize_batch(objects, key_func, func, cache=None):
+    """
+    Returns func(obj) for each of the objects, computing it once per
+    distinct key_func(obj) and keeping it in the cache (an LRUCache shared
+    by the requests) when given. Objects with unhashable keys aren't
+    memoized.
+    """
+    memo = {}
+    values = []
+    for obj in objects:
+        try:
+            key = key_func(obj)
+            value = memo.get(key, _missing)
+        except TypeError:
+            values.append(func(obj))
+            continue
+        if value is _missing:
+            if cache is not None:
+                value = cache.get(key, _missing)
+            if value is _missing:
+                value = func(obj)
+                if cache is not None:
+                    cache.set(key, value)
+            memo[key] = value
+        values.append(value)
+    return values
 
 
 class Column(object):
@@ -39,7 +94,10 @@ class Column(object):
                  image_alt="", shrink=False, expand=False, sortable=False,
                  default="", sort_field=None,
                  default_sort_dir=SORT_DESCENDING, link=False,
-                 link_func=None, cell_clickable=False, css_class="", data_func=None):
+                 link_func=None, cell_clickable=False, css_class="", data_func=None,
+                 footer=None, batch_data_func=None, data_fields=None,
+                 memoize=False, memoize_timeout=None, memoize_size=1000,
+                 link_key=None, link_url=None, link_args=()):
         self.id = None
         self.datagrid = None
         self.default = default
@@ -57,11 +115,24 @@ class Column(object):
         self.sortable = sortable
         self.default_sort_dir = default_sort_dir
         self.cell_clickable = cell_clickable
-        self.link = link
+        self.link = link or link_url is not None
+        self.link_url = link_url
+        self.link_args = link_args
+        self.url_templates = {}
         self.link_func = link_func or \
             (lambda x, y: self.datagrid.link_to_object(x, y))
         self.css_class = css_class
         self.data_func = data_func
+        self.batch_data_func = batch_data_func
+        self.data_fields = data_fields
+        self.footer = footer
+        self.memoize = memoize or memoize_timeout is not None
+        self.link_key = link_key
+        if memoize_timeout is None:
+            self.data_cache = self.link_cache = None
+        else:
+            self.data_cache = LRUCache(memoize_size, memoize_timeout)
+            self.link_cache = LRUCache(memoize_size, memoize_timeout)
         self.creation_counter = Column.creation_counter
         Column.creation_counter += 1
 
@@ -82,8 +153,7 @@ class Column(object):
         else:
             columns.append(self.id)
 
-        return "?%scolumns=%s" % (self.get_url_params_except("columns"),
-                                  ",".join(columns))
+        return self.datagrid.query.url({'columns': ",".join(columns)})
     toggle_url = property(get_toggle_url)
 
     def get_header(self):
@@ -123,12 +193,10 @@ class Column(object):
                 in_sort = True
                 sort_primary = (sort_list[0] == cur_column_id)
 
-            url_prefix = "?%ssort=" % self.get_url_params_except("sort",
-                                                                 "datagrid-id",
-                                                                 "gridonly",
-                                                                 "columns")
+            query = self.datagrid.query
+            exclude = ("datagrid-id", "gridonly")
             unsort = [i for i in sort_list if i !=cur_column_id]
-            unsort_url = url_prefix + ','.join(unsort)
+            unsort_url = query.url({'sort': ','.join(unsort)}, exclude)
             if sort_primary:
                 unsort.insert(0, new_column_id)
             else:
@@ -137,9 +205,9 @@ class Column(object):
             if isinstance(self,NonDatabaseColumn):
                 if len(unsort)>1:
                     in_sort = False
-                sort_url   = url_prefix + new_column_id
+                sort_url   = query.url({'sort': new_column_id}, exclude)
             else:
-                sort_url   = url_prefix + ",".join(unsort)
+                sort_url   = query.url({'sort': ",".join(unsort)}, exclude)
 
         return mark_safe(render_to_string(
             self.datagrid.column_header_template, {
@@ -158,21 +226,16 @@ class Column(object):
         Utility function to return a string containing URL parameters to
         this page with the specified parameter filtered out.
         """
-        s = ""
-
-        for key in self.datagrid.request.GET:
-            if key not in params:
-                s += "%s=%s&" % (key, self.datagrid.request.GET[key])
-
-        return s
+        return self.datagrid.query.prefix(*params)
 
-    def render_cell(self, obj):
+    def render_cell(self, obj, rendered_data=_missing, url=_missing):
         """
-        Renders the table cell containing column data.
+        Renders the table cell containing column data, from the rendered
+        data and the url of the link when given, even if None.
         """
-        rendered_data = self.render_data(obj)
+        if rendered_data is _missing:
+            rendered_data = self.render_data(obj)
         css_class = ""
-        url = ""
 
         if self.css_class:
             if callable(self.css_class):
@@ -180,11 +243,8 @@ class Column(object):
             else:
                 css_class = self.css_class
 
-        if self.link:
-            try:
-                url = self.link_func(obj, rendered_data)
-            except AttributeError:
-                pass
+        if url is _missing:
+            url = self.get_link_url(obj, rendered_data)
 
         self.label = self.label or ' '.join(self.id.split('_')).title()
         return mark_safe(render_to_string(self.datagrid.cell_template, {
@@ -195,19 +255,66 @@ class Column(object):
             'data': mark_safe(rendered_data)
         }))
 
-    def render_data(self, obj):
+    def get_link_url(self, obj, rendered_data):
         """
-        Renders the column data to a string. This may contain HTML.
+        Returns the url the cell of obj links to, or "" if it doesn't link.
+        """
+        if self.link_url:
+            return self.get_url_template().urls([obj])[0]
+        if self.link:
+            try:
+                return self.link_func(obj, rendered_data)
+            except AttributeError:
+                pass
+        return ""
+
+    def get_link_urls(self, objects, data):
+        """
+        Returns the urls of the cells of the objects of a page, computed
+        once per distinct link_key(obj) when a link_key is given.
+        """
+        if not self.link:
+            return [""] * len(objects)
+        if self.link_url:
+            return self.get_url_template().urls(objects)
+        pairs = zip(objects, data)
+        if self.link_key:
+            return memoize_batch(pairs, lambda pair: self.link_key(pair[0]),
+                lambda pair: self.get_link_url(*pair), self.link_cache)
+        return [self.get_link_url(obj, datum) for obj, datum in pairs]
+
+    def get_url_template(self):
+        """
+        Returns the URLTemplate of link_url, resolved once per urlconf and
+        script prefix.
+        """
+        urlconf = get_urlconf() or settings.ROOT_URLCONF
+        key = (self.link_url, urlconf, get_script_prefix())
+        template = self.url_templates.get(key)
+        if template is None:
+            template = self.url_templates[key] = URLTemplate(
+                self.link_url, self.link_args, urlconf)
+        return template
+
+    def get_link_paths(self):
+        """
+        Returns the attribute paths the links of the column read, when
+        they are built from link_url.
+        """
+        if not self.link_url:
+            return []
+        if isinstance(self.link_args, dict):
+            return sorted(self.link_args.values())
+        return list(self.link_args)
+
+    def get_value(self, obj):
+        """
+        Returns the value of the field of the column, following the
+        relations of a dotted field name.
         """
         field_names = self.field_name.split('.')
         if len(field_names) > 1:
-            field_name = field_names.pop(0)
-            value = getattr(obj, field_name)
-            if callable(value):
-                value = value()
-            if value is None:
-                #NO further processing is possible, so bailout early.
-                return value
+            value = obj
             while field_names:
                 field_name = field_names.pop(0)
                 value = getattr(value, field_name)
@@ -216,9 +323,25 @@ class Column(object):
                 if value is None:
                     #NO further processing is possible, so bailout early.
                     return value
+            return value
         else:
             # value = getattr(obj, self.field_name)
-            value = getattr(obj, self.db_field, self.default)
+            return getattr(obj, self.db_field, self.default)
+
+    def get_memo_key(self, obj):
+        """
+        Returns the input the rendered data of obj depends on, the key of
+        the memoized data.
+        """
+        return self.get_value(obj)
+
+    def render_data(self, obj):
+        """
+        Renders the column data to a string. This may contain HTML.
+        """
+        value = self.get_value(obj)
+        if value is None and '.' in self.field_name:
+            return value
         if self.data_func:
             value = self.data_func(value)
         if callable(value):
@@ -226,16 +349,131 @@ class Column(object):
         else:
             return value
 
+    def render_data_batch(self, objects):
+        """
+        Renders the column data of all the objects of a page, with one call
+        to batch_data_func when given, so a lookup per row becomes a single
+        bulk lookup.
+        """
+        if self.batch_data_func:
+            data = list(self.batch_data_func(objects))
+            if len(data) != len(objects):
+                raise ValueError("The batch_data_func of the column %s gave "
+                                 "%d values for %d objects." %
+                                 (self.id, len(data), len(objects)))
+            return data
+        if self.memoize:
+            return memoize_batch(objects, self.get_memo_key,
+                                 self.render_data, self.data_cache)
+        return [self.render_data(obj) for obj in objects]
+
+    def get_values_fields(self, model):
+        """
+        Returns the values() lookups of the fields the column reads from
+        the objects of model, or None if it needs model instances.
+        """
+        paths = self.get_data_paths()
+        if paths is None:
+            return None
+        fields = []
+        for path in paths:
+            field = get_value_path(model, path)
+            if field is None:
+                return None
+            fields.append(field)
+        return fields
+
+    def get_data_paths(self):
+        """
+        Returns the attribute paths the column reads from the objects, such
+        as "author.name", or None if it can't be told.
+        """
+        if self.batch_data_func and self.data_fields is None:
+            return None
+        if '.' in self.field_name:
+            paths = [self.field_name]
+        else:
+            paths = [self.db_field]
+        return paths + list(self.data_fields or [])
+
+    def get_export_field(self, model):
+        """
+        Returns the field of model the column shows as is, whose values the
+        typed export formats keep, or None if the column computes its data.
+        """
+        if self.data_func or self.batch_data_func:
+            return None
+        if '.' in self.field_name:
+            return get_path_field(model, self.field_name)
+        return get_path_field(model, self.db_field)
+
 class NonDatabaseColumn(Column):
+    """
+    A column computed in Python by data_func (or batch_data_func) from the
+    object of the row.
+
+    data_fields lists the fields data_func reads. Sorting by a column
+    without extra_sort is done in Python, and when its data_fields are
+    known only those fields are fetched to compute the sort keys.
+    """
     def __init__(self, label="", extra_sort=False, *args, **kwargs):
         Column.__init__(self, label, *args, **kwargs)
         self.db_field = False
         self.extra_sort = extra_sort
+
+    def get_memo_key(self, obj):
+        if self.data_fields is None:
+            return obj
+        return tuple([operator.attrgetter(field.replace('__', '.'))(obj)
+                      for field in self.data_fields])
+
+    def get_data_paths(self):
+        if self.data_fields is None and \
+           (self.data_func or self.batch_data_func):
+            return None
+        return list(self.data_fields or [])
+
+    def get_export_field(self, model):
+        return None
+
     def render_data(self, obj):
         if self.data_func:
             return self.data_func(obj)
         return self.label
 
+class ComputedColumn(Column):
+    """
+    A column computed by the database from an expression, such as the date
+    of the latest comment of each entry:
+
+        last_comment = ComputedColumn("Last comment",
+                                      Max('comment__created_on'))
+
+    The expression can be anything annotate() accepts: an aggregate, or on
+    recent Django versions an F() expression or a correlated Subquery. It
+    is added to the grid queryset under the id of the column, so the column
+    sorts and filters in SQL, survives the optimize_sorts pk re-fetch, and
+    rendering it doesn't cost any work per row. This replaces the raw SQL
+    of NonDatabaseColumn(extra_sort=...).
+    """
+    def __init__(self, label, expression, sortable=True, *args, **kwargs):
+        Column.__init__(self, label, sortable=sortable, *args, **kwargs)
+        self.expression = expression
+
+    def get_values_fields(self, model):
+        return [self.id]
+
+class AggregateColumn(ComputedColumn):
+    """
+    A column showing an aggregate over related objects, such as the number
+    of comments of each entry:
+
+        comments = AggregateColumn("Comments", Count('comment'))
+    """
+    def __init__(self, label, aggregate, *args, **kwargs):
+        ComputedColumn.__init__(self, label, aggregate, *args, **kwargs)
+        self.aggregate = aggregate
+
 class DateTimeColumn(Column):
     """
     A column that renders a date or time.
@@ -246,7 +484,14 @@ class DateTimeColumn(Column):
 
     def render_data(self, obj):
         # return date(getattr(obj, self.field_name), self.format)
-        return date(getattr(obj, self.db_field), self.format)
+        return get_date_formatter(self.format).format(
+            getattr(obj, self.db_field))
+
+    def render_data_batch(self, objects):
+        if self.batch_data_func or self.memoize:
+            return Column.render_data_batch(self, objects)
+        return format_dates([getattr(obj, self.db_field) for obj in objects],
+                            self.format)
 
 class DateTimeSinceColumn(Column):
     """
@@ -257,7 +502,153 @@ class DateTimeSinceColumn(Column):
 
     def render_data(self, obj):
         # return _("%s ago") % timesince(getattr(obj, self.field_name))
-        return _("%s ago") % timesince(getattr(obj, self.db_field))
+        return format_timesince([getattr(obj, self.db_field)])[0]
+
+    def render_data_batch(self, objects):
+        if self.batch_data_func or self.memoize:
+            return Column.render_data_batch(self, objects)
+        # One reference time for the whole page.
+        return format_timesince([getattr(obj, self.db_field)
+                                 for obj in objects])
+
+class ForeignKeyLabelColumn(Column):
+    """
+    A column showing a label of the object a foreign key points to, such as
+    the name of the author of each entry:
+
+        created_by = ForeignKeyLabelColumn("Author", label_field="username")
+
+    The label is label_field of the related object, or label_func(object)
+    (unicode by default). The labels of a page are resolved with one query
+    on the ids of its foreign keys instead of joining the related table,
+    and are kept across requests in an LRU cache of the column, which
+    saving or deleting a related object invalidates. So most pages don't
+    need any query for them. The column sorts by label_field when given.
+    """
+    def __init__(self, label, label_field=None, label_func=unicode,
+                 model=None, cache_size=1000, cache_timeout=300,
+                 sortable=True, *args, **kwargs):
+        Column.__init__(self, label, sortable=sortable, *args, **kwargs)
+        self.label_field = label_field
+        self.label_func = label_func
+        self.label_sort = kwargs.get('sort_field') is None
+        self.model = None
+        self.label_cache = LRUCache(cache_size, cache_timeout)
+        if model is not None:
+            self.set_related_model(model)
+
+    def set_related_model(self, model):
+        self.model = model
+        uid = 'datagrid-labels-%s' % id(self)
+        post_save.connect(self.invalidate_label, sender=model,
+                          weak=False, dispatch_uid=uid)
+        post_delete.connect(self.invalidate_label, sender=model,
+                            weak=False, dispatch_uid=uid)
+
+    def get_related_model(self):
+        if self.model is None:
+            self.set_related_model(self.datagrid.queryset.model._meta.get_field(
+                self.db_field).rel.to)
+        return self.model
+
+    def invalidate_label(self, sender, instance, **kwargs):
+        self.label_cache.delete(instance.pk)
+
+    def get_related_id(self, obj):
+        # Objects hold the id in the attname of the field, values() rows
+        # and documents in the field itself.
+        value = getattr(obj, self.db_field + '_id', _missing)
+        if value is _missing:
+            value = getattr(obj, self.db_field, None)
+        return value
+
+    def get_labels(self, ids):
+        """
+        Returns the labels of the related objects by id, fetching those
+        that aren't cached with one query.
+        """
+        labels = {}
+        missing = []
+        for pk in set(ids):
+            if pk is None:
+                continue
+            label = self.label_cache.get(pk, _missing)
+            if label is _missing:
+                missing.append(pk)
+            else:
+                labels[pk] = label
+        if missing:
+            manager = self.get_related_model()._default_manager
+            if self.label_field:
+                fetched = manager.filter(pk__in=missing).values_list(
+                    'pk', self.label_field)
+            else:
+                fetched = [(pk, self.label_func(obj)) for pk, obj in
+                           manager.in_bulk(missing).items()]
+            for pk, label in fetched:
+                labels[pk] = label
+                self.label_cache.set(pk, label)
+        return labels
+
+    def render_data_batch(self, objects):
+        ids = [self.get_related_id(obj) for obj in objects]
+        labels = self.get_labels(ids)
+        return [labels.get(pk, self.default) for pk in ids]
+
+    def render_data(self, obj):
+        return self.render_data_batch([obj])[0]
+
+    def get_data_paths(self):
+        if isinstance(self.datagrid.queryset, DjangoQuerySetAdapter):
+            # The id of the foreign key, without following the relation.
+            return [self.db_field + '_id']
+        return [self.db_field]
+
+    def get_values_fields(self, model):
+        # Under its attname, as the name of the foreign key is the one the
+        # lookups of other columns following it are nested under.
+        return [self.db_field + '_id']
+
+
+def get_declared_models(grid_class, model):
+    """
+    Returns model and the models the columns, filters and search fields of
+    a grid class reach from it through forward relations.
+    """
+    meta = getattr(grid_class, 'Meta', None)
+    paths = list(getattr(meta, 'filtering_options', {}))
+    paths += [field.lstrip('^=@')
+              for field in getattr(meta, 'search_fields', [])]
+    for attr in dir(grid_class):
+        column = getattr(grid_class, attr)
+        if not isinstance(column, Column):
+            continue
+        paths += [column.field_name or attr, column.sort_field or attr]
+        paths += list(column.data_fields or []) + column.get_link_paths()
+        lookup = getattr(getattr(column, 'expression', None), 'lookup', None)
+        if lookup:
+            paths.append(lookup)
+    models = [model]
+    for path in paths:
+        models.extend(get_forward_models(model, path))
+    return sorted(set(models), key=lambda model: model._meta.db_table)
+
+
+class DataGridMetaclass(type):
+    """
+    Tracks the models a grid class shows (see get_declared_models) as soon
+    as it is defined, when its Meta declares the model of its queryset. So
+    their versions change with the saves and deletes of every process
+    importing the grid, not only of those which rendered it.
+    """
+    def __new__(cls, name, bases, attrs):
+        new_class = super(DataGridMetaclass, cls).__new__(cls, name, bases,
+                                                          attrs)
+        model = getattr(getattr(new_class, 'Meta', None), 'model', None)
+        if model is not None:
+            for related in get_declared_models(new_class, model):
+                track_model(related)
+        return new_class
 
 
 class DataGrid(object):
@@ -299,11 +690,17 @@ class DataGrid(object):
                                     turned off for more advanced querysets
                                     (such as when using extra()).
                                     The default is True.
+        * 'sort_cache_timeout':     The number of seconds the order of the
+                                    rows sorted by a NonDatabaseColumn is
+                                    cached. The default is 300.
     """
+    __metaclass__ = DataGridMetaclass
+
     def __init__(self, request, queryset, title="", extra_context={},
                  optimize_sorts=True, listview_template='datagrid/listview.html',
                  column_header_template='datagrid/column_header.html', cell_template='datagrid/cell.html'):
         self.request = request
+        self._query = None
         if isinstance(queryset, QuerySetAdapter):
             self.queryset = queryset
         elif isinstance(queryset, list):
@@ -316,6 +713,10 @@ class DataGrid(object):
             raise Exception("Unsupported Query Type")
 
         self.rows = []
+        self.footer = []
+        self.groups = []
+        self.group_column = None
+        self.annotated_columns = []
         self.columns = []
         self.all_columns = []
         self.db_field_map = {}
@@ -324,6 +725,9 @@ class DataGrid(object):
         self.page = None
         self.sort_list = None
         self.state_loaded = False
+        self.data_loaded = False
+        self.search_loaded = False
+        self.filter_loaded = False
         self.page_num = 0
         self.id = None
         self.extra_context = dict(extra_context)
@@ -345,6 +749,7 @@ class DataGrid(object):
         self.listview_template = listview_template
         self.column_header_template = column_header_template
         self.cell_template = cell_template
+        self.sort_cache_timeout = 300
 
 
         for attr in dir(self):
@@ -362,10 +767,19 @@ class DataGrid(object):
                 if not column.field_name:
                     column.field_name = column.id
 
+                if isinstance(column, ComputedColumn):
+                    # The expression is annotated under the id of the column.
+                    column.field_name = column.db_field = column.id
+                    column.sort_field = column.id
+
                 if not column.db_field and \
                   not isinstance(column, NonDatabaseColumn):
                     column.db_field = column.field_name
                     column.sort_field = column.field_name
+                if isinstance(column, ForeignKeyLabelColumn) and \
+                   column.label_field and column.label_sort:
+                    column.sort_field = "%s.%s" % (column.db_field,
+                                                   column.label_field)
                 if column.db_field:
                     self.db_field_map[column.id] = column.db_field
 
@@ -397,18 +811,45 @@ class DataGrid(object):
         self.filtering_options = getattr(meta, 'filtering_options', {})
         self.filter_fields = self.filtering_options.keys()
         self.search_fields = getattr(meta, 'search_fields', [])
+        self.group_by = getattr(meta, 'group_by', None)
+        self.projection = getattr(meta, 'projection', True)
+        self.required_fields = getattr(meta, 'required_fields', [])
+        self.fast_rows = getattr(meta, 'fast_rows', True)
+        self.background_exports = getattr(meta, 'background_exports',
+                                          ('pdf', 'xlsx'))
+        self.modified_field = getattr(meta, 'modified_field', None)
+        self.cache_timeout = getattr(meta, 'cache', None)
+        self.cache_per_user = getattr(meta, 'cache_per_user', False)
+        self.row_cache = getattr(meta, 'row_cache', None)
+        self.watermark = None
+        self.watermark_key = None
+        self.unfiltered_queryset = self.queryset
+
+
+    def get_query(self):
+        """
+        Returns the QueryState of the parameters of the request, parsed once
+        for all the urls of the grid: sort headers, column toggles, pages
+        and exports.
+        """
+        if self._query is None:
+            self._query = QueryState(self.request.GET)
+        return self._query
+    query = property(get_query)
 
-
-    def load_state(self):
+    def load_state(self, precompute=True):
         """
         Loads the state of the datagrid.
 
         This will retrieve the user-specified or previously stored
         sorting order and columns list, as well as any state a subclass
-        may need.
+        may need. The objects of the page are then fetched, unless
+        precompute is False, such as for exports.
         """
 
         if self.state_loaded:
+            if precompute:
+                self.precompute()
             return
 
         profile_sort_list = None
@@ -438,21 +879,34 @@ class DataGrid(object):
                 pass
 
 
-        columns = self.all_columns
+        # Figure out the columns we're going to display, from the request,
+        # the profile, or all of them.
+        colnames_str = self.request.GET.get('columns', profile_columns_list)
 
+        if colnames_str:
+            colnames = colnames_str.split(',')
+        else:
+            colnames = [column.id for column in self.all_columns]
+
+        if self.profile_columns_field and profile and \
+           colnames_str and colnames_str != profile_columns_list:
+            setattr(profile, self.profile_columns_field, colnames_str)
+            profile_dirty = True
+
+        # Skip the columns the user specified that don't exist.
+        columns = [column for column in
+                   [getattr(self, colname, None) for colname in colnames]
+                   if isinstance(column, Column)] or self.all_columns
 
         expand_columns = []
         normal_columns = []
+        self.columns = []
 
-        for colname in columns:
-            try:
-                column = getattr(self, colname.id)
-            except AttributeError:
-                # The user specified a column that doesn't exist. Skip it.
+        for column in columns:
+            if column in self.columns:
                 continue
 
-            if column not in self.columns:
-                self.columns.append(column)
+            self.columns.append(column)
             column.active = True
 
             if column.expand:
@@ -507,10 +961,34 @@ class DataGrid(object):
         if self.load_extra_state(profile):
             profile_dirty = True
 
+        if profile and profile_dirty:
+            profile.save()
+
         self.state_loaded = True
 
+        if precompute:
+            self.precompute()
+
+    def precompute(self):
+        """
+        Fetches the groups or the objects of the page, once the state is
+        loaded.
+        """
+        if self.data_loaded:
+            return
+        self.data_loaded = True
+
+        group_by = self.request.GET.get('group_by', self.group_by)
+        if group_by in self.db_field_map and \
+           not isinstance(getattr(self, group_by), ComputedColumn):
+            # The values the database computes per row can't be grouped.
+            self.group_column = getattr(self, group_by)
+
         # Fetch the list of objects and have it ready.
-        self.precompute_objects()
+        if self.group_column:
+            self.precompute_groups()
+        else:
+            self.precompute_objects()
 
 
     def load_extra_state(self, profile):
@@ -528,11 +1006,45 @@ class DataGrid(object):
         Builds the queryset and stores the list of objects for use in
         rendering the datagrid.
         """
-        query = self.queryset
-        use_select_related = False
+        query, python_sort, sort_list, extra_names = self.get_sorted_query()
+
+        self.paginator = Paginator(query, self.paginate_by,
+                                           self.paginate_orphans)
+        self.compute_footer()
+        self.page = self.get_page()
+
+        self.rows = []
+        self.rows_raw = []
+        id_list = None
+
+        if python_sort:
+            # The page holds the sorted pks, fetch their objects.
+            id_list = list(self.page.object_list)
+        elif self.optimize_sorts and len(sort_list) > 0:
+            # This can be slow when sorting by multiple columns. If we
+            # have multiple items in the sort list, we'll request just the
+            # IDs and then fetch the actual details from that.
+            id_list = list(self.iter_sorted_ids(
+                self.page.object_list.distinct(), extra_names))
+
+        self.page.object_list = self.load_objects(id_list,
+                                                  self.page.object_list)
+        self.rows = self.build_rows(self.page.object_list)
+
+    def get_sorted_query(self):
+        """
+        Returns the filtered queryset sorted by the sort list, whether it is
+        sorted in Python (a PythonSortedList of the pks then), the fields
+        the database sorts by and the names of the extra selects among them.
+        """
+        query = self.annotate_queryset(self.queryset,
+            [column for column in self.get_query_columns()
+             if column not in self.annotated_columns])
         # Generate the actual list of fields we'll be sorting by
         sort_list = []
         extra_sort_list = []
+        extra_names = []
+        python_sort = False
         for sort_item in self.sort_list:
             if sort_item[0] == "-":
                 base_sort_item = sort_item[1:]
@@ -543,19 +1055,21 @@ class DataGrid(object):
 
             if sort_item and base_sort_item in self.db_field_map:
                 db_field = self.sort_field_map[base_sort_item]
+                if isinstance(self.queryset, DjangoQuerySetAdapter):
+                    # Lookups spanning tables are followed by the ORM.
+                    db_field = db_field.replace('.', '__')
                 sort_list.append(prefix + db_field)
-
-                # Lookups spanning tables require that we query from those
-                # tables. In order to keep things simple, we'll just use
-                # select_related so that we don't have to figure out the
-                # table relationships. We only do this if we have a lookup
-                # spanning tables.
-                if '.' in db_field:
-                    use_select_related = True
             else:
                 column = getattr(self,base_sort_item)
                 if column.extra_sort:
                     extra_sort_list.append({sort_item:column.extra_sort})
+                    if isinstance(self.queryset, DjangoQuerySetAdapter):
+                        # The selected value is sorted along with the other
+                        # fields, in the requested order.
+                        sort_list.append(sort_item)
+                        extra_names.append(base_sort_item)
+                elif column.data_func:
+                    python_sort = True
 
         if extra_sort_list:
             query = query.extra_sort(*extra_sort_list)
@@ -564,13 +1078,319 @@ class DataGrid(object):
             query = query.order_by(*sort_list)
         if not ( sort_list or extra_sort_list):
             query = query.order_by()
+        if python_sort:
+            query = self.get_python_sorted_list(self.annotate_queryset(
+                self.queryset, [column for column in self.get_query_columns()
+                                if column not in self.annotated_columns]))
+        else:
+            query = self.project_queryset(query)
+        return query, python_sort, sort_list, extra_names
+
+    def iter_sorted_ids(self, queryset, extra_names=()):
+        """
+        Streams the pks of a sorted queryset, in order.
+        """
+        selected = self.get_annotations(
+            self.get_query_columns() + self.annotated_columns).keys() + \
+            list(extra_names)
+        if selected:
+            # The annotations have to stay in the select list for the
+            # database to sort by them.
+            rows = queryset.values_list('pk', *selected)
+        else:
+            rows = queryset.values_list('pk', flat=True)
+        if hasattr(rows, 'iterator'):
+            rows = rows.iterator()
+        for row in rows:
+            yield row[0] if selected else row
+
+    def get_keyset(self, sort_list, extra_names=()):
+        """
+        Returns the (lookup, descending) pairs of the sort list, ended by
+        the pk to make them unique, to page through the sorted queryset by
+        filtering the rows after the last one fetched. Returns None when a
+        sort key can't be compared in a filter: an extra select, an
+        annotation, a relation or a field that may be NULL (nullable, or
+        through a nullable foreign key), as NULLs don't compare.
+        """
+        if extra_names:
+            return None
+        model = self.queryset.model
+        keyset = []
+        for sort_item in sort_list:
+            lookup = sort_item.lstrip('-')
+            if lookup == 'pk':
+                field = model._meta.pk
+            else:
+                field = get_path_field(model, lookup)
+                if field is not None and is_nullable_path(model, lookup):
+                    field = None
+            if field is None or field.null:
+                return None
+            keyset.append((lookup, sort_item.startswith('-')))
+            if field is model._meta.pk and '__' not in lookup:
+                return keyset
+        return keyset + [('pk', False)]
+
+    def get_keyset_rows(self, queryset, keyset, bounds=(None, None)):
+        """
+        Returns the queryset sorted by the keyset, as tuples of the values
+        of its lookups. The annotations stay selected after them, as in
+        iter_sorted_ids(), so the rows are still grouped by the object.
 
+        bounds are the keyset values of the first row and of the row
+        following the last, or None to start from the first row or to
+        end with the last.
+        """
+        first, following = bounds
+        if first is not None:
+            queryset = queryset.filter(
+                get_keyset_filter(keyset, first, inclusive=True))
+        if following is not None:
+            # The rows before it are those after it in the reverse order.
+            queryset = queryset.filter(get_keyset_filter(
+                [(lookup, not descending) for lookup, descending in keyset],
+                following))
+        selected = self.get_annotations(
+            self.get_query_columns() + self.annotated_columns).keys()
+        return queryset.order_by(*[
+            descending and '-' + lookup or lookup
+            for lookup, descending in keyset
+        ]).values_list(*([lookup for lookup, descending in keyset] +
+                         selected))
+
+    def iter_keyset_chunks(self, queryset, keyset, chunk_size=1000, start=0,
+                           end=None, bounds=(None, None)):
+        """
+        Streams the rows of get_keyset_rows(), from the row at offset start
+        to the one at end (excluded), in lists of at most chunk_size, each
+        selected after the last row of the previous one.
+        """
+        queryset = self.get_keyset_rows(queryset, keyset, bounds)
+        last = None
+        while end is None or start < end:
+            stop = start + chunk_size
+            if end is not None:
+                stop = min(stop, end)
+            if last is None:
+                rows = list(queryset[start:stop])
+            else:
+                rows = list(queryset.filter(
+                    get_keyset_filter(keyset, last))[:stop - start])
+            if rows:
+                yield rows
+                last = rows[-1][:len(keyset)]
+            if len(rows) < stop - start:
+                break
+            start = stop
+
+    def iter_sorted_id_chunks(self, queryset, sort_list, extra_names=(),
+                              chunk_size=1000, start=0, end=None,
+                              bounds=(None, None)):
+        """
+        Streams the pks of a sorted queryset, from the row at offset start
+        to the one at end (excluded), in lists of at most chunk_size, a
+        query each, so that they are never all in memory: client side
+        cursors fetch the whole result of a query at once.
+
+        Each chunk follows the last row of the previous one when the sort
+        keys allow it (see get_keyset), else it is sliced at its offset.
+        The bounds of get_keyset_rows() only apply in the first case.
+        """
+        keyset = self.get_keyset(sort_list, extra_names)
+        if keyset is not None:
+            for rows in self.iter_keyset_chunks(queryset, keyset, chunk_size,
+                                                start, end, bounds):
+                yield [row[len(keyset) - 1] for row in rows]
+            return
+        while end is None or start < end:
+            stop = start + chunk_size
+            if end is not None:
+                stop = min(stop, end)
+            id_list = list(self.iter_sorted_ids(queryset[start:stop],
+                                                extra_names))
+            if id_list:
+                yield id_list
+            if len(id_list) < stop - start:
+                break
+            start = stop
+
+    def load_objects(self, id_list=None, object_list=None):
+        """
+        Returns the objects of id_list in its order, or those of
+        object_list, ready for the columns: with their relations fetched,
+        and as records when the columns only read fields.
+        """
+        if id_list is not None:
+            # Make sure to unset the order. We can't meaningfully order these
+            # results in the query, as what we really want is to keep it in
+            # the order specified in id_list, and we certainly don't want
+            # the database to do any special ordering (possibly slowing things
+            # down). We'll set the order properly in a minute.
+            object_list = self.post_process_queryset(
+                self.annotate_queryset(self.queryset.filter_pk(
+                    id_list, self.get_projection())))
+        object_list = self.select_relations(object_list)
+
+        # Grab the whole list at once. We know it won't be too large,
+        # and it will prevent one query per row.
+        values_fields = self.get_values_fields()
+        if isinstance(object_list, ValuesQuerySet):
+            object_list = records_from_dicts(object_list)
+        elif values_fields and isinstance(object_list, QuerySet):
+            # The columns only read fields, don't build model instances.
+            Record = record_class(values_fields)
+            object_list = [Record._make(row) for row in
+                           object_list.values_list(*values_fields)]
+        else:
+            object_list = list(object_list)
 
+        if id_list:
+            # The database will give us the items in a more or less random
+            # order, since it doesn't know to keep it in the order provided by
+            # the ID list. This will place the results back in the order we
+            # expect.
+            object_list = self.order_by_ids(object_list, id_list)
+        return object_list
 
+    def iter_export_chunks(self, chunk_size=1000):
+        """
+        Streams the objects of the whole filtered and sorted grid, in lists
+        of at most chunk_size, so exports use constant memory.
 
+        Django querysets fetch their sorted pks a chunk at a time and load
+        the objects of each chunk like a page. The other data sources
+        stream their rows in batches. Grids sorted in Python hold all their
+        sorted pks, as they have to sort them.
+        """
+        query, python_sort, sort_list, extra_names = self.get_sorted_query()
+        if python_sort:
+            ids = iter(query[:])
+        elif isinstance(self.queryset, DjangoQuerySetAdapter):
+            for id_list in self.iter_sorted_id_chunks(
+                    query.distinct(), sort_list, extra_names, chunk_size):
+                yield self.load_objects(id_list)
+            return
+        else:
+            for objects in query.iterate_chunks(chunk_size,
+                                                self.get_projection()):
+                yield objects
+            return
+        while True:
+            id_list = list(itertools.islice(ids, chunk_size))
+            if not id_list:
+                break
+            yield self.load_objects(id_list)
 
-        self.paginator = Paginator(query, self.paginate_by,
-                                           self.paginate_orphans)
+    def get_unannotated_queryset(self):
+        """
+        Returns the filtered queryset without the annotations added to
+        filter by computed columns. Aggregating over annotations isn't
+        supported by every Django version, so the filtered rows are
+        selected by a subquery instead.
+        """
+        if not self.annotated_columns:
+            return self.queryset
+        return DjangoQuerySetAdapter(
+            self.queryset.filter_pk(self.queryset.values('pk')))
+
+    def get_query_columns(self):
+        """
+        Returns the active columns, followed by the hidden columns the grid
+        is sorted by.
+        """
+        columns = list(self.columns)
+        for sort_item in self.sort_list or []:
+            column = getattr(self, sort_item.lstrip("-"), None)
+            if isinstance(column, Column) and column not in columns:
+                columns.append(column)
+        return columns
+
+    def get_annotations(self, columns=None):
+        """
+        Returns the expressions of the ComputedColumns by column id, for the
+        given columns or the active ones.
+        """
+        if columns is None:
+            columns = self.columns
+        return dict([(column.id, column.expression)
+                     for column in columns
+                     if isinstance(column, ComputedColumn)])
+
+    def annotate_queryset(self, queryset, columns=None):
+        """
+        Adds the expressions of the ComputedColumns to the queryset, all in a
+        single annotate() call.
+        """
+        annotations = self.get_annotations(columns)
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+        return queryset
+
+    def get_python_sorted_list(self, query):
+        """
+        Returns the pks of the query sorted in Python by the sort list, for
+        sorts involving a NonDatabaseColumn the data source can't sort by.
+
+        Only the pk and the fields the sort keys need are streamed from the
+        adapter, unless a column doesn't declare its data_fields. The whole
+        ordering is cached for the current version of the data when it can
+        be told, otherwise each page is taken from a bounded heap.
+        """
+        sort_columns = [(sort_item.startswith("-"),
+                         getattr(self, sort_item.lstrip("-")))
+                        for sort_item in self.sort_list]
+        fields = set()
+        for descending, column in sort_columns:
+            if column.db_field:
+                fields.add(column.sort_field.replace('.', '__'))
+            elif column.data_fields is not None and fields is not None:
+                fields.update(column.data_fields)
+            elif column.data_func:
+                fields = None
+                break
+
+        key_funcs = []
+        for descending, column in sort_columns:
+            if column.db_field:
+                key_func = operator.attrgetter(column.sort_field)
+            elif column.data_func:
+                key_func = column.data_func
+            else:
+                continue
+            if descending:
+                key_func = lambda obj, key_func=key_func: \
+                    ReverseKey(key_func(obj))
+            key_funcs.append(key_func)
+        if fields is not None:
+            fields = sorted(fields)
+
+        version = self.get_data_version()
+        if version is None:
+            cache_key = None
+        else:
+            cache_key = self.get_cache_key('sort', ",".join(self.sort_list),
+                                           version)
+        return PythonSortedList(
+            query, fields,
+            lambda obj: tuple([key_func(obj) for key_func in key_funcs]),
+            cache_key, self.sort_cache_timeout)
+
+    def get_data_version(self):
+        """
+        Returns the version of the data of the grid model, which changes
+        whenever one of its objects is saved or deleted, or None if it
+        can't be told.
+        """
+        if not isinstance(self.queryset, DjangoQuerySetAdapter):
+            return None
+        track_model(self.queryset.model)
+        return get_model_version(self.queryset.model)
+
+    def get_page(self):
+        """
+        Returns the page of the paginator requested by the 'page' parameter.
+        """
         page_num = self.request.GET.get('page', 1)
 
         # Accept either "last" or a valid page number.
@@ -578,55 +1398,329 @@ class DataGrid(object):
             page_num = self.paginator.num_pages
 
         try:
-            self.page = self.paginator.page(page_num)
+            return self.paginator.page(page_num)
         except InvalidPage:
             raise Http404
 
-        self.rows = []
-        self.rows_raw = []
-        id_list = None
+    @staticmethod
+    def order_by_ids(object_list, id_list):
+        """
+        Returns the objects in the order of id_list.
+        """
+        index = dict([(id, pos) for (pos, id) in enumerate(id_list)])
+        ordered_list = [None] * len(id_list)
+        for obj in list(object_list):
+            ordered_list[index[obj.id]] = obj
+        return ordered_list
 
-        if self.optimize_sorts and len(sort_list) > 0:
-            # This can be slow when sorting by multiple columns. If we
-            # have multiple items in the sort list, we'll request just the
-            # IDs and then fetch the actual details from that.
-            id_list = list(self.page.object_list.distinct().values_list(
-                'pk', flat=True))
-            # Make sure to unset the order. We can't meaningfully order these
-            # results in the query, as what we really want is to keep it in
-            # the order specified in id_list, and we certainly don't want
-            # the database to do any special ordering (possibly slowing things
-            # down). We'll set the order properly in a minute.
-            self.page.object_list = self.post_process_queryset(
-                self.queryset.filter_pk(id_list))
-        if use_select_related:
-            self.page.object_list = \
-                self.page.object_list.select_related(depth=1)
+    def build_rows(self, object_list):
+        """
+        Renders the cells and data of each object for the active columns.
 
-        if id_list:
-            # The database will give us the items in a more or less random
-            # order, since it doesn't know to keep it in the order provided by
-            # the ID list. This will place the results back in the order we
-            # expect.
-            index = dict([(id, pos) for (pos, id) in enumerate(id_list)])
-            object_list = [None] * len(id_list)
-            for obj in list(self.page.object_list):
-                object_list[index[obj.id]] = obj
+        With Meta.row_cache the rendered rows are read from the cache with
+        a single get_many, and only the rows missing from it are rendered,
+        then cached.
+        """
+        object_list = list(object_list)
+        keys = self.get_row_cache_keys(object_list)
+        if keys is None:
+            keys = [None] * len(object_list)
+            cached = {}
         else:
-            # Grab the whole list at once. We know it won't be too large,
-            # and it will prevent one query per row.
-            if isinstance(self.page.object_list, ValuesQuerySet):
-                object_list = [ Struct(**i) for i in self.page.object_list ]
+            cached = cache.get_many(keys)
+        rendered = iter(self.render_rows([obj for obj, key in
+                                          zip(object_list, keys)
+                                          if key not in cached]))
+        rows = []
+        missed = {}
+        for obj, key in zip(object_list, keys):
+            if key in cached:
+                cells, data = cached[key]
             else:
-                object_list = list(self.page.object_list)
+                cells, data = rendered.next()
+                if key is not None:
+                    missed[key] = (cells, data)
+            rows.append({
+                'object': obj,
+                'cells': list(cells),
+                'data': list(data),
+            })
+        if missed:
+            cache.set_many(missed, self.row_cache)
+        return rows
 
+    def render_rows(self, object_list):
+        """
+        Returns the rendered cells and data of each object, rendering each
+        column for all the objects at once.
+        """
+        columns_data = []
+        columns_urls = []
+        for column in self.columns:
+            data = column.render_data_batch(object_list)
+            columns_data.append(data)
+            columns_urls.append(column.get_link_urls(object_list, data))
+        rows = []
+        for obj, data, urls in zip(object_list, zip(*columns_data),
+                                   zip(*columns_urls)):
+            rows.append(([column.render_cell(obj, datum, url)
+                          for column, datum, url in
+                          zip(self.columns, data, urls)], list(data)))
+        return rows
+
+    def get_row_cache_keys(self, object_list):
+        """
+        Returns the keys of the rendered rows of the objects in the cache,
+        or None when the grid doesn't cache them (Meta.row_cache).
+
+        A row is the same across pages, sorts, filters and searches: its
+        key holds the grid, the active columns, the user if
+        Meta.cache_per_user, the pk of the object and the value of its
+        Meta.modified_field, or else the version of the grid model, and the
+        versions of the related models the columns show.
+        """
+        if not self.row_cache or \
+           not isinstance(self.queryset, DjangoQuerySetAdapter):
+            return None
+        model = self.queryset.model
+        parts = [','.join([column.id for column in self.columns]),
+                 get_language()]
+        if self.cache_per_user:
+            parts.append(self.request.user.pk)
+        for related in self.get_cache_models():
+            if related is not model or not self.modified_field:
+                track_model(related)
+                parts.append(get_model_version(related))
+        prefix = 'datagrid-row:%s.%s:%s' % (
+            self.__class__.__module__, self.__class__.__name__,
+            hashlib.md5(smart_str(u'|'.join([force_unicode(part)
+                                             for part in parts]))
+                        ).hexdigest())
+        attname = model._meta.pk.attname
+        keys = []
         for obj in object_list:
-            self.rows.append({
-                'object': obj,
-                'cells': [column.render_cell(obj) for column in self.columns],
-                'data': [column.render_data(obj) for column in self.columns],
+            row = [getattr(obj, attname)]
+            if self.modified_field:
+                row.append(getattr(obj, self.modified_field))
+            keys.append('%s:%s' % (prefix, hashlib.md5(smart_str(
+                u'|'.join([force_unicode(value) for value in row]))
+            ).hexdigest()))
+        return keys
+
+    def get_row_cache_paths(self):
+        """Returns the fields the keys of the cached rows read."""
+        if self.row_cache and self.modified_field:
+            return [self.modified_field]
+        return []
+
+    def precompute_groups(self):
+        """
+        Builds the page of groups shown in the grouped mode, along with the
+        rows of the expanded groups.
+
+        The groups are computed by the database, with a
+        values(field).annotate(...) query on Django and a $group stage on
+        mongo, giving the count and the footer aggregates of the columns
+        for each group. Only the page of groups is fetched, and the members
+        of a group are loaded through filter_pk when it is expanded.
+        """
+        column = self.group_column
+        field = column.db_field.replace('.', '__')
+        aggregates = dict([(other.id,
+                            other.footer(other.db_field.replace('.', '__')))
+                           for other in self.get_footer_columns()
+                           if other is not column])
+        aggregates['datagrid_count'] = Count('pk')
+        descending = ("-%s" % column.id) in self.sort_list
+        self.paginator = Paginator(
+            self.get_unannotated_queryset().group_by(field, descending,
+                                                     **aggregates),
+            self.paginate_by, self.paginate_orphans)
+        self.page = self.get_page()
+
+        expanded = self.request.GET.getlist('expand')
+        self.groups = []
+        for group in self.page.object_list:
+            value = group[field]
+            is_expanded = unicode(value) in expanded
+            if is_expanded:
+                expand = [i for i in expanded if i != unicode(value)]
+            else:
+                expand = expanded + [unicode(value)]
+            if is_expanded:
+                rows = self.build_rows(self.get_group_members(field, value))
+            else:
+                rows = []
+            self.groups.append({
+                'value': value,
+                'count': group['datagrid_count'],
+                'cells': [(other is column,
+                           value if other is column else group.get(other.id))
+                          for other in self.columns],
+                'expanded': is_expanded,
+                'expand_url': self.query.url({'expand': expand}),
+                'rows': rows,
             })
 
+    def get_group_members(self, field, value):
+        """
+        Loads the objects of a group, at most paginate_by of them.
+        """
+        id_list = list(self.queryset.filter(**{field: value}).values_list(
+            'pk', flat=True)[:self.paginate_by])
+        return self.load_objects(id_list)
+
+    def get_related_paths(self):
+        """
+        Returns the attribute paths the active columns read from the
+        objects, such as "author.name".
+        """
+        paths = []
+        for column in self.columns:
+            if not isinstance(column, ComputedColumn):
+                paths.extend(column.get_data_paths() or [])
+            paths.extend(column.get_link_paths())
+        return paths
+
+    def get_projection(self):
+        """
+        Returns the fields of the objects the active columns read, or None
+        if they can't be told, such as when a NonDatabaseColumn doesn't
+        declare its data_fields, a column reads a property or links with a
+        link_func.
+
+        Only the first field of the paths following relations is listed,
+        the related objects are fetched whole.
+        """
+        if not self.projection:
+            return None
+        if django.VERSION < (1, 4) and self.get_annotations(
+                self.get_query_columns() + self.annotated_columns):
+            # Django 1.3 reads the annotations of deferred objects from the
+            # wrong columns.
+            return None
+        paths = list(self.required_fields) + self.get_row_cache_paths()
+        for column in self.columns:
+            if column.link and not column.link_url or \
+               callable(column.css_class):
+                # link_func and css_class may read any field of the object.
+                return None
+            if not isinstance(column, ComputedColumn):
+                column_paths = column.get_data_paths()
+                if column_paths is None:
+                    return None
+                paths.extend(column_paths)
+            paths.extend(column.get_link_paths())
+        fields = set(path.replace('__', '.').split('.')[0] for path in paths)
+
+        if isinstance(self.queryset, DjangoQuerySetAdapter):
+            opts = self.queryset.model._meta
+            names = {}
+            for field in opts.fields:
+                names[field.name] = names[field.attname] = field.name
+            projection = set()
+            for field in fields:
+                if field in names:
+                    projection.add(names[field])
+                elif get_relation(self.queryset.model, field)[0] is None:
+                    # Not a field, it may read any of them.
+                    return None
+            fields = projection
+        return sorted(fields)
+
+    def get_values_fields(self):
+        """
+        Returns the values() lookups of the fields the active columns read,
+        starting with the pk, when they only read fields of the model and
+        its foreign keys. Returns None if the columns need model instances,
+        such as for links of a link_func or data_funcs reading any attribute.
+        """
+        if not self.fast_rows or \
+           not isinstance(self.queryset, DjangoQuerySetAdapter) or \
+           self.post_process_queryset.im_func is not \
+           DataGrid.post_process_queryset.im_func:
+            return None
+        model = self.queryset.model
+        fields = [model._meta.pk.attname] + self.get_row_cache_paths()
+        for column in self.columns:
+            if column.link and not column.link_url or \
+               callable(column.css_class):
+                return None
+            column_fields = column.get_values_fields(model)
+            if column_fields is None:
+                return None
+            fields.extend(column_fields)
+            for path in column.get_link_paths():
+                field = get_value_path(model, path)
+                if field is None:
+                    return None
+                fields.append(field)
+        values_fields = []
+        for field in fields:
+            if field not in values_fields:
+                values_fields.append(field)
+        nested = set([field.split('__')[0] for field in values_fields
+                      if '__' in field])
+        if nested.intersection(values_fields):
+            # A field read as is and followed by other lookups, such as a
+            # foreign key's id and one of its fields, can't be both.
+            return None
+        return values_fields
+
+    def project_queryset(self, queryset):
+        """
+        Restricts the fields the queryset fetches to the projection of
+        the active columns, when the data source supports it.
+        """
+        fields = self.get_projection()
+        if fields is None or isinstance(queryset, ValuesQuerySet) or \
+           not hasattr(queryset, 'only'):
+            return queryset
+        return queryset.only(*fields)
+
+    def select_relations(self, object_list):
+        """
+        Joins (select_related) or prefetches (prefetch_related, on Django
+        1.4 and later) the relations the active columns follow, so a page
+        costs the same number of queries whatever its number of rows.
+        """
+        if not isinstance(self.queryset, DjangoQuerySetAdapter) or \
+           not isinstance(object_list, QuerySet) or \
+           isinstance(object_list, ValuesQuerySet):
+            return object_list
+        return apply_plan(object_list, *plan_queryset(
+            self.queryset.model, self.get_related_paths()))
+
+    def get_footer_columns(self):
+        """
+        Returns the active columns with a footer aggregate. The footers of
+        the ComputedColumns are left out: the aggregates run over the
+        unannotated queryset (see get_unannotated_queryset).
+        """
+        return [column for column in self.columns
+                if column.footer and column.db_field and
+                   not isinstance(column, ComputedColumn)]
+
+    def compute_footer(self):
+        """
+        Computes the footer aggregates of the columns over the filtered
+        queryset.
+
+        All of them are computed by a single aggregate() call, which also
+        counts the rows for the paginator, so showing a footer doesn't cost
+        more queries than the count.
+        """
+        aggregates = dict([(column.id,
+                            column.footer(column.db_field.replace('.', '__')))
+                           for column in self.get_footer_columns()])
+        if not aggregates:
+            self.footer = []
+            return
+        aggregates['datagrid_count'] = Count('pk')
+        values = self.get_unannotated_queryset().aggregate(**aggregates)
+        self.paginator._count = values.pop('datagrid_count')
+        self.footer = [values.get(column.id) for column in self.columns]
+
     def post_process_queryset(self, queryset):
         """
         Processes a QuerySet after the initial query has been built and
@@ -643,8 +1737,9 @@ class DataGrid(object):
         return queryset
 
     def handle_search(self):
-        if not self.search_fields:
+        if not self.search_fields or self.search_loaded:
             return
+        self.search_loaded = True
         query = self.request.GET.get('q', None)
         if not query:
             return
@@ -655,19 +1750,65 @@ class DataGrid(object):
         self.queryset = self.queryset.filter(query_criteria)
 
     def handle_filter(self):
-        queryset = self.queryset
-        if not self.filter_fields:
+        if not self.filter_fields or self.filter_loaded:
             return
+        self.filter_loaded = True
+        self.unfiltered_queryset = self.queryset
         for field in self.filter_fields:
-            query = self.request.GET.get(field, None)
-            if query:
-                if query.startswith("!"):
-                    opts = self.filtering_options[field]
-                    if opts.inverse:
-                        query = query[1:]
-                        self.queryset = queryset.exclude(**{field: query})
-                        return
-                self.queryset = queryset.filter(**{field: query})
+            queryset = self.get_filter_queryset(field, self.queryset)
+            filtered = self.filtering_options[field].filter_queryset(
+                queryset, field, self.request.GET)
+            if filtered is not queryset:
+                if queryset is not self.queryset:
+                    # The column was annotated to be filtered.
+                    self.annotated_columns.append(getattr(self, field))
+                self.queryset = filtered
+
+    def handle_since(self):
+        """
+        Restricts the export of a grid with a Meta.modified_field to the
+        rows modified since the 'since' parameter, or else since the
+        watermark stored for the 'consumer' parameter. Sets the watermark
+        of the export: the latest modification of its rows, or the since
+        value when none changed.
+        """
+        if not self.modified_field:
+            return
+        since = self.request.GET.get('since', None)
+        consumer = self.request.GET.get('consumer', None)
+        if consumer:
+            # The key of the filtered data the consumer follows.
+            self.watermark_key = self.get_cache_key('watermark', consumer)
+            if not since and self.watermark_key is not None:
+                since = cache.get(self.watermark_key)
+        if since:
+            try:
+                since = parse_watermark(since)
+            except ValueError:
+                raise Http404
+            # The rows modified at the watermark are exported again, as
+            # rows modified at the same time may have been committed since.
+            self.queryset = self.queryset.filter(
+                **{'%s__gte' % self.modified_field: since})
+        watermark = self.queryset.aggregate(
+            watermark=Max(self.modified_field))['watermark']
+        if watermark is None:
+            watermark = since
+        if watermark is not None:
+            self.watermark = format_watermark(watermark)
+
+    def get_filter_queryset(self, field, queryset=None):
+        """
+        Returns the queryset a field is filtered on, by default the one
+        before the filters are applied. Computed columns have to be
+        annotated before they can be filtered.
+        """
+        if queryset is None:
+            queryset = self.unfiltered_queryset
+        column = getattr(self, field, None)
+        if isinstance(column, ComputedColumn):
+            queryset = self.annotate_queryset(queryset, [column])
+        return queryset
 
 
 
@@ -679,6 +1820,11 @@ class DataGrid(object):
         """
         self.handle_search()
         self.handle_filter()
+        cache_key = self.get_listview_cache_key()
+        if cache_key is not None:
+            html = cache.get(cache_key)
+            if html is not None:
+                return mark_safe(html)
         self.load_state()
         context = {
             'datagrid': self,
@@ -706,8 +1852,81 @@ class DataGrid(object):
 
         context.update(self.extra_context)
 
-        return mark_safe(render_to_string(self.listview_template,
-            RequestContext(self.request, context)))
+        html = render_to_string(self.listview_template,
+                                RequestContext(self.request, context))
+        if cache_key is not None:
+            cache.set(cache_key, html, self.cache_timeout)
+        return mark_safe(html)
+
+    def get_cache_models(self):
+        """
+        Returns the models whose data the list view shows: the model of the
+        grid and the models the active columns, their links, aggregates,
+        filters and search fields reach through relations.
+        """
+        model = self.queryset.model
+        models = [model]
+        paths = [path.replace('.', '__')
+                 for path in self.get_related_paths()]
+        for column in self.columns:
+            lookup = getattr(getattr(column, 'expression', None), 'lookup',
+                             None)
+            if lookup:
+                paths.append(lookup)
+            if isinstance(column, ForeignKeyLabelColumn):
+                models.append(column.get_related_model())
+        paths += list(self.filter_fields)
+        paths += [field.lstrip('^=@') for field in self.search_fields]
+        for path in paths:
+            related = model
+            for name in path.split('__'):
+                related = get_relation(related, name)[0]
+                if related is None:
+                    break
+                models.append(related)
+        return sorted(set(models), key=lambda model: model._meta.db_table)
+
+    def get_cache_versions(self):
+        """
+        Returns the versions of the models of get_cache_models(), changed
+        by any save or delete of their objects.
+        """
+        versions = []
+        for model in self.get_cache_models():
+            track_model(model)
+            versions.append(get_model_version(model))
+        return versions
+
+    def get_listview_cache_key(self):
+        """
+        Returns the key of the list view rendered for the request in the
+        cache, or None when the grid doesn't cache it (Meta.cache) or its
+        data can't be identified across requests.
+
+        The key holds the query of the grid (with its filters and search),
+        the parameters of the request, the state of the grid the user sees
+        and the versions of the models it shows, changed by any save or
+        delete of their objects.
+        """
+        if not self.cache_timeout or \
+           not isinstance(self.queryset, DjangoQuerySetAdapter):
+            return None
+        self.load_state(precompute=False)
+        parts = [
+            self.query.encode(exclude=('gridonly', 'datagrid-id')),
+            ','.join([column.id for column in self.columns]),
+            ','.join(self.sort_list),
+            self.paginate_by,
+            self.group_by,
+            self.id,
+            get_language(),
+        ]
+        if self.cache_per_user:
+            parts.append(self.request.user.pk)
+        parts += self.get_cache_versions()
+        return self.get_cache_key('listview', hashlib.md5(
+            smart_str(u'|'.join([force_unicode(part) for part in parts]))
+        ).hexdigest())
 
     @cache_control(no_cache=True, no_store=True, max_age=0,
                    must_revalidate=True)
@@ -718,13 +1937,90 @@ class DataGrid(object):
         """
         return HttpResponse(unicode(self.render_listview()))
 
+    def render_autocomplete_to_response(self):
+        """
+        Renders the values of an autocompleted filter field starting with
+        the 'term' parameter as a JSON list.
+        """
+        field = self.request.GET.get('autocomplete')
+        options = self.filtering_options.get(field)
+        if options is None or not options.autocomplete:
+            raise Http404
+        versions = []
+        if isinstance(self.queryset, DjangoQuerySetAdapter):
+            versions = self.get_cache_versions()
+        key = self.get_cache_key('autocomplete', field, *versions)
+        values = autocomplete(self.queryset, field,
+                              self.request.GET.get('term', ''), key=key,
+                              limit=options.autocomplete_limit,
+                              timeout=options.autocomplete_timeout)
+        return HttpResponse(simplejson.dumps(values),
+                            mimetype='application/json')
+
+    def get_cache_key(self, *parts):
+        """
+        Returns a cache key for data computed from the queryset of this
+        grid, or None if the queryset can't be identified across requests.
+        """
+        query_key = self.queryset.cache_key()
+        if query_key is None:
+            return None
+        return ':'.join(['datagrid', self.__class__.__module__,
+                         self.__class__.__name__, query_key] +
+                        [str(part) for part in parts])
+
+    def get_export_format(self):
+        """
+        Returns the export format requested by the 'export' parameter (or
+        'is_csv' and 'is_pdf'), or None.
+        """
+        export_format = self.request.GET.get('export', None)
+        if export_format in EXPORT_FORMATS:
+            return export_format
+        if self.request.GET.get('is_csv', None):
+            return 'csv'
+        if self.request.GET.get('is_pdf', None):
+            return 'pdf'
+        return None
+
+    def render_export_to_response(self, export_format):
+        """
+        Exports all the rows of the filtered and sorted grid, not only the
+        current page. The formats in Meta.background_exports are written by
+        background jobs and served from disk, the others are streamed.
+        """
+        if export_format in self.background_exports:
+            return export_to_response(self, export_format)
+        content_type, extension = EXPORT_FORMATS[export_format][:2]
+        return streaming_response(iter_export(self, export_format),
+                                  content_type, 'data.%s' % extension)
+
     def render_to_response(self, template_name, extra_context={}):
         """
         Renders a template containing this datagrid as a context variable.
         """
+        # Autocomplete lookups are answered from the unfiltered queryset.
+        if self.request.GET.get('autocomplete', None):
+            return self.render_autocomplete_to_response()
+
         self.handle_search()
         self.handle_filter()
-        self.load_state()
+        export_format = self.get_export_format()
+        if export_format:
+            self.handle_since()
+            self.load_state(precompute=False)
+            response = self.render_export_to_response(export_format)
+            if self.watermark is not None and \
+               response.status_code in (200, 206):
+                response['X-Datagrid-Watermark'] = self.watermark
+                if self.watermark_key is not None and \
+                   response.status_code == 200:
+                    # A consumer whose download fails gets the rows again.
+                    call_when_sent(response, lambda: cache.set(
+                        self.watermark_key, self.watermark, VERSION_TIMEOUT))
+            return response
+        # A cached list view is rendered without fetching the page.
+        self.load_state(precompute=not self.cache_timeout)
 
 
         # If the caller is requesting just this particular grid, return it.
@@ -737,21 +2033,6 @@ class DataGrid(object):
         }
         context.update(extra_context)
         context.update(self.extra_context)
-        if self.request.GET.get('is_pdf', None):
-            import ho.pisa as pisa
-            file_data = render_to_string('datagrid/as_pdf.pdf', context)
-            myfile = StringIO.StringIO()
-            pisa.CreatePDF(file_data, myfile)
-            myfile.seek(0)
-            response =  HttpResponse(myfile, mimetype='application/pdf')
-            response['Content-Disposition'] = 'attachment; filename=data.pdf'
-            return response
-        elif self.request.GET.get('is_csv', None):
-            file_data = render_to_string('datagrid/as_csv.csv', context)
-            response =  HttpResponse(file_data, mimetype='text.csv')
-            response['Content-Disposition'] = 'attachment; filename=data.csv'
-            return response
-
 
         return render_to_response(template_name, RequestContext(self.request,
                                                                 context))
@@ -766,8 +2047,240 @@ class DataGrid(object):
 
 
 class FilterOptions(object):
-    def __init__(self, title, values, inverse=False):
+    """
+    Options of a filterable field, given in the 'filtering_options' of the
+    grid Meta.
+
+    With autocomplete=True the form renders a text input completed from
+    the distinct values of the field instead of a <select> of 'values'.
+    """
+    kind = "select"
+
+    def __init__(self, title, values=(), inverse=False, autocomplete=False,
+                 autocomplete_limit=20, autocomplete_timeout=300):
         self.title = title
         self.inverse = inverse
         self.values = values
+        self.autocomplete = autocomplete
+        self.autocomplete_limit = autocomplete_limit
+        self.autocomplete_timeout = autocomplete_timeout
+        self.selected = None
+
+    def filter_queryset(self, queryset, field, data):
+        """
+        Returns the queryset filtered by the value of the field in data,
+        the GET parameters of the request.
+        """
+        query = data.get(field, None)
+        if not query:
+            return queryset
+        if query.startswith("!") and self.inverse:
+            return queryset.exclude(**{field: query[1:]})
+        return queryset.filter(**{field: query})
+
+    def load_selected(self, datagrid, field):
+        """
+        Loads the currently selected value of the field for the filter form.
+        """
         self.selected = None
+        val = datagrid.request.GET.get(field, None)
+        if val is not None:
+            try:
+                self.selected = int(val)
+            except ValueError:
+                self.selected = val
+
+
+class RangeFilterOptions(FilterOptions):
+    """
+    Filters a field between the values of the '<field>__gte' and
+    '<field>__lte' parameters, either of which may be left empty.
+
+    The bounds compile to plain comparisons on the field (WHERE field >= x
+    on Django, {field: {$gte: x}} on mongo), which can use an index on the
+    field. coerce converts the parameters to the type of the field, which
+    is needed for adapters that don't do it themselves.
+    """
+    kind = "range"
+
+    def __init__(self, title, coerce=None):
+        FilterOptions.__init__(self, title)
+        self.coerce = coerce
+        self.lower = ""
+        self.upper = ""
+
+    def get_bound(self, data, param):
+        value = data.get(param, None)
+        if not value:
+            return None
+        if self.coerce:
+            try:
+                return self.coerce(value)
+            except ValueError:
+                return None
+        return value
+
+    def get_lookups(self, field, data):
+        """
+        Returns the lookups selecting the rows in the requested range.
+        """
+        lookups = {}
+        for lookup in ('%s__gte' % field, '%s__lte' % field):
+            value = self.get_bound(data, lookup)
+            if value is not None:
+                lookups[lookup] = value
+        return lookups
+
+    def filter_queryset(self, queryset, field, data):
+        lookups = self.get_lookups(field, data)
+        if not lookups:
+            return queryset
+        return queryset.filter(**lookups)
+
+    def load_selected(self, datagrid, field):
+        data = datagrid.request.GET
+        self.lower = data.get('%s__gte' % field, "")
+        self.upper = data.get('%s__lte' % field, "")
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def parse_watermark(value):
+    """
+    Returns the value of a watermark, a number such as a version counter or
+    an ISO 8601 date and time, aware when it has a UTC offset.
+    >>> parse_watermark('42'), parse_watermark('2012-03-04T05:06:07.000008')
+    (42, datetime.datetime(2012, 3, 4, 5, 6, 7, 8))
+    >>> parse_watermark('2012-03-04T05:06:07+01:00').utcoffset()
+    datetime.timedelta(0, 3600)
+    """
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    value = value.replace(' ', 'T')
+    tzinfo = None
+    match = re.search(r'(Z|([+-])(\d\d):?(\d\d))$', value)
+    if match is not None:
+        value = value[:match.start()]
+        if match.group(2):
+            offset = int(match.group(3)) * 60 + int(match.group(4))
+            if match.group(2) == '-':
+                offset = -offset
+        else:
+            offset = 0
+        tzinfo = FixedOffset(offset)
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format).replace(
+                tzinfo=tzinfo)
+        except ValueError:
+            pass
+    raise ValueError("Invalid watermark: %r" % value)
+
+
+def get_keyset_filter(keyset, values, inclusive=False):
+    """
+    Returns the Q object selecting the rows sorted after the row with the
+    values of the keyset's (lookup, descending) pairs, and that row too if
+    inclusive.
+    """
+    after = []
+    equal = {}
+    for (lookup, descending), value in zip(keyset, values):
+        comparison = descending and '__lt' or '__gt'
+        after.append(Q(**dict(equal, **{lookup + comparison: value})))
+        equal[lookup] = value
+    if inclusive:
+        after.append(Q(**equal))
+    return reduce(operator.or_, after)
+
+
+def format_watermark(value):
+    """
+    Returns the text of a watermark, read back by parse_watermark().
+    >>> format_watermark(datetime.datetime(2012, 3, 4, 5, 6, 7,
+    ...                                    tzinfo=FixedOffset(-90)))
+    '2012-03-04T05:06:07-01:30'
+    """
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+DATE_WINDOWS = (
+    ('1d', ugettext_lazy("Today"), 1),
+    ('7d', ugettext_lazy("Last 7 days"), 7),
+    ('30d', ugettext_lazy("Last 30 days"), 30),
+    ('365d', ugettext_lazy("Last year"), 365),
+)
+
+
+class DateRangeFilterOptions(RangeFilterOptions):
+    """
+    Filters a date or datetime field by a relative window, such as the
+    last 7 days given as '<field>=7d', or between the dates (YYYY-MM-DD) of
+    the '<field>__gte' and '<field>__lte' parameters, both included.
+
+    windows is a list of (key, label, days) for the relative windows.
+    They start at midnight, so the number of rows in each window, shown by
+    the filter form, is cached for the day, or bucket_timeout seconds.
+    """
+    kind = "date_range"
+
+    def __init__(self, title, windows=DATE_WINDOWS, bucket_counts=True,
+                 bucket_timeout=300):
+        RangeFilterOptions.__init__(self, title, coerce=parse_date)
+        self.windows = windows
+        self.bucket_counts = bucket_counts
+        self.bucket_timeout = bucket_timeout
+        self.buckets = []
+
+    def get_window_start(self, days, today=None):
+        today = today or datetime.date.today()
+        return datetime.datetime.combine(
+            today - datetime.timedelta(days=days - 1), datetime.time.min)
+
+    def get_lookups(self, field, data):
+        for key, label, days in self.windows:
+            if data.get(field, None) == key:
+                return {'%s__gte' % field: self.get_window_start(days)}
+        lookups = {}
+        lower = self.get_bound(data, '%s__gte' % field)
+        if lower is not None:
+            lookups['%s__gte' % field] = lower
+        upper = self.get_bound(data, '%s__lte' % field)
+        if upper is not None:
+            # Compare with the start of the next day, so datetimes of the
+            # last day are included.
+            lookups['%s__lt' % field] = upper + datetime.timedelta(days=1)
+        return lookups
+
+    def get_bucket_counts(self, datagrid, field):
+        """
+        Returns the number of rows in each window, counted over the grid
+        queryset before the filters are applied.
+        """
+        today = datetime.date.today()
+        key = datagrid.get_cache_key('buckets', field, today.isoformat())
+        counts = key and cache.get(key)
+        if counts is None:
+            queryset = datagrid.get_filter_queryset(field)
+            counts = [queryset.filter(**{
+                '%s__gte' % field: self.get_window_start(window[2], today)
+            }).count() for window in self.windows]
+            if key:
+                cache.set(key, counts, self.bucket_timeout)
+        return counts
+
+    def load_selected(self, datagrid, field):
+        RangeFilterOptions.load_selected(self, datagrid, field)
+        self.selected = datagrid.request.GET.get(field, None)
+        if self.bucket_counts:
+            counts = self.get_bucket_counts(datagrid, field)
+        else:
+            counts = [""] * len(self.windows)
+        self.buckets = [(key, label, count) for (key, label, days), count
+                        in zip(self.windows, counts)]
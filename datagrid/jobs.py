@@ -0,0 +1,363 @@
+"""Exports run as background jobs by a bounded pool of local worker
+processes, for the formats too slow to build in the request, such as PDF.
+
+Each export is written once to a file named after a fingerprint of the
+grid, its filters, sort, columns and the version of its data, and served
+from that file (with HTTP Range support) until the data changes. The
+requests for an export being written share its job, even across the
+processes of the server, and are told to retry shortly."""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import Queue
+import re
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.translation import get_language, ugettext as _
+
+from .exports import EXPORT_FORMATS, streaming_response
+from .parallel import close_connections, reset_connections, write_export
+
+try:
+    from django.http import FileResponse
+except ImportError:
+    # Before Django 1.8 files are streamed like the other exports.
+    FileResponse = None
+
+
+def get_export_dir():
+    return getattr(settings, 'DATAGRID_EXPORT_DIR',
+                   os.path.join(tempfile.gettempdir(), 'datagrid-exports'))
+
+
+def get_export_workers():
+    """Returns the number of worker processes, 0 to export in the request."""
+    return getattr(settings, 'DATAGRID_EXPORT_WORKERS', 2)
+
+
+EXPORT_RETRY_AFTER = getattr(settings, 'DATAGRID_EXPORT_RETRY_AFTER', 5)
+# Seconds after which a job that didn't finish is considered dead, and
+# the exports kept on disk.
+EXPORT_JOB_TIMEOUT = getattr(settings, 'DATAGRID_EXPORT_JOB_TIMEOUT', 3600)
+EXPORT_MAX_AGE = getattr(settings, 'DATAGRID_EXPORT_MAX_AGE', 60 * 60 * 24)
+
+
+def get_fingerprint(datagrid, format):
+    """
+    Returns the fingerprint of the export of the grid in format, or None if
+    its data can't be identified across requests. It changes with the
+    versions of all the models the export shows, including those reached
+    through relations, the language and, for the grids cached per user
+    (Meta.cache_per_user), the user.
+    """
+    if datagrid.get_data_version() is None:
+        return None
+    parts = ['export', format,
+             ",".join([column.id for column in datagrid.columns]),
+             ",".join(datagrid.sort_list),
+             ",".join([str(version)
+                       for version in datagrid.get_cache_versions()]),
+             get_language()]
+    if datagrid.cache_per_user:
+        parts.append(datagrid.request.user.pk)
+    key = datagrid.get_cache_key(*parts)
+    if key is None:
+        return None
+    return hashlib.md5(key).hexdigest()
+
+
+class ExportJob(object):
+    """
+    The export of a grid in a format to path. The lock file next to it
+    marks the job as running for all the processes sharing the directory,
+    and the .failed file its failure.
+    """
+    def __init__(self, datagrid, format, path):
+        self.datagrid = datagrid
+        self.format = format
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.failed_path = path + '.failed'
+
+    def acquire(self):
+        """Returns whether the job was free to start."""
+        try:
+            os.close(os.open(self.lock_path,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except OSError:
+            try:
+                stale = time.time() - os.path.getmtime(self.lock_path) > \
+                    EXPORT_JOB_TIMEOUT
+            except OSError:
+                # Just released.
+                return not os.path.exists(self.path) and self.acquire()
+            if stale:
+                self.release()
+                return self.acquire()
+            return False
+
+    def release(self):
+        try:
+            os.remove(self.lock_path)
+        except OSError:
+            pass
+
+    def write(self):
+        """Writes the export to a temporary file renamed to path once
+        complete, so a partial export is never served."""
+        partial_path = '%s.%d.part' % (self.path, os.getpid())
+        try:
+            output = open(partial_path, 'wb')
+            try:
+                write_export(self.datagrid, self.format, output)
+            finally:
+                output.close()
+            os.rename(partial_path, self.path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+
+    def run_in_process(self):
+        """Entry point of the worker process, forked with the grid."""
+        reset_connections()
+        self.write()
+
+    def run(self):
+        """Writes the export in a worker process, waiting for it."""
+        try:
+            # The process is forked from the thread running the job, whose
+            # connections would be shared with it.
+            close_connections()
+            process = multiprocessing.Process(target=self.run_in_process)
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                # Marks the failure for the requests waiting for the export,
+                # which would otherwise start the job again and again.
+                logging.error("Export to %s failed with exit code %s",
+                              self.path, process.exitcode)
+                open(self.failed_path, 'w').close()
+        finally:
+            self.release()
+            clean_export_dir()
+
+
+class ExportPool(object):
+    """
+    A queue of export jobs, run by at most size worker threads each
+    waiting for the process of its current job. Threads are started on the
+    first jobs.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.queue = Queue.Queue()
+        self.jobs = {}
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, job):
+        """
+        Queues the job, unless the same export is already queued or
+        running in this or another process.
+        """
+        self.lock.acquire()
+        try:
+            if job.path in self.jobs or not job.acquire():
+                return
+            self.jobs[job.path] = job
+            if len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+        self.queue.put(job)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                job.run()
+            finally:
+                self.lock.acquire()
+                try:
+                    del self.jobs[job.path]
+                finally:
+                    self.lock.release()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    _pool_lock.acquire()
+    try:
+        if _pool is None:
+            _pool = ExportPool(get_export_workers())
+        return _pool
+    finally:
+        _pool_lock.release()
+
+
+def clean_export_dir(max_age=EXPORT_MAX_AGE):
+    """Removes the exports older than max_age seconds."""
+    directory = get_export_dir()
+    now = time.time()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if now - os.path.getmtime(path) > max(max_age, EXPORT_JOB_TIMEOUT):
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def parse_range(header, size):
+    """
+    Returns the (start, end) bytes, both included, of a Range header for a
+    file of size bytes, None when the whole file should be served and False
+    when the range can't be satisfied. Multiple ranges aren't supported and
+    are served as the whole file.
+    >>> parse_range('bytes=10-19', 100), parse_range('bytes=90-', 100)
+    ((10, 19), (90, 99))
+    >>> parse_range('bytes=-10', 100), parse_range('bytes=0-5,10-15', 100)
+    ((90, 99), None)
+    >>> parse_range('bytes=100-', 100)
+    False
+    """
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header or '')
+    if match is None:
+        return None
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start = int(start)
+        end = min(int(end or size - 1), size - 1)
+    if start > end or start >= size:
+        return False
+    return start, end
+
+
+def iter_file(file, length, chunk_size=64 * 1024):
+    """Streams length bytes of the file from its position."""
+    try:
+        while length > 0:
+            data = file.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        file.close()
+
+
+def file_response(request, file, content_type, filename):
+    """
+    Returns a response serving the file, or the part of it requested by the
+    Range header.
+    """
+    size = os.fstat(file.fileno()).st_size
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if byte_range is False:
+        file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+    if byte_range is None:
+        if FileResponse is not None:
+            # Sent by the server with wsgi.file_wrapper when it can.
+            response = FileResponse(file, content_type=content_type)
+            response['Content-Disposition'] = \
+                'attachment; filename=%s' % filename
+        else:
+            response = streaming_response(iter_file(file, size),
+                                          content_type, filename)
+        response['Content-Length'] = str(size)
+    else:
+        start, end = byte_range
+        file.seek(start)
+        response = streaming_response(iter_file(file, end - start + 1),
+                                      content_type, filename)
+        response.status_code = 206
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def failed_response():
+    """Returns the response telling the export failed."""
+    return HttpResponse(_("The export failed."), status=500)
+
+
+def pending_response():
+    """Returns the response asking to retry while the export is written."""
+    response = HttpResponse(_("The export is being prepared, it will be "
+                              "downloaded in a few seconds."), status=202)
+    response['Retry-After'] = str(EXPORT_RETRY_AFTER)
+    response['Refresh'] = str(EXPORT_RETRY_AFTER)
+    return response
+
+
+def export_to_response(datagrid, format):
+    """
+    Returns the response serving the export of the grid in format, from the
+    file written by its job. The job is started by the first request and
+    the requests until it's done get a 202 response asking to retry.
+
+    Exports whose data can't be identified across requests, and all the
+    exports when DATAGRID_EXPORT_WORKERS is 0, are written in the request.
+    When the job fails, the next request gets an error response, and the
+    one after starts the job again.
+    """
+    content_type, extension = EXPORT_FORMATS[format][:2]
+    filename = 'data.%s' % extension
+    fingerprint = get_fingerprint(datagrid, format)
+    if fingerprint is None:
+        output = tempfile.TemporaryFile()
+        write_export(datagrid, format, output)
+        output.seek(0)
+        return file_response(datagrid.request, output, content_type,
+                             filename)
+
+    directory = get_export_dir()
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by another request.
+            pass
+    path = os.path.join(directory, '%s.%s' % (fingerprint, extension))
+    if not os.path.exists(path):
+        job = ExportJob(datagrid, format, path)
+        try:
+            os.remove(job.failed_path)
+            return failed_response()
+        except OSError:
+            pass
+        if get_export_workers() == 0:
+            if job.acquire():
+                try:
+                    job.write()
+                finally:
+                    job.release()
+        else:
+            get_pool().submit(job)
+    try:
+        output = open(path, 'rb')
+    except IOError:
+        return pending_response()
+    return file_response(datagrid.request, output, content_type, filename)
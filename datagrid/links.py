@@ -0,0 +1,119 @@
+"""Links of the cells of a grid built from a named URL pattern, resolved once
+and filled in for each row by string formatting instead of a reverse() per
+row.
+
+The patterns are looked up in the internals of Django's resolver. When they
+aren't available, or don't give a url for the arguments of a row, the url
+is built by reverse() like a link_func would."""
+
+import re
+from operator import attrgetter
+
+from django.core.urlresolvers import (NoReverseMatch, get_callable,
+                                      get_resolver, get_script_prefix,
+                                      get_urlconf, reverse)
+from django.utils.encoding import force_unicode, iri_to_uri
+
+
+class URLTemplate(object):
+    """
+    The URL pattern named viewname, with the arguments read from the
+    attribute paths args of each object, or with keyword arguments read
+    from the paths given by a dictionary of args.
+
+    The pattern is looked up once, when the template is created. Filling it
+    in for an object formats the strings reverse() would try, and checks
+    them with the regular expressions of the pattern compiled once, falling
+    back to reverse() itself.
+    """
+    def __init__(self, viewname, args=(), urlconf=None):
+        if isinstance(args, dict):
+            self.names = sorted(args)
+            self.paths = [args[name] for name in self.names]
+        else:
+            self.names = None
+            self.paths = list(args)
+        self.getters = [attrgetter(path) for path in self.paths]
+        self.viewname = viewname
+        self.urlconf = urlconf
+        try:
+            self.prefix, self.candidates = self.resolve(viewname, urlconf)
+        except (AttributeError, NoReverseMatch):
+            # Resolver internals of another Django version, or patterns
+            # reverse() may still handle.
+            self.prefix, self.candidates = get_script_prefix(), []
+
+    def resolve(self, viewname, urlconf=None):
+        """
+        Returns the prefix of the urls and the (format, parameters, regex)
+        of the patterns of viewname taking the arguments, like reverse().
+        """
+        resolver = get_resolver(urlconf or get_urlconf())
+        prefix = get_script_prefix()
+        view = viewname
+        if isinstance(viewname, basestring):
+            parts = viewname.split(':')
+            view = parts.pop()
+            for namespace in parts:
+                app_list = resolver.app_dict.get(namespace)
+                if app_list and namespace not in app_list:
+                    namespace = app_list[0]
+                try:
+                    extra, resolver = resolver.namespace_dict[namespace]
+                except KeyError:
+                    raise NoReverseMatch("%s is not a registered namespace"
+                                         % namespace)
+                prefix += extra
+        try:
+            view = get_callable(view, True)
+        except (ImportError, AttributeError), e:
+            raise NoReverseMatch("Error importing '%s': %s." % (view, e))
+
+        candidates = []
+        for possibility in resolver.reverse_dict.getlist(view):
+            bits, pattern = possibility[0], possibility[1]
+            regex = re.compile(u'^%s' % pattern, re.UNICODE)
+            for result, params in bits:
+                if self.names is None:
+                    if len(params) != len(self.paths):
+                        continue
+                elif set(params) != set(self.names):
+                    continue
+                candidates.append((result, params, regex))
+        if not candidates:
+            raise NoReverseMatch("Reverse for '%s' with arguments '%s' not "
+                                 "found." % (viewname, self.paths))
+        return prefix, candidates
+
+    def url(self, obj):
+        """
+        Returns the url of obj, or "" when one of its arguments is None.
+        """
+        values = []
+        for getter in self.getters:
+            value = getter(obj)
+            if value is None:
+                return ""
+            values.append(force_unicode(value))
+        if self.names is not None:
+            arguments = dict(zip(self.names, values))
+        for result, params, regex in self.candidates:
+            if self.names is None:
+                arguments = dict(zip(params, values))
+            candidate = result % arguments
+            if regex.search(candidate):
+                return iri_to_uri(u'%s%s' % (self.prefix, candidate))
+        if self.names is not None:
+            return reverse(self.viewname, self.urlconf, kwargs=arguments)
+        return reverse(self.viewname, self.urlconf, args=values)
+
+    def urls(self, objects):
+        """Returns the urls of the objects, "" for the objects missing an
+        attribute or whose url can't be reversed."""
+        urls = []
+        for obj in objects:
+            try:
+                urls.append(self.url(obj))
+            except (AttributeError, NoReverseMatch):
+                urls.append("")
+        return urls
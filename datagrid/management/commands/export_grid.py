@@ -0,0 +1,84 @@
+import sys
+from optparse import make_option
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.http import Http404, HttpRequest, QueryDict
+from django.utils.importlib import import_module
+
+from datagrid.exports import EXPORT_FORMATS
+from datagrid.grids import DataGrid
+from datagrid.parallel import write_export
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', default='csv', dest='format',
+            help='Export format: %s. Defaults to csv.' %
+                 ', '.join(sorted(EXPORT_FORMATS))),
+        make_option('--processes', default=None, dest='processes',
+            type='int', help='Number of processes writing the export. '
+                'Defaults to the DATAGRID_EXPORT_PROCESSES setting.'),
+        make_option('--params', default='', dest='params',
+            help='Query string of the grid request, such as '
+                 '"sort=-created_on&columns=title,created_on".'),
+        make_option('--user', default=None, dest='user',
+            help='Username of the user the grid is built for.'),
+    )
+    help = ("Exports all the rows of a grid to a file, with the same engine "
+            "as the exports served by the grid. The grid is built by the "
+            "factory, a dotted path to a callable taking a request and "
+            "returning the grid, such as a DataGrid subclass.")
+    args = '<grid factory> <output file or ->'
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Give the grid factory and the output file.')
+        factory_path, output_path = args
+        export_format = options.get('format', 'csv')
+        if export_format not in EXPORT_FORMATS:
+            raise CommandError('Unknown export format "%s".' % export_format)
+
+        try:
+            module_name, name = factory_path.rsplit('.', 1)
+            factory = getattr(import_module(module_name), name)
+        except (ValueError, ImportError, AttributeError), e:
+            raise CommandError('Cannot import the grid factory "%s": %s' %
+                               (factory_path, e))
+
+        request = HttpRequest()
+        request.GET = QueryDict(options.get('params', ''))
+        if options.get('user'):
+            try:
+                request.user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError('Unknown user "%s".' % options['user'])
+        else:
+            request.user = AnonymousUser()
+
+        datagrid = factory(request)
+        if not isinstance(datagrid, DataGrid):
+            raise CommandError('"%s" did not return a DataGrid.' %
+                               factory_path)
+        datagrid.handle_search()
+        datagrid.handle_filter()
+        try:
+            datagrid.handle_since()
+        except Http404:
+            raise CommandError('Invalid since watermark "%s".' %
+                               request.GET.get('since'))
+        datagrid.load_state(precompute=False)
+
+        if output_path == '-':
+            output = sys.stdout
+        else:
+            output = open(output_path, 'wb')
+        try:
+            write_export(datagrid, export_format, output,
+                         options.get('processes'))
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        if datagrid.watermark is not None:
+            # For the next delta export, given as since in --params.
+            sys.stderr.write('Watermark: %s\n' % datagrid.watermark)
@@ -1,9 +1,98 @@
 import copy
+import re
 import pymongo
 import pymongo.cursor
 import logging
 
-from adapters import QuerySetAdapter, ManagerAdapter
+from adapters import QuerySetAdapter, ManagerAdapter, _coerce, split_lookup
+from records import dict_record
+
+
+MONGO_OPERATORS = {
+    'gt': '$gt',
+    'gte': '$gte',
+    'lt': '$lt',
+    'lte': '$lte',
+    'ne': '$ne',
+    'in': '$in',
+}
+
+MONGO_ACCUMULATORS = {
+    'Sum': '$sum',
+    'Avg': '$avg',
+    'Min': '$min',
+    'Max': '$max',
+}
+
+
+# The operators whose values are converted to the type of the field.
+COERCED_OPERATORS = ('exact', 'gt', 'gte', 'lt', 'lte', 'ne', 'in')
+
+
+def lookups_to_spec(lookups, coerce=None):
+    """Translates Django style lookups to a mongo query document. Range
+    lookups become plain comparison operators, which can use an index on
+    the field.
+    >>> spec = lookups_to_spec({'created_on__gte': 1, 'created_on__lt': 5})
+    >>> sorted(spec['created_on'].items())
+    [('$gte', 1), ('$lt', 5)]
+
+    The lookups of a field are merged in one document, where an exact value
+    is matched with $in. coerce(field, value) converts the compared values.
+    >>> spec = lookups_to_spec({'id': '3', 'id__lt': '5'},
+    ...                        coerce=lambda field, value: int(value))
+    >>> sorted(spec['id'].items())
+    [('$in', [3]), ('$lt', 5)]
+    """
+    conditions = {}
+    for lookup, value in sorted(lookups.items()):
+        field, lookup_operator = split_lookup(lookup)
+        field = field.replace('__', '.')
+        if coerce is not None and lookup_operator in COERCED_OPERATORS:
+            if lookup_operator == 'in':
+                value = [coerce(field, item) for item in value]
+            else:
+                value = coerce(field, value)
+        if lookup_operator == 'exact':
+            condition = {'$in': [value]}
+        elif lookup_operator in MONGO_OPERATORS:
+            condition = {MONGO_OPERATORS[lookup_operator]: value}
+        else:
+            pattern = re.escape(value)
+            if lookup_operator.endswith('startswith'):
+                pattern = '^' + pattern
+            if lookup_operator == 'iexact':
+                pattern = '^%s$' % pattern
+            options = lookup_operator.startswith('i') and 'i' or ''
+            condition = {'$regex': pattern, '$options': options}
+        conditions.setdefault(field, []).append((lookup_operator, condition))
+
+    spec = {}
+    clashes = []
+    for field, field_conditions in conditions.items():
+        if len(field_conditions) == 1 and field_conditions[0][0] == 'exact':
+            spec[field] = field_conditions[0][1]['$in'][0]
+            continue
+        merged = {}
+        for lookup_operator, condition in field_conditions:
+            if set(condition) & set(merged):
+                # The same operator twice, such as exact and in.
+                clashes.append({field: condition})
+            else:
+                merged.update(condition)
+        spec[field] = merged
+    if clashes:
+        spec['$and'] = clashes
+    return spec
+
+
+def get_document_value(document, field):
+    """Returns the value of a dotted field of a document, or None."""
+    for name in field.split('.'):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(name)
+    return document
 
 
 class MongoQuerySetAdapter(QuerySetAdapter):
@@ -15,32 +104,146 @@ class MongoQuerySetAdapter(QuerySetAdapter):
         self.model.objects = self
         self.pk = pk
         self.mongo_cursor = mongo_cursor
+        self.samples = {}
 
     def __getitem__(self, items):
         if isinstance(items,int):
-            i = self.mongo_cursor[items]
-            return Struct(self.pk, **i)
+            return self._record(self.mongo_cursor[items])
         self.mongo_cursor = self.mongo_cursor.__getitem__(items)
         return self
 
     def distinct(self, true_or_false=True):
         return self
 
-    def filter_pk(self, ids_list):
-        pk = self.pk
-        code = "%s.indexOf[this.%s] != -1 " % (ids_list, pk)
-        mongo_cursor = self.mongo_cursor.where(code)
-        print code
-        a = [Struct(self.pk, **i) for i in mongo_cursor]
-        return a
+    def _record(self, document):
+        """Returns a record of the document, whose pk is also read as id."""
+        return dict_record(document, (('id', self.pk),))
+
+    def _spec(self):
+        return getattr(self.mongo_cursor, '_Cursor__spec', None) or {}
+
+    def _projection(self, fields):
+        if fields is None:
+            return None
+        return dict.fromkeys(list(fields) + [self.pk], 1)
+
+    def filter_pk(self, ids_list, fields=None):
+        mongo_cursor = self.mongo_cursor.collection.find(
+            {self.pk: {'$in': list(ids_list)}},
+            fields=self._projection(fields))
+        return [self._record(i) for i in mongo_cursor]
+
+    def only(self, *fields):
+        """Fetches only the given fields of the documents."""
+        mongo_cursor = self.mongo_cursor.clone()
+        mongo_cursor._Cursor__fields = self._projection(fields)
+        return MongoQuerySetAdapter(mongo_cursor, self.pk)
+
+    def iterate(self, fields=None):
+        """Streams (pk, row) pairs, with only the given fields of the
+        documents when fields are given."""
+        cursor = self.mongo_cursor.collection.find(
+            self._spec(), fields=self._projection(fields))
+        for i in cursor:
+            yield i[self.pk], self._record(i)
+
+    def iterate_chunks(self, chunk_size, fields=None):
+        """Streams the documents in the order of the cursor, in lists of
+        chunk_size fetched from the server in batches of the same size."""
+        mongo_cursor = self.mongo_cursor.clone()
+        mongo_cursor._Cursor__fields = self._projection(fields)
+        mongo_cursor.batch_size(chunk_size)
+        chunk = []
+        for document in mongo_cursor:
+            chunk.append(self._record(document))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
 
     def count(self):
         if isinstance(self.mongo_cursor, list):
             return len(self.mongo_cursor)
         return self.mongo_cursor.count()
 
+    def _find(self, spec):
+        base_spec = self._spec()
+        if base_spec:
+            spec = {'$and': [base_spec, spec]}
+        return MongoQuerySetAdapter(self.mongo_cursor.collection.find(spec),
+                                    self.pk)
+
+    def coerce_value(self, field, value):
+        """Converts a value given as a string (usually from the request) to
+        the type of the field, read from a document holding it, as Django
+        converts it to the type of the model field."""
+        if not isinstance(value, basestring):
+            return value
+        if field not in self.samples:
+            document = self.mongo_cursor.collection.find_one(
+                {field: {'$exists': True, '$ne': None}}, fields=[field])
+            self.samples[field] = get_document_value(document, field)
+        return _coerce(self.samples[field], value)
+
     def filter(self, *args, **kwargs):
-        return self
+        if args:
+            logging.error("""Q objects with MongoQuerySetAdapter
+                not supported""")
+        if not kwargs:
+            return self
+        return self._find(lookups_to_spec(kwargs, self.coerce_value))
+
+    def exclude(self, *args, **kwargs):
+        if args:
+            logging.error("""Q objects with MongoQuerySetAdapter
+                not supported""")
+        if not kwargs:
+            return self
+        return self._find({'$nor': [lookups_to_spec(kwargs,
+                                                    self.coerce_value)]})
+
+    def _group(self, group_id, aggregates, *stages):
+        """Runs a $group stage computing Django aggregates (Sum, Avg, Min,
+        Max, Count) over the documents matched by the cursor."""
+        group = {'_id': group_id}
+        for name, aggregate in aggregates.items():
+            if aggregate.name == 'Count':
+                group[name] = {'$sum': 1}
+            else:
+                field = aggregate.lookup.replace('__', '.')
+                if field == "pk":
+                    field = self.pk
+                group[name] = {MONGO_ACCUMULATORS[aggregate.name]:
+                               '$' + field}
+        pipeline = [{'$group': group}] + list(stages)
+        spec = self._spec()
+        if spec:
+            pipeline.insert(0, {'$match': spec})
+        result = self.mongo_cursor.collection.aggregate(pipeline)
+        if isinstance(result, dict):
+            result = result['result']
+        return list(result)
+
+    def aggregate(self, **aggregates):
+        result = self._group(None, aggregates)
+        if not result:
+            # Nothing matched: counts are 0 and the other aggregates None,
+            # like in Django.
+            return dict([(name, 0 if aggregate.name == 'Count' else None)
+                         for name, aggregate in aggregates.items()])
+        result[0].pop('_id')
+        return result[0]
+
+    def group_by(self, field, descending=False, **aggregates):
+        groups = self._group('$' + field.replace('__', '.'), aggregates,
+                             {'$sort': {'_id': descending and -1 or 1}})
+        for group in groups:
+            group[field] = group.pop('_id')
+        return groups
+
+    def distinct_values(self, field):
+        return copy.copy(self.mongo_cursor).distinct(field)
 
     def values_list(self, *fields, **kwargs):
         if fields:
@@ -80,15 +283,7 @@ class MongoQuerySetAdapter(QuerySetAdapter):
             not supported""")
         return self
 
-class Struct:
-    """Object presentation of dictionaries
-    >>> d = {'a+b': 'c', 'c': 3}
-    >>> s = Struct(**d)
-    >>> getattr(s,'a+b')
-    'c'
-    >>> s.c
-    3
-    """
-    def __init__(self, pk="id", **entries):
-        self.__dict__["id"] = entries[pk]
-        self.__dict__.update(entries)
+    def annotate(self, *args, **kwargs):
+        logging.error("""Aggregate columns with MongoQuerySetAdapter
+            not supported""")
+        return self
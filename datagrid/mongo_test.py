@@ -90,3 +90,10 @@ class MongoDataGridTest(TestCase):
         # Exercise the code paths when rendering
         self.datagrid.render_listview()
 
+
+    def testFilterCoerced(self):
+        """Testing filters from the request match the numeric fields"""
+        self.assertEqual(self.datagrid.queryset.filter(
+            id='5', id__lte='7').count(), 1)
+        self.assertEqual(self.datagrid.queryset.filter(
+            id__gte='3', id__lt='6').count(), 3)
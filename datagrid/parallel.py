@@ -0,0 +1,193 @@
+"""Exports of large grids written in parallel by a pool of processes.
+
+The sorted rows of the grid are split in consecutive partitions, each
+written by a process of the pool with its own database connection, and
+the partitions are concatenated in order. When the sort keys allow it (see
+DataGrid.get_keyset), the parent reads the keys of the first row of each
+partition and a process selects its rows between them, else a partition
+is a range of offsets. A process fetches its rows like a whole export
+does, a chunk at a time. Only the Django querysets of the formats streamed
+by parts (CSV and NDJSON) are exported in parallel, the others are written
+by a single process."""
+
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from .adapters import DjangoQuerySetAdapter
+from .exports import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, PARTITIONED_FORMATS
+
+
+def get_export_processes():
+    """Returns the number of processes writing an export."""
+    return getattr(settings, 'DATAGRID_EXPORT_PROCESSES', 1)
+
+
+# The connections and cache client inherited from the parent process, kept
+# referenced by the process: freeing them would end the sessions of the
+# parent, as the drivers say goodbye on the sockets they share.
+_inherited = []
+
+
+def close_connections():
+    """Closes the database connections of the thread, before it forks a
+    process that would otherwise inherit them."""
+    for connection in connections.all():
+        connection.close()
+
+
+def reset_connections():
+    """
+    Makes the process open its own database connections and cache client
+    rather than use those inherited from the parent process, which still
+    uses them: they are neither closed nor freed.
+
+    In-memory SQLite databases are copied in the process with their
+    connection, which is kept as it's the only way to reach them.
+    """
+    for connection in connections.all():
+        if connection.vendor == 'sqlite' and \
+           connection.settings_dict['NAME'] == ':memory:':
+            continue
+        if connection.connection is not None:
+            _inherited.append(connection.connection)
+            connection.connection = None
+    if getattr(cache, '_client', None) is not None:
+        _inherited.append(cache._client)
+        cache._client = None
+
+
+def get_sorted_rows(datagrid):
+    """
+    Returns the sorted query of the grid, as get_sorted_query() does, and
+    its number of rows. The pks of the grids sorted in Python are listed,
+    as the processes can only share the sort by inheriting it.
+    """
+    query, python_sort, sort_list, extra_names = datagrid.get_sorted_query()
+    if python_sort:
+        query = list(query[:])
+        return (query, python_sort, sort_list, extra_names), len(query)
+    query = query.distinct()
+    return (query, python_sort, sort_list, extra_names), query.count()
+
+
+def get_partitions(count, processes, per_process=4):
+    """
+    Returns the (start, end) ranges splitting count rows in partitions, a
+    few per process so the processes finishing early take the next ones.
+    >>> get_partitions(10, 2, per_process=2)
+    [(0, 3), (3, 6), (6, 9), (9, 10)]
+    """
+    size = max(int(math.ceil(count / float(processes * per_process))), 1)
+    return [(start, min(start + size, count))
+            for start in range(0, count, size)]
+
+
+def get_boundaries(datagrid, query, keyset, partitions, chunk_size):
+    """
+    Returns the keyset values of the first row of each partition but the
+    first, reading the keys of the sorted query a chunk at a time.
+    """
+    offsets = [start for start, end in partitions[1:]]
+    boundaries = []
+    offset = 0
+    for rows in datagrid.iter_keyset_chunks(query, keyset, chunk_size):
+        while offsets and offsets[0] < offset + len(rows):
+            boundaries.append(rows[offsets.pop(0) - offset][:len(keyset)])
+        if not offsets:
+            break
+        offset += len(rows)
+    return boundaries
+
+
+# The export being written, set in the processes of the pool only.
+_export = None
+
+
+def _init_process(export):
+    global _export
+    _export = export
+    reset_connections()
+
+
+def _write_partition(numbered_partition):
+    """Writes the rows of a partition of the export, given with its
+    number, to a file, whose path is returned."""
+    index, partition = numbered_partition
+    datagrid, format, sorted_rows, keyset, directory, chunk_size = _export
+    query, python_sort, sort_list, extra_names = sorted_rows
+    iterate = EXPORT_FORMATS[format][3]
+    if python_sort:
+        start, end = partition
+        id_lists = (query[offset:min(offset + chunk_size, end)]
+                    for offset in range(start, end, chunk_size))
+    elif keyset is None:
+        start, end = partition
+        id_lists = datagrid.iter_sorted_id_chunks(
+            query, sort_list, extra_names, chunk_size, start, end)
+    else:
+        id_lists = datagrid.iter_sorted_id_chunks(
+            query, sort_list, extra_names, chunk_size, bounds=partition)
+    chunks = (datagrid.load_objects(id_list) for id_list in id_lists)
+    path = os.path.join(directory, '%06d' % index)
+    output = open(path, 'wb')
+    try:
+        for data in iterate(datagrid, chunk_size, header=False,
+                            chunks=chunks):
+            output.write(data)
+    finally:
+        output.close()
+    return path
+
+
+def write_export(datagrid, format, output, processes=None,
+                 chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Writes the export of the grid in format to the output file, with
+    processes processes (DATAGRID_EXPORT_PROCESSES by default) when the
+    grid and format can be exported in parallel.
+    """
+    if processes is None:
+        processes = get_export_processes()
+    content_type, extension, write, iterate = EXPORT_FORMATS[format]
+    if processes < 2 or format not in PARTITIONED_FORMATS or \
+       not isinstance(datagrid.queryset, DjangoQuerySetAdapter):
+        write(datagrid, output)
+        return
+
+    for data in iterate(datagrid, chunk_size, header=True, chunks=[]):
+        output.write(data)
+    sorted_rows, count = get_sorted_rows(datagrid)
+    query, python_sort, sort_list, extra_names = sorted_rows
+    partitions = get_partitions(count, processes)
+    keyset = None
+    if not python_sort:
+        keyset = datagrid.get_keyset(sort_list, extra_names)
+    if keyset is not None:
+        boundaries = [None] + get_boundaries(datagrid, query, keyset,
+                                             partitions, chunk_size) + [None]
+        partitions = zip(boundaries, boundaries[1:])
+    directory = tempfile.mkdtemp(prefix='datagrid-export-')
+    # The export is handed to the processes as they start rather than set
+    # in the module, where the exports of other threads would replace it.
+    export = (datagrid, format, sorted_rows, keyset, directory, chunk_size)
+    pool = multiprocessing.Pool(processes, _init_process, (export,))
+    try:
+        for path in pool.imap(_write_partition, enumerate(partitions)):
+            partition_file = open(path, 'rb')
+            try:
+                shutil.copyfileobj(partition_file, output)
+            finally:
+                partition_file.close()
+            os.remove(path)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(directory, ignore_errors=True)
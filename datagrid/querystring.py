@@ -0,0 +1,85 @@
+"""The query string of the request a grid renders, parsed and encoded once,
+from which the urls of the sort headers, column toggles, pages and exports
+are derived."""
+
+import urllib
+
+from django.utils.encoding import smart_str
+
+
+def encode_param(name, value):
+    """
+    Returns the encoded name=value pair of a query string. Commas are kept,
+    they separate the columns of the sort and columns parameters.
+    >>> encode_param('q', u'caf\\xe9 & co')
+    'q=caf%C3%A9+%26+co'
+    >>> encode_param('sort', '-name,id')
+    'sort=-name,id'
+    """
+    return '%s=%s' % (urllib.quote_plus(smart_str(name), ','),
+                      urllib.quote_plus(smart_str(value), ','))
+
+
+class QueryState(object):
+    """
+    The parameters of a query string, such as request.GET, encoded once.
+
+    The query strings derived from it by replacing or removing parameters
+    join the encoded pairs of the parameters they keep, computed once per
+    set of removed names, with the encoded new values.
+    >>> from django.http import QueryDict
+    >>> query = QueryState(QueryDict('sort=name&page=2&q=a+b'))
+    >>> query.url({'page': 3}, exclude=['q'])
+    '?sort=name&page=3'
+    >>> query.url({'sort': '-name,id'}, exclude=['page', 'q'])
+    '?sort=-name,id'
+    >>> query.items('sort', 'page')
+    [(u'q', u'a b')]
+    """
+    def __init__(self, params):
+        self.pairs = []
+        if hasattr(params, 'lists'):
+            lists = sorted(params.lists())
+        else:
+            lists = sorted((name, [value]) for name, value in params.items())
+        for name, values in lists:
+            for value in values:
+                self.pairs.append((name, value, encode_param(name, value)))
+        self.prefixes = {}
+
+    def items(self, *exclude):
+        """Returns the (name, value) parameters but the excluded ones."""
+        return [(name, value) for name, value, encoded in self.pairs
+                if name not in exclude]
+
+    def prefix(self, *exclude):
+        """
+        Returns the encoded parameters but the excluded ones, each followed
+        by "&" so that more can be appended.
+        """
+        key = frozenset(exclude)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            prefix = self.prefixes[key] = ''.join(
+                [encoded + '&' for name, value, encoded in self.pairs
+                 if name not in key])
+        return prefix
+
+    def encode(self, params=None, exclude=()):
+        """
+        Returns the query string with the params dictionary replacing the
+        parameters of the same names, and without the excluded ones. A list
+        gives a parameter repeated for each of its values.
+        """
+        params = params or {}
+        query = self.prefix(*(tuple(exclude) + tuple(params)))
+        for name, value in sorted(params.items()):
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for item in value:
+                query += encode_param(name, item) + '&'
+        return query[:-1]
+
+    def url(self, params=None, exclude=()):
+        """Returns the encoded query string, starting with "?"."""
+        return '?' + self.encode(params, exclude)
@@ -0,0 +1,95 @@
+"""Lightweight records holding the rows of a grid, built from the values of
+the fields the columns read instead of full model instances or
+dictionaries."""
+
+from operator import itemgetter
+
+from .caching import LRUCache
+
+# The record classes of the most recently used field tuples. Documents with
+# varying fields, such as mongo's, would create classes without bound.
+_record_classes = LRUCache(1000)
+
+
+def record_class(fields, aliases=(), nested=True):
+    """Returns the record class for a tuple of field names, created once per
+    tuple. Records are tuples of the values, read by attribute like objects,
+    so building one doesn't copy them into a per-instance __dict__.
+
+    When nested, fields following relations with "__" are grouped in nested
+    records, so the columns read "author.name" from a record like from an
+    object. This is for the lookups the grid plans for values_list(), the
+    other fields keep their names as they are. aliases are (name, field)
+    pairs of extra attribute names, such as "id" for the pk of mongo
+    documents.
+    >>> Record = record_class(('id', 'title', 'author__name'))
+    >>> record = Record._make((1, u'Post', u'Ann'))
+    >>> record.title, record.author.name
+    (u'Post', u'Ann')
+    >>> record_class(('_id', 'name'), (('id', '_id'),))._make((5, u'x')).id
+    5
+    >>> record_class(('id', 'author__name'), nested=False)._make(
+    ...     (1, u'Ann')).author__name
+    u'Ann'
+    """
+    key = (tuple(fields), aliases, nested)
+    Record = _record_classes.get(key)
+    if Record is not None:
+        return Record
+    fields = key[0]
+    names = []
+    layout = {}
+    for position, field in enumerate(fields):
+        if nested:
+            name, sep, rest = field.partition('__')
+        else:
+            name, sep, rest = field, '', ''
+        if name not in layout:
+            names.append(name)
+            layout[name] = [] if sep else position
+        if sep:
+            layout[name].append((position, rest))
+
+    attrs = {'__slots__': (), '_fields': fields}
+    for index, name in enumerate(names):
+        attrs[name] = property(itemgetter(index))
+    for alias, name in key[1]:
+        if alias not in attrs and name in attrs:
+            attrs[alias] = attrs[name]
+
+    if not [name for name in names if isinstance(layout[name], list)]:
+        def _make(cls, values):
+            return tuple.__new__(cls, values)
+    else:
+        def _make(cls, values):
+            values = tuple(values)
+            record = []
+            for name in names:
+                position = layout[name]
+                if isinstance(position, list):
+                    record.append(record_class(
+                        [rest for p, rest in position])._make(
+                        [values[p] for p, rest in position]))
+                else:
+                    record.append(values[position])
+            return tuple.__new__(cls, record)
+    attrs['_make'] = classmethod(_make)
+    Record = type('Record', (tuple,), attrs)
+    _record_classes.set(key, Record)
+    return Record
+
+
+def dict_record(row, aliases=()):
+    """Returns a record of the items of a dictionary, whose keys are kept as
+    they are, and sorted so the same keys in any order share a class.
+    >>> dict_record({'b': 1, 'a+b': 'c', 'user__name': 'd'})._fields
+    ('a+b', 'b', 'user__name')
+    """
+    fields = sorted(row)
+    return record_class(fields, aliases, nested=False)._make(
+        [row[field] for field in fields])
+
+
+def records_from_dicts(rows):
+    """Converts the dictionaries of a values() query to records."""
+    return [dict_record(row) for row in rows]
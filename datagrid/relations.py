@@ -0,0 +1,175 @@
+"""Planning of the select_related() and prefetch_related() lookups needed
+to render the relations the columns of a grid follow, so that a page costs
+a constant number of queries instead of one per row and relation."""
+
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.fields.related import ManyToManyRel, OneToOneField
+from django.db.models.query import QuerySet
+
+
+# prefetch_related() appeared in Django 1.4. On older versions the
+# relations to many objects are left to be fetched lazily.
+HAS_PREFETCH_RELATED = hasattr(QuerySet, 'prefetch_related')
+
+_plans = {}
+
+
+def get_relation(model, name):
+    """Returns the model the attribute name of model leads to and whether
+    it holds many objects, or (None, False) if it isn't a relation."""
+    opts = model._meta
+    try:
+        field = opts.get_field(name)
+    except FieldDoesNotExist:
+        for related in opts.get_all_related_objects() + \
+                       opts.get_all_related_many_to_many_objects():
+            if related.get_accessor_name() == name:
+                return (related.model,
+                        not isinstance(related.field, OneToOneField))
+        return None, False
+    if field.rel is None:
+        return None, False
+    return field.rel.to, isinstance(field.rel, ManyToManyRel)
+
+
+def get_forward_models(model, path):
+    """Returns the models the forward relations of an attribute path lead
+    to from model. Unlike get_relation() it doesn't look for the reverse
+    relations, only known once all the models are loaded, so it can be used
+    while they are.
+    >>> from django.contrib.auth.models import Permission
+    >>> get_forward_models(Permission, "content_type.app_label")
+    [<class 'django.contrib.contenttypes.models.ContentType'>]
+    """
+    models = []
+    for name in path.replace('__', '.').split('.'):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            break
+        if field.rel is None or isinstance(field.rel.to, basestring):
+            break
+        model = field.rel.to
+        models.append(model)
+    return models
+
+
+def plan_relations(model, path):
+    """Returns the select_related and prefetch_related lookups for the
+    relations followed by an attribute path such as "author.name".
+
+    Forward foreign keys and one-to-one relations are joined with
+    select_related, everything past the first reverse or many-to-many
+    relation is prefetched.
+    >>> from django.contrib.auth.models import Permission, User
+    >>> plan_relations(Permission, "content_type.app_label")
+    (('content_type',), ())
+    >>> plan_relations(User, "groups.count")
+    ((), ('groups',))
+    >>> plan_relations(User, "username")
+    ((), ())
+    """
+    key = (model, path)
+    if key not in _plans:
+        joined = []
+        select_related = ()
+        many = False
+        for name in path.replace('__', '.').split('.'):
+            model, is_many = get_relation(model, name)
+            if model is None:
+                break
+            joined.append(name)
+            many = many or is_many
+            if not many:
+                select_related = ('__'.join(joined),)
+        if many:
+            prefetch_related = ('__'.join(joined),)
+        else:
+            prefetch_related = ()
+        _plans[key] = (select_related, prefetch_related)
+    return _plans[key]
+
+
+def plan_queryset(model, paths):
+    """Returns the select_related and prefetch_related lookups for all
+    the attribute paths, without the lookups others already cover."""
+    select_related = set()
+    prefetch_related = set()
+    for path in paths:
+        selected, prefetched = plan_relations(model, path)
+        select_related.update(selected)
+        prefetch_related.update(prefetched)
+    return (_minimal(select_related), _minimal(prefetch_related))
+
+
+def _minimal(lookups):
+    return sorted(lookup for lookup in lookups
+                  if not any(other.startswith(lookup + '__')
+                             for other in lookups))
+
+
+def apply_plan(queryset, select_related, prefetch_related):
+    """Applies the lookups of plan_queryset() to a Django queryset."""
+    if select_related:
+        queryset = queryset.select_related(*select_related)
+    if prefetch_related and HAS_PREFETCH_RELATED:
+        queryset = queryset.prefetch_related(*prefetch_related)
+    return queryset
+
+
+def get_path_field(model, path):
+    """Returns the field an attribute path reads, possibly through forward
+    foreign keys, or None if the path reads a relation, a property or goes
+    through relations to many objects.
+    >>> from django.contrib.auth.models import Permission
+    >>> get_path_field(Permission, "content_type.app_label").name
+    'app_label'
+    >>> get_path_field(Permission, "content_type") is None
+    True
+    """
+    names = path.replace('__', '.').split('.')
+    for name in names[:-1]:
+        model, many = get_relation(model, name)
+        if model is None or many:
+            return None
+    try:
+        field = model._meta.get_field(names[-1])
+    except FieldDoesNotExist:
+        return None
+    if field.rel is not None:
+        return None
+    return field
+
+
+def is_nullable_path(model, path):
+    """Returns whether an attribute path may read NULL: when the field it
+    reads or a foreign key it follows is nullable, or it can't be told.
+    >>> from django.contrib.auth.models import Permission
+    >>> is_nullable_path(Permission, "content_type.app_label")
+    False
+    """
+    for name in path.replace('__', '.').split('.'):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            return True
+        if field.null:
+            return True
+        if field.rel is not None:
+            model = field.rel.to
+    return False
+
+
+def get_value_path(model, path):
+    """Returns the values() lookup of an attribute path reading a field,
+    possibly through forward foreign keys, or None if the path reads a
+    relation, a property or goes through relations to many objects.
+    >>> from django.contrib.auth.models import Permission
+    >>> get_value_path(Permission, "content_type.app_label")
+    'content_type__app_label'
+    >>> get_value_path(Permission, "content_type") is None
+    True
+    """
+    if get_path_field(model, path) is None:
+        return None
+    return path.replace('.', '__')
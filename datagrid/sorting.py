@@ -0,0 +1,83 @@
+"""Sorting by values computed in Python, for the columns the data source
+can't sort by itself."""
+
+import heapq
+
+from django.core.cache import cache
+
+
+class ReverseKey(object):
+    """Sort key ordering a value in descending order
+    >>> sorted([1, 3, 2], key=ReverseKey)
+    [3, 2, 1]
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
+
+
+class PythonSortedList(object):
+    """The pks of a queryset, sorted by keys computed in Python.
+
+    Only the pk and the given fields of each row are streamed from the
+    adapter (whole rows when fields is None), and passed to key_func.
+    Used as the object list of the paginator, it returns the pks of the
+    requested page.
+
+    When a cache key is given, the whole ordering is computed once and
+    cached. Otherwise a page is taken from a heap of the rows up to its end,
+    so memory doesn't grow with the number of rows.
+    """
+    def __init__(self, queryset, fields, key_func, cache_key=None,
+                 timeout=300):
+        self.queryset = queryset
+        self.fields = fields
+        self.key_func = key_func
+        self.cache_key = cache_key
+        self.timeout = timeout
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.queryset.count()
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def iter_keys(self):
+        key_func = self.key_func
+        for pk, record in self.queryset.iterate(self.fields):
+            yield (key_func(record), pk)
+
+    def get_ordering(self):
+        """Returns the pks of all the rows, in order."""
+        ordering = cache.get(self.cache_key)
+        if ordering is None:
+            ordering = [pk for key, pk in sorted(self.iter_keys())]
+            cache.set(self.cache_key, ordering, self.timeout)
+        return ordering
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        if self.cache_key:
+            return self.get_ordering()[index]
+        if index.stop is None:
+            keys = sorted(self.iter_keys())
+        else:
+            keys = heapq.nsmallest(index.stop, self.iter_keys())
+        return [pk for key, pk in keys[index]]
@@ -1,9 +1,27 @@
-import urllib
+from __future__ import absolute_import
+
 from django import template
+
+from datagrid.querystring import QueryState
+
 register = template.Library()
 
 
 PAGINATION_DEFAULT = 20
+
+
+def get_query(context):
+    """
+    Returns the QueryState of the datagrid of the context, parsed once per
+    render, or of the request when there's no datagrid.
+    """
+    if 'datagrid' in context:
+        return context['datagrid'].query
+    if 'request' in context:
+        return QueryState(context['request'].GET)
+    return QueryState({})
+
+
 @register.inclusion_tag('datagrid/pagination_size_frag.html', takes_context=True)
 def render_pagination_size_widget(context):
     "Usage {% render_pagination_size_widget %}"
@@ -12,74 +30,38 @@ def render_pagination_size_widget(context):
     if 'request' in context:
 
         request = context['request']
-        getvars = request.GET.copy()
-        if 'page_size' in getvars:
-            payload['current_page_size'] = int(getvars['page_size'])
-            del getvars['page_size']
+        if 'page_size' in request.GET:
+            payload['current_page_size'] = int(request.GET['page_size'])
         else:
             from django.conf import settings
             payload['current_page_size'] = getattr(settings, 'PAGINATION_DEFAULT_PAGINATION', PAGINATION_DEFAULT)
-        if 'page' in getvars:
-            del getvars['page']
-        if len(getvars.keys()) > 0:
-            payload['getpagingvars'] =  zip(getvars.keys(), getvars.values())
-        else:
-            payload['getpagingvars'] = []
+        payload['getpagingvars'] = get_query(context).items('page_size',
+                                                            'page')
     return payload
 
 
 @register.inclusion_tag('datagrid/get_pdf_link.html', takes_context=True)
 def get_pdf_link(context):
-    getvars = {}
-    if 'request' in context:
-        request = context['request']
-        getvars = request.GET.copy()
-        getvars['is_pdf'] = 1
-        getvars = urllib.urlencode(getvars)
-        return {'getvars':getvars}
-    else:
-        getvars['is_pdf'] = 1
-        getvars = urllib.urlencode(getvars)
-    return {'getvars':getvars}
+    return {'getvars': get_query(context).encode({'is_pdf': 1})}
 
 
 @register.inclusion_tag('datagrid/get_csv_link.html', takes_context=True)
 def get_csv_link(context):
-    getvars = {}
-    if 'request' in context:
-        request = context['request']
-        getvars = request.GET.copy()
-        getvars['is_csv'] = 1
-        getvars = urllib.urlencode(getvars)
-    else:
-        getvars['is_csv'] = 1
-        getvars = urllib.urlencode(getvars)
-    return {'getvars':getvars}
+    return {'getvars': get_query(context).encode({'is_csv': 1})}
 
 @register.inclusion_tag('datagrid/get_search_form.html', takes_context=True)
 def get_search_form(context):
-    getvars = {}
+    searchterm = ''
     if 'request' in context:
-        request = context['request']
-        getvars = request.GET.copy()
-        if 'q' in getvars:
-            searchterm = getvars['q']
-            del getvars['q']
-            return {'getvars':getvars.items(), 'searchterm': searchterm}
-        else:
-            return {'getvars':[], 'searchterm': ''}
+        searchterm = context['request'].GET.get('q', '')
+    # A new search starts from the first page.
+    return {'getvars': get_query(context).items('q', 'page'),
+            'searchterm': searchterm}
 
 @register.inclusion_tag('datagrid/get_filter_form.html', takes_context=True)
 def get_filter_form(context):
-    request = context['request']
     for field, options in context['filtering_options']:
-        options.selected = None
-        val = request.GET.get(field, None)
-        if val is not None:
-            try:
-                options.selected = int(val)
-            except:
-                options.selected = val
+        options.load_selected(context['datagrid'], field)
     return context
 
 
@@ -92,13 +74,11 @@ def paginator(context, adjacent_pages=3):
     page_nums = range(max(1, context['page'] - adjacent_pages),
                       min(context['pages'], context['page'] + adjacent_pages)
                       + 1)
-    getvars = {}
-    if 'request' in context:
-        request = context['request']
-        getvars = request.GET.copy()
-        if 'page' in getvars:
-            getvars['page']
-    getvars = urllib.urlencode(getvars)
+    query = get_query(context)
+    getvars = query.encode(exclude=['page'])
+    page_prefix = '?' + query.prefix('page')
+    if context.get('extra_query', None):
+        page_prefix += context['extra_query'] + '&'
 
     return {
         'hits': context['hits'],
@@ -114,4 +94,5 @@ def paginator(context, adjacent_pages=3):
         'show_last': context['pages'] not in page_nums,
         'extra_query': context.get('extra_query', None),
         'getvars': getvars,
+        'page_prefix': page_prefix,
     }
@@ -24,15 +24,44 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import csv
+import os
+import shutil
+import StringIO
+import tempfile
+import zipfile
 from datetime import datetime, timedelta
 
 from django.conf import settings
-from django.contrib.auth.models import Group, User
-from django.http import HttpRequest
+from django.core.cache import cache
+from django.contrib.auth.models import Group, Permission, User
+from django.contrib.contenttypes.models import ContentType
+from django.conf.urls.defaults import patterns, url
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.http import HttpRequest, HttpResponse, QueryDict
 
-from datagrid.grids import ( Column, DataGrid, DateTimeSinceColumn,
-                                NonDatabaseColumn)
+from django.db import models
+from django.db.models import Count, Max, Sum
+from django.db.models.signals import post_save
+from django.template.defaultfilters import date
+from django.utils import simplejson, translation
+from django.utils.tzinfo import FixedOffset
+
+from datagrid.grids import ( Column, DataGrid, DateTimeColumn,
+                                DateTimeSinceColumn,
+                                NonDatabaseColumn, AggregateColumn,
+                                ComputedColumn, ForeignKeyLabelColumn,
+                                FilterOptions,
+                                RangeFilterOptions, DateRangeFilterOptions,
+                                format_watermark, parse_watermark)
 from datagrid.adapters import DictionaryQuerySetAdapter
+from datagrid.caching import get_model_version, get_version_key
+from datagrid.exports import iter_csv, write_xlsx
+from datagrid.jobs import ExportJob, get_fingerprint
+from datagrid.links import URLTemplate
+from datagrid.records import dict_record, record_class
+from datagrid.xlsx import HEADER_STYLE, XLSXWriter
 from django.test.testcases import TestCase
 
 from mongo_test import MongoDataGridTest
@@ -40,6 +69,13 @@ from mongo_test import MongoDataGridTest
 def id_mod_4(obj):
     return obj.id % 4
 
+class Ticket(models.Model):
+    title = models.CharField(max_length=50)
+    owner = models.ForeignKey(User, null=True)
+
+    class Meta:
+        app_label = 'datagrid'
+
 def populate_groups():
     for i in range(1, 100):
         group = Group(name="Group %02d" % i)
@@ -90,6 +126,17 @@ class DataGridWithNoDbColumnsNoExtra (DataGridWithNoDbColumns):
     custom = NonDatabaseColumn("Second Title",
                                sortable=True, data_func=id_mod_4, link=True,
                                )
+
+class UnlinkedDataGridWithNoDbColumns(DataGridWithNoDbColumnsNoExtra):
+    objid = Column("ID", sortable=True, field_name="id")
+    name = Column("Group Name", sortable=True, expand=True)
+    custom = NonDatabaseColumn("Second Title", sortable=True,
+                               data_func=id_mod_4)
+
+class DictionaryDataGridWithNoDbColumns(DataGridWithDictonaryData):
+    custom = NonDatabaseColumn("Second Title",
+                               sortable=True, data_func=id_mod_4, link=True,
+                               data_fields=["id"])
 class GroupDataGrid(DataGrid):
     objid = Column("ID", link=True, sortable=True, field_name="id")
     name = Column("Group Name", link=True, sortable=True, expand=True)
@@ -101,6 +148,177 @@ class GroupDataGrid(DataGrid):
             "objid", "name"
         ]
 
+class BackgroundExportGroupDataGrid(GroupDataGrid):
+    class Meta:
+        background_exports = ('csv',)
+
+class PermissionDataGrid(DataGrid):
+    name = Column("Name", sortable=True)
+    app_label = Column("Application", sortable=True,
+                       field_name="content_type.app_label")
+    model = Column("Model", field_name="content_type.model")
+
+    def __init__(self, request):
+        DataGrid.__init__(self, request, Permission.objects.all(),
+                          "Permissions")
+        self.default_sort = "app_label"
+
+class CachedPermissionDataGrid(PermissionDataGrid):
+    class Meta:
+        model = Permission
+        cache = 300
+
+def count_members(groups):
+    counts = dict(User.objects.filter(groups__in=groups).values_list(
+        'groups').annotate(Count('pk')))
+    return [counts.get(group.id, 0) for group in groups]
+
+class BatchGroupDataGrid(GroupDataGrid):
+    members = NonDatabaseColumn("Members", batch_data_func=count_members,
+                                data_fields=["id"])
+
+rendered_ids = []
+
+def id_mod_4_batch(groups):
+    rendered_ids.extend([group.id for group in groups])
+    return [group.id % 4 for group in groups]
+
+class RowCacheGroupDataGrid(GroupDataGrid):
+    custom = NonDatabaseColumn("Second Title", data_fields=["id"],
+                               batch_data_func=id_mod_4_batch)
+
+    class Meta:
+        row_cache = 300
+
+calls = []
+
+def staff_label(is_staff):
+    calls.append(is_staff)
+    return is_staff and "Staff" or "Member"
+
+def staff_link(obj, data):
+    calls.append(obj.is_staff)
+    return "/users/?is_staff=%s" % obj.is_staff
+
+class MemoizedUserDataGrid(DataGrid):
+    username = Column("Username", sortable=True)
+    is_staff = Column("Staff", data_func=staff_label, memoize_timeout=60,
+                      link=True, link_func=staff_link,
+                      link_key=lambda obj: obj.is_staff)
+
+    def __init__(self, request):
+        DataGrid.__init__(self, request, User.objects.all(), "Users")
+
+class TicketDataGrid(DataGrid):
+    title = Column("Title", sortable=True)
+    owner = Column("Owner", sortable=True, field_name="owner.username")
+
+    def __init__(self, request):
+        DataGrid.__init__(self, request, Ticket.objects.all(), "Tickets")
+
+class PermissionTypeDataGrid(DataGrid):
+    name = Column("Name", sortable=True)
+    content_type = ForeignKeyLabelColumn("Type", label_field="model")
+
+    def __init__(self, request):
+        DataGrid.__init__(self, request, Permission.objects.all(),
+                          "Permissions")
+
+class AppLabelPermissionTypeDataGrid(PermissionTypeDataGrid):
+    app_label = Column("Application", field_name="content_type.app_label")
+
+class LabelAfterPermissionDataGrid(DataGrid):
+    app_label = Column("Application", field_name="content_type.app_label")
+    name = Column("Name", sortable=True)
+    content_type = ForeignKeyLabelColumn("Type", label_field="model")
+
+    def __init__(self, request):
+        DataGrid.__init__(self, request, Permission.objects.all(),
+                          "Permissions")
+
+def user_view(request, *args, **kwargs):
+    return HttpResponse()
+
+urlpatterns = patterns('',
+    url(r'^users/(\d+)/$', user_view, name='datagrid-test-user'),
+    url(r'^users/(?P<username>[\w.@+-]+)/profile/$', user_view,
+        name='datagrid-test-profile'),
+)
+
+class LinkedUserDataGrid(DataGrid):
+    username = Column("Username", sortable=True,
+                      link_url='datagrid-test-user', link_args=['id'])
+    email = Column("Email", link_url='datagrid-test-profile',
+                   link_args={'username': 'username'})
+
+    def __init__(self, request):
+        DataGrid.__init__(self, request, User.objects.all(), "Users")
+
+class AutocompleteGroupDataGrid(GroupDataGrid):
+    class Meta:
+        filtering_options = {
+            'name': FilterOptions("Name", autocomplete=True,
+                                  autocomplete_limit=5),
+        }
+
+class UserDataGrid(DataGrid):
+    objid = Column("ID", sortable=True, field_name="id")
+    username = Column("Username", sortable=True)
+    date_joined = DateTimeSinceColumn("Joined", sortable=True)
+
+    class Meta:
+        filtering_options = {
+            'id': RangeFilterOptions("ID", coerce=int),
+            'date_joined': DateRangeFilterOptions("Joined"),
+        }
+
+    def __init__(self, request, queryset=None):
+        DataGrid.__init__(self, request, queryset or User.objects.all(),
+                          "All Users")
+        self.default_sort = "objid"
+
+class DeltaUserDataGrid(UserDataGrid):
+    class Meta:
+        modified_field = 'date_joined'
+
+class FooterGroupDataGrid(DataGrid):
+    objid = Column("ID", sortable=True, field_name="id", footer=Sum)
+    name = Column("Group Name", sortable=True, footer=Max)
+
+    def __init__(self, request, queryset=None):
+        DataGrid.__init__(self, request, queryset or Group.objects.all(),
+                          "All Groups")
+        self.default_sort = "objid"
+
+class FooterUserDataGrid(DataGrid):
+    objid = Column("ID", sortable=True, field_name="id", footer=Sum)
+    username = Column("Username", sortable=True)
+    is_staff = Column("Staff", sortable=True)
+
+    def __init__(self, request, queryset=None):
+        DataGrid.__init__(self, request, queryset or User.objects.all(),
+                          "All Users")
+        self.default_sort = "objid"
+
+class MembersGroupDataGrid(GroupDataGrid):
+    members = AggregateColumn("Members", Count('user'))
+
+
+class FooterMembersGroupDataGrid(GroupDataGrid):
+    objid = Column("ID", sortable=True, field_name="id", footer=Sum)
+    members = AggregateColumn("Members", Count('user'), footer=Sum)
+
+
+class LastJoinedGroupDataGrid(GroupDataGrid):
+    objid = Column("ID", sortable=True, field_name="id", footer=Sum)
+    last_joined = ComputedColumn("Last joined", Max('user__date_joined'))
+
+    class Meta:
+        filtering_options = {
+            'last_joined': DateRangeFilterOptions("Last joined",
+                                                  bucket_counts=False),
+        }
+
 
 class ColumnsTest(TestCase):
     def testDateTimeSinceColumn(self):
@@ -121,6 +339,25 @@ class ColumnsTest(TestCase):
         obj.time = now - timedelta(days=7)
         self.assertEqual(column.render_data(obj), "1 week ago")
 
+    def testDateColumnsBatch(self):
+        """Testing formatting the dates of a page in one batch"""
+        class DummyObj:
+            def __init__(self, time):
+                self.time = time
+
+        now = datetime.now()
+        objects = [DummyObj(now - timedelta(days=days))
+                   for days in (0, 5, 5, 7)] + [DummyObj(None)]
+
+        column = DateTimeSinceColumn("Test", field_name='time')
+        self.assertEqual(column.render_data_batch(objects),
+                         [column.render_data(obj) for obj in objects])
+
+        for format in (None, "D, j N Y H:i", r"\Y Y", "SHORT_DATE_FORMAT"):
+            column = DateTimeColumn("Test", field_name='time', format=format)
+            self.assertEqual(column.render_data_batch(objects),
+                             [date(obj.time, format) for obj in objects])
+
 
 class DataGridTest(TestCase):
     grid_class = GroupDataGrid
@@ -145,6 +382,13 @@ class DataGridTest(TestCase):
         """Testing rendering datagrid to HTTPResponse"""
         self.datagrid.render_listview_to_response()
 
+    def testCsvResponse(self):
+        """Testing the CSV response holds all the rows, not the page"""
+        self.request.GET['is_csv'] = "1"
+        response = self.datagrid.render_to_response("datagrid/listview.html")
+        self.assertEqual(response['Content-Type'], "text/csv; charset=utf-8")
+        self.assertEqual(len(response.content.splitlines()), 100)
+
     def testSortAscending(self):
         """Testing datagrids with ascending sort"""
         self.request.GET['sort'] = "name,objid"
@@ -202,13 +446,1000 @@ class GridWithNoDbColumnsTest(DataGridTest):
         # Exercise the code paths when rendering
         self.datagrid.render_listview()
 
+    def testCsvExport(self):
+        """Testing the CSV export streams all the sorted rows in chunks"""
+        self.request.GET['sort'] = "custom"
+        self.datagrid.load_state(precompute=False)
+        chunks = list(iter_csv(self.datagrid, chunk_size=40))
+        self.assertEqual(len(chunks), 4)
+        rows = list(csv.reader(StringIO.StringIO("".join(chunks))))
+        self.assertEqual(rows[0], ["ID", "Group Name", "Second Title"])
+        self.assertEqual(len(rows), 100)
+        self.assertEqual([row[1] for row in rows[1:4]],
+                         ["Group 04", "Group 08", "Group 12"])
+        self.assertEqual([row[2] for row in rows[1:]],
+                         sorted(row[2] for row in rows[1:]))
+
+    def testNdjsonExport(self):
+        """Testing the NDJSON export keeps the values of the fields typed"""
+        self.request.GET['export'] = "ndjson"
+        self.request.GET['sort'] = "-objid"
+        response = self.datagrid.render_to_response("datagrid/listview.html")
+        self.assertEqual(response['Content-Type'], "application/x-ndjson")
+        rows = [simplejson.loads(line)
+                for line in "".join(response).splitlines()]
+        self.assertEqual(len(rows), 99)
+        self.assertEqual(rows[0]['objid'], 99)
+        self.assertEqual(rows[0]['name'], "Group 99")
 
-class GridWithNoDbColumnsTestWithNoExtra(DataGridTest):
+    def testXlsxExport(self):
+        """Testing the XLSX export writes typed cells under a header row"""
+        self.request.GET['sort'] = "-objid"
+        self.datagrid.load_state(precompute=False)
+        output = StringIO.StringIO()
+        write_xlsx(self.datagrid, output)
+        workbook = zipfile.ZipFile(output)
+        self.assertEqual(workbook.testzip(), None)
+        sheet = workbook.read('xl/worksheets/sheet1.xml')
+        self.assertEqual(sheet.count('<row '), 100)
+        self.assertTrue('<c r="A1" s="4" t="inlineStr"><is>'
+                        '<t xml:space="preserve">ID</t>' in sheet)
+        self.assertTrue('<c r="A2"><v>99</v></c>' in sheet)
+
+    def testXlsxSheetsSplit(self):
+        """Testing the XLSX rows beyond a sheet go on to the next ones"""
+        output = StringIO.StringIO()
+        writer = XLSXWriter(output, "Groups", max_rows=40)
+        writer.write_row(["ID"], HEADER_STYLE)
+        writer.write_rows([[i] for i in range(99)])
+        writer.close()
+        workbook = zipfile.ZipFile(output)
+        self.assertEqual(workbook.testzip(), None)
+        self.assertTrue('<sheet name="Groups (3)" sheetId="3" r:id="rId3"/>'
+                        in workbook.read('xl/workbook.xml'))
+        self.assertTrue('Id="rId4" Type="http://schemas.openxmlformats.org/'
+                        'officeDocument/2006/relationships/styles"' in
+                        workbook.read('xl/_rels/workbook.xml.rels'))
+        sheets = [workbook.read('xl/worksheets/sheet%d.xml' % number)
+                  for number in (1, 2, 3)]
+        self.assertEqual([sheet.count('<row ') for sheet in sheets],
+                         [40, 40, 22])
+        for sheet in sheets:
+            self.assertTrue('<c r="A1" s="4" t="inlineStr">' in sheet)
+        self.assertTrue('<c r="A2"><v>39</v></c>' in sheets[1])
+        self.assertTrue('<c r="A22"><v>98</v></c>' in sheets[2])
+
+
+class GridWithNoDbColumnsTestWithNoExtra(GridWithNoDbColumnsTest):
     grid_class = DataGridWithNoDbColumnsNoExtra
 
+    def testSortNoDbWithFieldSort(self):
+        """Testing sorting by a NonDatabaseColumn and a database field"""
+        self.request.GET['sort'] = "custom,-objid"
+        self.datagrid.load_state()
+        self.assertEqual([row['object'].name
+                          for row in self.datagrid.rows[:3]],
+                         ["Group 96", "Group 92", "Group 88"])
+
+    def testSortNoDbCacheInvalidation(self):
+        """Testing the cached Python sort is invalidated by saves"""
+        self.request.GET['sort'] = "custom"
+        self.datagrid.load_state()
+        Group.objects.filter(name="Group 04").update(name="Group 4")
+        group = Group.objects.get(name="Group 08")
+        group.name = "Group 8"
+        group.save()
+
+        datagrid = self.grid_class(self.request)
+        datagrid.load_state()
+        self.assertEqual([row['object'].name for row in datagrid.rows[:2]],
+                         ["Group 4", "Group 8"])
+        Group.objects.get(name="Group 4").delete()
+
+        datagrid = self.grid_class(self.request)
+        datagrid.load_state()
+        self.assertEqual(datagrid.rows[0]['object'].name, "Group 8")
+
+class DictionaryGridWithNoDbColumnsTest(GridWithNoDbColumnsTest):
+    grid_class = DictionaryDataGridWithNoDbColumns
+
 class DataGridWithValuesQueryTest(GridWithNoDbColumnsTest):
     grid_class = DataGridWithValuesQuery
 
 class GridDictionaryTest(DataGridTest):
     grid_class = DataGridWithDictonaryData
 
+
+class AutocompleteTest(DataGridTest):
+    grid_class = AutocompleteGroupDataGrid
+
+    def testAutocomplete(self):
+        """Testing autocomplete of filter fields"""
+        self.request.GET['autocomplete'] = "name"
+        self.request.GET['term'] = "group 1"
+        response = self.datagrid.render_to_response("unused.html")
+        self.assertEqual(simplejson.loads(response.content),
+                         ["Group 10", "Group 11", "Group 12", "Group 13",
+                          "Group 14"])
+
+        # Answered from the cached prefix the second time.
+        self.assertNumQueries(0, self.datagrid.render_to_response,
+                              "unused.html")
+
+        # Until the data changes.
+        Group.objects.filter(name="Group 10").delete()
+        response = self.datagrid.render_to_response("unused.html")
+        self.assertEqual(simplejson.loads(response.content)[0], "Group 11")
+
+class RangeFilterTest(TestCase):
+    def setUp(self):
+        now = datetime.now()
+        for i in range(1, 21):
+            User.objects.create(username="user%02d" % i,
+                                date_joined=now - timedelta(days=i))
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+
+    def testRangeFilter(self):
+        """Testing filtering by a numeric range"""
+        first = User.objects.order_by('id')[0].id
+        self.request.GET['id__gte'] = str(first + 2)
+        self.request.GET['id__lte'] = str(first + 4)
+        datagrid = UserDataGrid(self.request)
+        datagrid.render_listview()
+        self.assertEqual([row['object'].username for row in datagrid.rows],
+                         ["user03", "user04", "user05"])
+
+    def testDateWindowFilter(self):
+        """Testing filtering by a relative date window"""
+        self.request.GET['date_joined'] = "7d"
+        datagrid = UserDataGrid(self.request)
+        datagrid.render_listview()
+        self.assertEqual(datagrid.paginator.count, 6)
+
+        options = datagrid.filtering_options['date_joined']
+        self.assertEqual([count for key, label, count in options.buckets],
+                         [0, 6, 20, 20])
+
+    def testDateRangeFilterDictionary(self):
+        """Testing filtering by a date range with dictionary data"""
+        today = datetime.now().date()
+        self.request.GET['date_joined__gte'] = \
+            (today - timedelta(days=3)).isoformat()
+        self.request.GET['date_joined__lte'] = \
+            (today - timedelta(days=2)).isoformat()
+        datagrid = UserDataGrid(self.request, DictionaryQuerySetAdapter(
+            list(User.objects.values('id', 'username', 'date_joined'))))
+        datagrid.render_listview()
+        self.assertEqual(sorted(row['object'].username
+                                for row in datagrid.rows),
+                         ["user02", "user03"])
+
+class FooterTest(DataGridTest):
+    grid_class = FooterGroupDataGrid
+
+    def testFooter(self):
+        """Testing footer aggregates"""
+        ids = list(Group.objects.values_list('id', flat=True))
+        self.datagrid.load_state()
+        self.assertEqual(self.datagrid.footer, [sum(ids), "Group 99"])
+        self.assertEqual(self.datagrid.paginator.count, len(ids))
+        self.assertTrue("datagrid-footer" in self.datagrid.render_listview())
+
+    def testFooterDictionary(self):
+        """Testing footer aggregates with dictionary data"""
+        datagrid = self.grid_class(self.request, DictionaryQuerySetAdapter(
+            list(Group.objects.values())))
+        datagrid.load_state()
+        self.assertEqual(datagrid.footer,
+                         [sum(Group.objects.values_list('id', flat=True)),
+                          "Group 99"])
+
+class GroupByTest(TestCase):
+    def setUp(self):
+        for i in range(1, 21):
+            User.objects.create(username="user%02d" % i, is_staff=i % 3 == 0)
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+        self.request.GET = QueryDict("group_by=is_staff", mutable=True)
+
+    def testGroupBy(self):
+        """Testing grouping rows by a column"""
+        datagrid = FooterUserDataGrid(self.request)
+        datagrid.render_listview()
+        self.assertEqual([(group['value'], group['count'])
+                          for group in datagrid.groups],
+                         [(False, 14), (True, 6)])
+        self.assertEqual(datagrid.groups[1]['rows'], [])
+
+    def testGroupByExpand(self):
+        """Testing expanding a group"""
+        self.request.GET['expand'] = "True"
+        datagrid = FooterUserDataGrid(self.request)
+        datagrid.render_listview()
+        self.assertEqual([row['object'].username
+                          for row in datagrid.groups[1]['rows']],
+                         ["user03", "user06", "user09", "user12", "user15",
+                          "user18"])
+        ids = User.objects.filter(is_staff=True).values_list('id', flat=True)
+        self.assertEqual(datagrid.groups[1]['cells'][0], (False, sum(ids)))
+
+    def testGroupByDictionary(self):
+        """Testing grouping rows with dictionary data"""
+        datagrid = FooterUserDataGrid(self.request, DictionaryQuerySetAdapter(
+            list(User.objects.values('id', 'username', 'is_staff'))))
+        datagrid.render_listview()
+        self.assertEqual([(group['value'], group['count'])
+                          for group in datagrid.groups],
+                         [(False, 14), (True, 6)])
+
+class AggregateColumnTest(DataGridTest):
+    grid_class = MembersGroupDataGrid
+
+    def setUp(self):
+        DataGridTest.setUp(self)
+        for i, group in enumerate(Group.objects.order_by('id')[:5]):
+            for j in range(i + 1):
+                User.objects.create(username="user%d-%d" % (i, j)).groups.add(
+                    group)
+
+    def testSortByAggregate(self):
+        """Testing sorting by an aggregate column"""
+        self.request.GET['sort'] = "-members,objid"
+        self.assertNumQueries(3, self.datagrid.load_state)
+        self.assertEqual([(row['object'].name, row['data'][2])
+                          for row in self.datagrid.rows[:6]],
+                         [("Group 05", 5), ("Group 04", 4), ("Group 03", 3),
+                          ("Group 02", 2), ("Group 01", 1), ("Group 06", 0)])
+
+    def testFooterAndGroupsOfAggregate(self):
+        """Testing aggregate columns next to footers and groups"""
+        self.request.GET['group_by'] = "members"
+        datagrid = FooterMembersGroupDataGrid(self.request)
+        datagrid.render_listview()
+        self.assertEqual(datagrid.group_column, None)
+        self.assertEqual(datagrid.footer, [
+            None, sum(Group.objects.values_list('id', flat=True)), None])
+
+        self.request.GET = QueryDict("group_by=name&expand=Group+05")
+        datagrid = FooterMembersGroupDataGrid(self.request)
+        datagrid.render_listview()
+        group = [group for group in datagrid.groups
+                 if group['value'] == "Group 05"][0]
+        self.assertEqual([row['data'][2] for row in group['rows']], [5])
+
+class ComputedColumnTest(DataGridTest):
+    grid_class = LastJoinedGroupDataGrid
+
+    def setUp(self):
+        DataGridTest.setUp(self)
+        now = datetime.now()
+        for i, group in enumerate(Group.objects.order_by('id')[:3]):
+            User.objects.create(username="user%d" % i,
+                                date_joined=now - timedelta(days=i * 10)
+                                ).groups.add(group)
+
+    def testSortAndFilterByComputedColumn(self):
+        """Testing sorting and filtering by a computed column"""
+        self.request.GET['sort'] = "last_joined"
+        self.request.GET['last_joined'] = "30d"
+        self.datagrid.handle_filter()
+        self.datagrid.load_state()
+        self.assertEqual([row['object'].name for row in self.datagrid.rows],
+                         ["Group 03", "Group 02", "Group 01"])
+        self.assertEqual(self.datagrid.footer, [None,
+            sum(Group.objects.order_by('id').values_list('id', flat=True)[:3]),
+            None])
+
+
+class ExtraSortTest(DataGridTest):
+    grid_class = DataGridWithNoDbColumns
+
+    def testExtraSortWithFieldSort(self):
+        """Testing sorting by extra_sort and a database field together"""
+        self.request.GET['sort'] = "custom,-objid"
+        self.datagrid.load_state()
+        self.assertEqual([row['object'].name
+                          for row in self.datagrid.rows[:3]],
+                         ["Group 96", "Group 92", "Group 88"])
+
+
+class RelationsTest(TestCase):
+    def setUp(self):
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+
+    def testRelationsAreJoined(self):
+        """Testing related fields cost no query per row"""
+        self.request.GET['sort'] = "app_label,-name"
+        datagrid = PermissionDataGrid(self.request)
+        self.assertNumQueries(3, datagrid.load_state)
+        self.assertEqual(len(datagrid.rows), 10)
+        labels = [row['data'][1] for row in datagrid.rows]
+        self.assertEqual(labels, sorted(labels))
+
+    def testValuesRows(self):
+        """Testing columns reading fields are rendered from values() rows"""
+        self.request.GET['sort'] = "-name"
+        datagrid = PermissionDataGrid(self.request)
+        self.assertEqual(datagrid.get_values_fields(),
+                         ["id", "name", "content_type__app_label",
+                          "content_type__model"])
+        datagrid.load_state()
+        permission = Permission.objects.order_by('-name')[0]
+        self.assertFalse(isinstance(datagrid.rows[0]['object'], Permission))
+        self.assertEqual(datagrid.rows[0]['data'],
+                         [permission.name, permission.content_type.app_label,
+                          permission.content_type.model])
+
+        datagrid = GroupDataGrid(self.request)
+        self.assertEqual(datagrid.get_values_fields(), None)
+
+
+class ListviewCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def render(self, sort="app_label,-name"):
+        request = HttpRequest()
+        request.user = User(username="testuser")
+        request.GET['sort'] = sort
+        return CachedPermissionDataGrid(request).render_listview()
+
+    def testCachedListview(self):
+        """Testing the list view is rendered once per state and data"""
+        html = self.render()
+        self.assertNumQueries(0, self.render)
+        self.assertEqual(self.render(), html)
+        self.assertNotEqual(self.render("-app_label"), html)
+
+        # Saving an object of a related model renders it again.
+        content_type = Permission.objects.order_by('content_type__app_label',
+                                                   '-name')[0].content_type
+        content_type.app_label = "renamed"
+        content_type.save()
+        self.assertTrue("renamed" in self.render("-app_label"))
+
+    def testModelsTrackedWhenDefined(self):
+        """Testing the models of a grid's Meta.model are tracked at once"""
+        uid = 'datagrid-version:%s' % get_version_key(ContentType)
+        post_save.disconnect(sender=ContentType, dispatch_uid=uid)
+        version = get_model_version(ContentType)
+        ContentType.objects.all()[0].save()
+        self.assertEqual(get_model_version(ContentType), version)
+
+        class TrackedPermissionDataGrid(PermissionDataGrid):
+            class Meta:
+                model = Permission
+
+        ContentType.objects.all()[0].save()
+        self.assertNotEqual(get_model_version(ContentType), version)
+
+
+class ColumnSelectionTest(TestCase):
+    def setUp(self):
+        for i in range(1, 6):
+            User.objects.create(username="user%02d" % i)
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+
+    def testColumnsFromRequest(self):
+        """Testing the columns parameter selects and projects the columns"""
+        self.request.GET['columns'] = "username,objid,bogus"
+        datagrid = UserDataGrid(self.request)
+        datagrid.load_state()
+        self.assertEqual([column.id for column in datagrid.columns],
+                         ["username", "objid"])
+        self.assertFalse(datagrid.date_joined.active)
+        self.assertEqual(datagrid.get_projection(), ["id", "username"])
+        self.assertEqual(datagrid.rows[0]['data'],
+                         ["user01", User.objects.get(username="user01").id])
+        self.assertFalse(hasattr(datagrid.rows[0]['object'], 'password'))
+
+    def testNoProjectionForUndeclaredDataFields(self):
+        """Testing NonDatabaseColumns without data_fields fetch whole rows"""
+        populate_groups()
+        self.request.GET['columns'] = "objid,name"
+        datagrid = UnlinkedDataGridWithNoDbColumns(self.request)
+        datagrid.load_state()
+        self.assertEqual(datagrid.get_projection(), ["id", "name"])
+
+        self.request.GET['columns'] = "objid,custom"
+        datagrid = UnlinkedDataGridWithNoDbColumns(self.request)
+        datagrid.load_state()
+        self.assertEqual(datagrid.get_projection(), None)
+        self.assertEqual(len(datagrid.rows[0]['data']), 2)
+
+    def testNoProjectionForLinkFunc(self):
+        """Testing links built by a link_func fetch whole rows"""
+        populate_groups()
+        datagrid = DataGridWithNoDbColumnsNoExtra(self.request)
+        datagrid.load_state()
+        self.assertEqual(datagrid.get_projection(), None)
+
+
+class RecordsTest(TestCase):
+    def testRecords(self):
+        """Testing row records read like objects"""
+        Record = record_class(("id", "name", "owner__username"))
+        record = Record._make((3, "Group 03", "user03"))
+        self.assertEqual((record.id, record.name, record.owner.username),
+                         (3, "Group 03", "user03"))
+        self.assertTrue(record_class(("id", "name", "owner__username"))
+                        is Record)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+        record = dict_record({'_id': 7, 'name': "doc"}, (('id', '_id'),))
+        self.assertEqual((record.id, record.name), (7, "doc"))
+
+    def testDictionaryKeysStayFlat(self):
+        """Testing the keys of dictionary rows aren't nested"""
+        record = dict_record({'id': 1, 'user__username': "ann"})
+        self.assertEqual(record.user__username, "ann")
+        column = Column("User", field_name="user__username")
+        self.assertEqual(column.get_value(record), "ann")
+
+        # The same keys in any order share a class.
+        classes = set(type(dict_record(dict.fromkeys(keys)))
+                      for keys in (("a", "b", "c"), ("c", "a", "b")))
+        self.assertEqual(len(classes), 1)
+
+    def testDictionaryRows(self):
+        """Testing dictionary adapter rows are records"""
+        adapter = DictionaryQuerySetAdapter([{'id': 1, 'name': "a"}])
+        self.assertEqual(adapter[0].name, "a")
+        self.assertEqual(adapter.filter_pk([1])[0].id, 1)
+
+
+class BatchDataFuncTest(DataGridTest):
+    grid_class = BatchGroupDataGrid
+
+    def testBatchDataFunc(self):
+        """Testing batch_data_func is called once per page"""
+        for i, group in enumerate(Group.objects.order_by('id')[:2]):
+            for j in range(i + 1):
+                User.objects.create(username="user%d%d" % (i, j)
+                                    ).groups.add(group)
+        self.datagrid.render_listview()
+        self.datagrid = self.grid_class(self.request)
+        self.assertNumQueries(4, self.datagrid.load_state)
+        self.assertEqual([row['data'][2] for row in self.datagrid.rows[:3]],
+                         [1, 2, 0])
+        self.assertTrue(">2<" in self.datagrid.rows[1]['cells'][2].replace(
+            "\n", "").replace(" ", ""))
+
+
+def first_member_count(groups):
+    return count_members(groups)[:1]
+
+def no_members(groups):
+    return [None] * len(groups)
+
+def member_count(group):
+    calls.append(group)
+    return None
+
+class BatchDataFuncErrorsTest(TestCase):
+    def setUp(self):
+        populate_groups()
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+
+    def testMissingValues(self):
+        """Testing a batch_data_func giving too few values is an error"""
+        column = NonDatabaseColumn("Members",
+                                   batch_data_func=first_member_count)
+        column.id = "members"
+        self.assertRaises(ValueError, column.render_data_batch,
+                          list(Group.objects.all()[:3]))
+
+    def testNoneValues(self):
+        """Testing None batch values aren't rendered again per row"""
+        del calls[:]
+        column = NonDatabaseColumn("Members", batch_data_func=no_members,
+                                   data_func=member_count)
+        column.id = "members"
+        column.datagrid = GroupDataGrid(self.request)
+        groups = list(Group.objects.all()[:3])
+        cells = [column.render_cell(obj, datum, "") for obj, datum in
+                 zip(groups, column.render_data_batch(groups))]
+        self.assertEqual(len(cells), 3)
+        self.assertEqual(calls, [])
+
+
+class RowCachePerUserGroupDataGrid(RowCacheGroupDataGrid):
+    class Meta:
+        row_cache = 300
+        cache_per_user = True
+
+
+class RowCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        populate_groups()
+
+    def render(self, sort, grid_class=RowCacheGroupDataGrid, user=None):
+        del rendered_ids[:]
+        request = HttpRequest()
+        request.user = user or User(username="testuser")
+        request.GET['sort'] = sort
+        request.GET['columns'] = "objid,name,custom"
+        datagrid = grid_class(request)
+        datagrid.load_state()
+        return datagrid.rows
+
+    def testRowCache(self):
+        """Testing rows are rendered once across sorts and pages"""
+        rows = self.render("objid")
+        self.assertEqual(len(rendered_ids), 10)
+        self.assertEqual(self.render("name"), rows)
+        self.assertEqual(rendered_ids, [])
+
+        # Only the rows missing from the cache are rendered.
+        self.render("-objid,name")
+        self.assertEqual(len(rendered_ids), 10)
+        self.render("objid")
+        self.assertEqual(rendered_ids, [])
+
+        # Saving an object renders them again.
+        Group.objects.get(name="Group 05").save()
+        self.render("objid")
+        self.assertEqual(len(rendered_ids), 10)
+
+    def testRowCachePerUser(self):
+        """Testing rows cached per user are rendered for each user"""
+        users = [User.objects.create(username="user%d" % i)
+                 for i in range(2)]
+        self.render("objid", RowCachePerUserGroupDataGrid, users[0])
+        self.assertEqual(len(rendered_ids), 10)
+        self.render("objid", RowCachePerUserGroupDataGrid, users[1])
+        self.assertEqual(len(rendered_ids), 10)
+        self.render("objid", RowCachePerUserGroupDataGrid, users[0])
+        self.assertEqual(rendered_ids, [])
+
+
+class MemoizeTest(TestCase):
+    def setUp(self):
+        for i in range(1, 7):
+            User.objects.create(username="user%02d" % i, is_staff=i % 2)
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+
+    def testMemoize(self):
+        """Testing memoized data_func and link_func within and across
+        requests"""
+        del calls[:]
+        datagrid = MemoizedUserDataGrid(self.request)
+        datagrid.load_state()
+        self.assertEqual(sorted(calls), [False, False, True, True])
+        self.assertEqual([row['data'][1] for row in datagrid.rows[:2]],
+                         ["Staff", "Member"])
+        self.assertTrue("/users/?is_staff=True" in datagrid.rows[0]['cells'][1])
+
+        del calls[:]
+        datagrid = MemoizedUserDataGrid(self.request)
+        datagrid.load_state()
+        self.assertEqual(calls, [])
+        self.assertEqual(len(datagrid.rows), 6)
+
+
+class FailingExportJob(ExportJob):
+    def write(self):
+        raise ValueError("Export failed")
+
+
+class ExportJobTest(TestCase):
+    def setUp(self):
+        populate_groups()
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+        self.request.GET['is_csv'] = "1"
+        self.old_settings = (getattr(settings, "DATAGRID_EXPORT_DIR", None),
+                             getattr(settings, "DATAGRID_EXPORT_WORKERS", 2))
+        settings.DATAGRID_EXPORT_DIR = tempfile.mkdtemp()
+        settings.DATAGRID_EXPORT_WORKERS = 0
+
+    def tearDown(self):
+        shutil.rmtree(settings.DATAGRID_EXPORT_DIR)
+        (settings.DATAGRID_EXPORT_DIR,
+         settings.DATAGRID_EXPORT_WORKERS) = self.old_settings
+
+    def render(self):
+        datagrid = BackgroundExportGroupDataGrid(self.request)
+        return datagrid.render_to_response("datagrid/listview.html")
+
+    def testExportFile(self):
+        """Testing exports are written once and served from disk"""
+        response = self.render()
+        self.assertEqual(response.status_code, 200)
+        content = response.content
+        self.assertEqual(len(content.splitlines()), 100)
+        self.assertEqual(len(os.listdir(settings.DATAGRID_EXPORT_DIR)), 1)
+
+        self.assertNumQueries(0, self.render)
+        self.request.META['HTTP_RANGE'] = "bytes=3-12"
+        response = self.render()
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'],
+                         "bytes 3-12/%d" % len(content))
+        self.assertEqual(response.content, content[3:13])
+
+    def testSharedJob(self):
+        """Testing requests for an export being written wait for it"""
+        settings.DATAGRID_EXPORT_WORKERS = 2
+        datagrid = BackgroundExportGroupDataGrid(self.request)
+        datagrid.load_state(precompute=False)
+        path = os.path.join(settings.DATAGRID_EXPORT_DIR, "%s.csv" %
+                            get_fingerprint(datagrid, 'csv'))
+        open(path + '.lock', 'w').close()
+        response = self.render()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Retry-After'], "5")
+
+    def testWorkerProcess(self):
+        """Testing exports are written by the process of a background job"""
+        datagrid = BackgroundExportGroupDataGrid(self.request)
+        datagrid.load_state(precompute=False)
+        path = os.path.join(settings.DATAGRID_EXPORT_DIR, "%s.csv" %
+                            get_fingerprint(datagrid, 'csv'))
+        job = ExportJob(datagrid, 'csv', path)
+        self.assertTrue(job.acquire())
+        # In-memory databases are only seen by the threads that opened
+        # them, so the process is forked from this one rather than by the
+        # threads of the pool.
+        job.run()
+        self.assertEqual(os.listdir(settings.DATAGRID_EXPORT_DIR),
+                         [os.path.basename(path)])
+        response = self.render()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.content.splitlines()), 100)
+        # The connection shared with the process still works.
+        self.assertEqual(Group.objects.count(), 99)
+
+    def testFailedJob(self):
+        """Testing the requests for a failed export get an error"""
+        settings.DATAGRID_EXPORT_WORKERS = 2
+        datagrid = BackgroundExportGroupDataGrid(self.request)
+        datagrid.load_state(precompute=False)
+        path = os.path.join(settings.DATAGRID_EXPORT_DIR, "%s.csv" %
+                            get_fingerprint(datagrid, 'csv'))
+        job = FailingExportJob(datagrid, 'csv', path)
+        self.assertTrue(job.acquire())
+        job.run()
+        self.assertEqual(os.listdir(settings.DATAGRID_EXPORT_DIR),
+                         [os.path.basename(job.failed_path)])
+        self.assertEqual(self.render().status_code, 500)
+        self.assertEqual(os.listdir(settings.DATAGRID_EXPORT_DIR), [])
+
+    def testFingerprintOfLanguageAndUser(self):
+        """Testing exports change with the language and, if cached per
+        user, the user"""
+        datagrid = BackgroundExportGroupDataGrid(self.request)
+        datagrid.load_state(precompute=False)
+        fingerprint = get_fingerprint(datagrid, 'csv')
+        translation.activate('fr')
+        try:
+            self.assertNotEqual(get_fingerprint(datagrid, 'csv'),
+                                fingerprint)
+        finally:
+            translation.deactivate()
+        datagrid.cache_per_user = True
+        fingerprint = get_fingerprint(datagrid, 'csv')
+        self.request.user = User.objects.create(username="other")
+        self.assertNotEqual(get_fingerprint(datagrid, 'csv'), fingerprint)
+
+    def testFingerprintOfRelatedModels(self):
+        """Testing exports change with the models reached by their columns"""
+        datagrid = PermissionDataGrid(self.request)
+        datagrid.load_state(precompute=False)
+        fingerprint = get_fingerprint(datagrid, 'csv')
+        ContentType.objects.all()[0].save()
+        self.assertNotEqual(get_fingerprint(datagrid, 'csv'), fingerprint)
+
+
+class ExportCommandTest(TestCase):
+    def setUp(self):
+        populate_groups()
+
+    def testExportGrid(self):
+        """Testing the export_grid command exports all the sorted rows"""
+        output = tempfile.NamedTemporaryFile()
+        call_command('export_grid', 'datagrid.tests.GroupDataGrid',
+                     output.name, params="sort=-name", processes=1)
+        rows = list(csv.reader(output))
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[1], [str(Group.objects.get(name="Group 99").id),
+                                   "Group 99"])
+
+        request = HttpRequest()
+        request.user = User(username="testuser")
+        request.GET['sort'] = "-name"
+        datagrid = GroupDataGrid(request)
+        datagrid.load_state(precompute=False)
+        query = datagrid.get_sorted_query()[0]
+        self.assertEqual(list(datagrid.iter_sorted_ids(query.distinct())),
+                         [int(row[0]) for row in rows[1:]])
+
+    def testParallelExport(self):
+        """Testing exports written by several processes are in order"""
+        for grid, params in (("GroupDataGrid", "sort=-name"),
+                             ("DataGridWithNoDbColumnsNoExtra",
+                              "sort=custom")):
+            outputs = []
+            for processes in (1, 3):
+                output = tempfile.NamedTemporaryFile()
+                call_command('export_grid', 'datagrid.tests.%s' % grid,
+                             output.name, params=params,
+                             processes=processes)
+                outputs.append(output.read())
+            self.assertEqual(len(outputs[1].splitlines()), 100)
+            self.assertEqual(outputs[1], outputs[0])
+
+
+class ExportChunksTest(TestCase):
+    def setUp(self):
+        populate_groups()
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+        self.request.GET['sort'] = "app_label,-name"
+
+    def assertChunks(self, grid_class, sort, chunk_size=7):
+        request = HttpRequest()
+        request.user = User(username="testuser")
+        request.GET['sort'] = sort
+        datagrid = grid_class(request)
+        datagrid.load_state(precompute=False)
+        query, python_sort, sort_list, extra_names = \
+            datagrid.get_sorted_query()
+        chunks = list(datagrid.iter_sorted_id_chunks(
+            query.distinct(), sort_list, extra_names, chunk_size))
+        self.assertTrue(chunks)
+        self.assertTrue(all(0 < len(chunk) <= chunk_size
+                            for chunk in chunks))
+        self.assertEqual(sum(chunks, []), list(datagrid.iter_sorted_ids(
+            query.distinct(), extra_names)))
+        return datagrid.get_keyset(sort_list, extra_names)
+
+    def testKeysetChunks(self):
+        """Testing export chunks follow the last row of the previous one"""
+        self.assertEqual(self.assertChunks(GroupDataGrid, "-objid"),
+                         [('id', True)])
+        self.assertEqual(self.assertChunks(PermissionDataGrid,
+                                           "app_label,-name"),
+                         [('content_type__app_label', False),
+                          ('name', True), ('pk', False)])
+
+    def testKeysetBounds(self):
+        """Testing export chunks between the keys of two rows"""
+        datagrid = PermissionDataGrid(self.request)
+        datagrid.load_state(precompute=False)
+        query, python_sort, sort_list, extra_names = \
+            datagrid.get_sorted_query()
+        keyset = datagrid.get_keyset(sort_list, extra_names)
+        query = query.distinct()
+        keys = [row[:len(keyset)]
+                for row in datagrid.get_keyset_rows(query, keyset)]
+        ids = list(datagrid.iter_sorted_ids(query, extra_names))
+        for first, following in ((5, 20), (None, 7), (12, None)):
+            bounds = (first is not None and keys[first] or None,
+                      following is not None and keys[following] or None)
+            chunks = list(datagrid.iter_sorted_id_chunks(
+                query, sort_list, extra_names, 4, bounds=bounds))
+            self.assertEqual(sum(chunks, []), ids[first:following])
+
+    def testNullableForeignKeyChunks(self):
+        """Testing export chunks sorted through a nullable foreign key"""
+        for i in range(10):
+            Ticket.objects.create(title="Ticket %d" % i, owner=i % 2 and
+                User.objects.create(username="owner%d" % i) or None)
+        self.assertEqual(self.assertChunks(TicketDataGrid, "owner", 3),
+                         None)
+
+        request = HttpRequest()
+        request.user = User(username="testuser")
+        request.GET['sort'] = "-owner"
+        datagrid = TicketDataGrid(request)
+        datagrid.load_state(precompute=False)
+        self.assertEqual(sum([len(objects) for objects in
+                              datagrid.iter_export_chunks(3)]), 10)
+
+    def testOffsetChunks(self):
+        """Testing export chunks of extra sorts are sliced at their offset"""
+        self.assertEqual(self.assertChunks(DataGridWithNoDbColumns,
+                                           "custom,-objid"), None)
+
+
+class DeltaExportTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.now = datetime.now()
+        for i in range(1, 6):
+            User.objects.create(username="user%02d" % i,
+                                date_joined=self.now - timedelta(days=i))
+
+    def export(self, params):
+        request = HttpRequest()
+        request.user = User(username="testuser")
+        request.GET = QueryDict("export=csv&" + params)
+        response = DeltaUserDataGrid(request).render_to_response(
+            "datagrid/listview.html")
+        rows = list(csv.reader(StringIO.StringIO("".join(response))))
+        return [row[1] for row in rows[1:]], response['X-Datagrid-Watermark']
+
+    def testSince(self):
+        """Testing delta exports hold the rows modified after since"""
+        since = (self.now - timedelta(days=3, hours=12)).isoformat()
+        usernames, watermark = self.export("since=" + since)
+        self.assertEqual(usernames, ["user01", "user02", "user03"])
+        self.assertEqual(watermark, (self.now - timedelta(days=1)).isoformat())
+
+        # The rows modified at the watermark are exported again.
+        usernames, next_watermark = self.export("since=" + watermark)
+        self.assertEqual(usernames, ["user01"])
+        self.assertEqual(next_watermark, watermark)
+
+    def testConsumer(self):
+        """Testing delta exports follow the watermark of a consumer"""
+        self.assertEqual(len(self.export("consumer=hourly")[0]), 5)
+        self.assertEqual(self.export("consumer=hourly")[0], ["user01"])
+        User.objects.create(username="user00", date_joined=self.now)
+        self.assertEqual(self.export("consumer=hourly"),
+                         (["user01", "user00"], self.now.isoformat()))
+        self.assertEqual(len(self.export("consumer=other")[0]), 6)
+
+    def testConsumerWatermarkOnceSent(self):
+        """Testing the watermark of a consumer is stored once the export
+        was sent"""
+        request = HttpRequest()
+        request.user = User(username="testuser")
+        request.GET = QueryDict("export=csv&consumer=hourly")
+        datagrid = DeltaUserDataGrid(request)
+        response = datagrid.render_to_response("datagrid/listview.html")
+        self.assertEqual(cache.get(datagrid.watermark_key), None)
+        self.assertEqual(len("".join(response).splitlines()), 6)
+        self.assertEqual(cache.get(datagrid.watermark_key),
+                         response['X-Datagrid-Watermark'])
+
+    def testAwareWatermark(self):
+        """Testing watermarks with a UTC offset are read back"""
+        for offset in (0, 60, -330):
+            watermark = datetime(2012, 3, 4, 5, 6, 7, 8,
+                                 tzinfo=FixedOffset(offset))
+            self.assertEqual(parse_watermark(format_watermark(watermark)),
+                             watermark)
+            self.assertEqual(
+                parse_watermark(format_watermark(watermark)).utcoffset(),
+                timedelta(minutes=offset))
+        self.assertEqual(parse_watermark("2012-03-04T05:06:07Z"),
+                         datetime(2012, 3, 4, 5, 6, 7,
+                                  tzinfo=FixedOffset(0)))
+
+
+class QueryStringTest(TestCase):
+    def setUp(self):
+        populate_groups()
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+        self.request.GET = QueryDict("q=a%26b&sort=name&page=2&gridonly=1",
+                                     mutable=True)
+
+    def testHeaderUrls(self):
+        """Testing the sort and toggle urls keep the escaped parameters"""
+        datagrid = GroupDataGrid(self.request)
+        datagrid.load_state()
+        self.assertTrue(datagrid.query is datagrid.query)
+        self.assertTrue('href="?page=2&amp;q=a%26b&amp;sort=-name"'
+                        in datagrid.columns[1].header)
+        self.assertEqual(datagrid.columns[0].toggle_url,
+                         "?gridonly=1&page=2&q=a%26b&sort=name&columns=name")
+
+    def testSortUrlsKeepColumns(self):
+        """Testing the sort urls keep the selected columns"""
+        self.request.GET['columns'] = "name"
+        datagrid = GroupDataGrid(self.request)
+        datagrid.load_state()
+        self.assertEqual([column.id for column in datagrid.columns], ["name"])
+        self.assertTrue('href="?columns=name&amp;page=2&amp;q=a%26b&amp;'
+                        'sort=-name"' in datagrid.columns[0].header)
+
+    def testPaginatorUrls(self):
+        """Testing the page links replace the page parameter"""
+        self.request.GET['page_size'] = "2"
+        datagrid = GroupDataGrid(self.request)
+        html = datagrid.render_listview()
+        self.assertTrue('href="?gridonly=1&amp;page_size=2&amp;q=a%26b&amp;'
+                        'sort=name&amp;page=3"' in html)
+        self.assertFalse('page=2&amp;page=' in html)
+
+
+class LinkURLTest(TestCase):
+    urls = 'datagrid.tests'
+
+    def setUp(self):
+        for i in range(1, 4):
+            User.objects.create(username="user.%d" % i,
+                                email="user%d@example.com" % i)
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+
+    def testLinkURL(self):
+        """Testing links filled in from a url pattern"""
+        datagrid = LinkedUserDataGrid(self.request)
+        self.assertEqual(datagrid.get_values_fields(),
+                         ["id", "username", "email"])
+        datagrid.load_state()
+        for user, row in zip(User.objects.order_by('username'),
+                             datagrid.rows):
+            url = reverse('datagrid-test-user', args=[user.id])
+            self.assertTrue('href="%s"' % url in row['cells'][0])
+            url = reverse('datagrid-test-profile',
+                          kwargs={'username': user.username})
+            self.assertTrue('href="%s"' % url in row['cells'][1])
+
+    def testLinkURLResolvedOnce(self):
+        """Testing the url pattern is resolved once, reverse() otherwise"""
+        column = LinkedUserDataGrid.username
+        template = column.get_url_template()
+        self.assertTrue(column.get_url_template() is template)
+
+        user = User.objects.order_by('id')[0]
+        fallback = URLTemplate('datagrid-test-user', ['id'])
+        fallback.candidates = []
+        self.assertEqual(fallback.url(user),
+                         reverse('datagrid-test-user', args=[user.id]))
+        self.assertEqual(URLTemplate('datagrid-test-missing', ['id']).urls(
+            [user]), [""])
+
+    def testLinkURLMissingArgument(self):
+        """Testing rows without the arguments of link_url aren't linked"""
+        column = LinkedUserDataGrid.username
+        self.assertEqual(column.get_url_template().urls(
+            [dict_record({'id': None}), dict_record({})]), ["", ""])
+
+
+class ForeignKeyLabelColumnTest(TestCase):
+    def setUp(self):
+        self.request = HttpRequest()
+        self.request.user = User(username="testuser")
+        PermissionTypeDataGrid.content_type.label_cache.clear()
+
+    def testLabels(self):
+        """Testing foreign key labels are fetched in bulk and cached"""
+        self.request.GET['sort'] = "content_type,name"
+        datagrid = PermissionTypeDataGrid(self.request)
+        self.assertEqual(datagrid.get_values_fields(),
+                         ["id", "name", "content_type_id"])
+        self.assertNumQueries(4, datagrid.load_state)
+        permission = Permission.objects.order_by(
+            'content_type__model', 'name')[0]
+        self.assertEqual(datagrid.rows[0]['data'],
+                         [permission.name, permission.content_type.model])
+
+        # The labels come from the cache until a related object is saved.
+        datagrid = PermissionTypeDataGrid(self.request)
+        self.assertNumQueries(3, datagrid.load_state)
+        content_type = ContentType.objects.get(pk=permission.content_type_id)
+        content_type.model = "renamed"
+        content_type.save()
+        datagrid = PermissionTypeDataGrid(self.request)
+        self.assertNumQueries(4, datagrid.load_state)
+        self.assertTrue("renamed" in [row['data'][1]
+                                      for row in datagrid.rows])
+
+    def testLabelWithFieldOfRelation(self):
+        """Testing labels next to a column following the same foreign key"""
+        self.request.GET['sort'] = "name"
+        permissions = Permission.objects.order_by('name')[:3]
+        datagrid = AppLabelPermissionTypeDataGrid(self.request)
+        datagrid.render_listview()
+        self.assertEqual([row['data'] for row in datagrid.rows[:3]],
+                         [[permission.name, permission.content_type.model,
+                           permission.content_type.app_label]
+                          for permission in permissions])
+
+        datagrid = LabelAfterPermissionDataGrid(self.request)
+        datagrid.render_listview()
+        self.assertEqual([row['data'] for row in datagrid.rows[:3]],
+                         [[permission.content_type.app_label, permission.name,
+                           permission.content_type.model]
+                          for permission in permissions])
@@ -0,0 +1,258 @@
+"""A minimal XLSX writer writing a workbook row by row.
+
+The rows of the sheet are written as they come to a temporary file, with
+the strings inline rather than in a shared strings table, and the file is
+compressed into the workbook once complete, so the memory used doesn't
+depend on the number of rows. The rows beyond the 1,048,576 of a sheet go
+on to the next ones."""
+
+import datetime
+import decimal
+import math
+import os
+import re
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+from django.utils.encoding import force_unicode
+
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+%s
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+
+RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets>%s</sheets>
+</workbook>"""
+
+WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+%s
+<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+SHEET_CONTENT_TYPE = """<Override PartName="/xl/worksheets/sheet%d.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>"""
+
+SHEET = """<sheet name=%s sheetId="%d" r:id="rId%d"/>"""
+
+SHEET_REL = """<Relationship Id="rId%d" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet%d.xml"/>"""
+
+# The cell styles: 0 general, 1 date, 2 date and time, 3 time, 4 header.
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy\\-mm\\-dd\\ hh:mm:ss"/></numFmts>
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="5">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="21" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+</cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>"""
+
+SHEET_START = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/></sheetView></sheetViews>
+<sheetData>"""
+
+SHEET_END = """</sheetData>
+</worksheet>"""
+
+DATE_STYLE, DATETIME_STYLE, TIME_STYLE, HEADER_STYLE = 1, 2, 3, 4
+
+# The number of rows of a sheet in Excel.
+MAX_ROWS = 1048576
+
+EPOCH = datetime.datetime(1899, 12, 30)
+
+# The characters XML 1.0 doesn't allow, dropped from the strings.
+re_invalid = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def column_letters(index):
+    """
+    Returns the letters naming the column of the 0-based index.
+    >>> column_letters(0), column_letters(25), column_letters(26)
+    ('A', 'Z', 'AA')
+    """
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def to_serial(value):
+    """
+    Returns the Excel serial number of a date, datetime or time, the days
+    since 1899-12-30 and the fraction of the day.
+    >>> to_serial(datetime.date(2000, 1, 1))
+    36526
+    >>> to_serial(datetime.datetime(2000, 1, 1, 12))
+    36526.5
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        delta = value - EPOCH
+        return delta.days + \
+            (delta.seconds + delta.microseconds / 1e6) / 86400.0
+    if isinstance(value, datetime.date):
+        return (value - EPOCH.date()).days
+    return (value.hour * 3600 + value.minute * 60 + value.second +
+            value.microsecond / 1e6) / 86400.0
+
+
+def is_number(value):
+    """Returns whether value is written as a number, which excludes the
+    infinite and NaN floats and decimals."""
+    if isinstance(value, float):
+        return not (math.isinf(value) or math.isnan(value))
+    if isinstance(value, decimal.Decimal):
+        return value.is_finite()
+    return isinstance(value, (int, long))
+
+
+def encode_cell(ref, value, style=0):
+    """
+    Returns the XML of the cell ref holding value: a number, a boolean, a
+    date or time in its style, or else the value's text as an inline
+    string. Empty cells aren't written.
+    >>> encode_cell('A1', 42), encode_cell('B1', True)
+    ('<c r="A1"><v>42</v></c>', '<c r="B1" t="b"><v>1</v></c>')
+    >>> encode_cell('C1', u'a < b')
+    '<c r="C1" t="inlineStr"><is><t xml:space="preserve">a &lt; b</t></is></c>'
+    """
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        style = DATETIME_STYLE
+    elif isinstance(value, datetime.date):
+        style = DATE_STYLE
+    elif isinstance(value, datetime.time):
+        style = TIME_STYLE
+    if style:
+        attributes = ' r="%s" s="%d"' % (ref, style)
+    else:
+        attributes = ' r="%s"' % ref
+    if isinstance(value, bool):
+        return '<c%s t="b"><v>%d</v></c>' % (attributes, value)
+    if is_number(value):
+        if isinstance(value, float):
+            return '<c%s><v>%r</v></c>' % (attributes, value)
+        return '<c%s><v>%s</v></c>' % (attributes, value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return '<c%s><v>%r</v></c>' % (attributes, to_serial(value))
+    text = escape(re_invalid.sub(u'', force_unicode(value)))
+    return '<c%s t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' \
+        % (attributes, text.encode('utf-8'))
+
+
+def get_sheet_name(name, number):
+    """
+    Returns the name of the sheet numbered number from 1 in a workbook
+    named name, at most 31 characters long as Excel requires.
+    >>> get_sheet_name('Users', 1), get_sheet_name('Users', 2)
+    ('Users', 'Users (2)')
+    """
+    if number == 1:
+        return name
+    suffix = ' (%d)' % number
+    return name[:31 - len(suffix)] + suffix
+
+
+class XLSXWriter(object):
+    """
+    Writes a workbook named sheet_name to file, a row at a time with
+    write_row(), complete once closed. The rows beyond max_rows go on to
+    the next sheets, numbered after the first one, under a copy of the
+    first row if it was written in the header style. The file needs to be
+    seekable, like the files zipfile writes.
+    """
+    def __init__(self, file, sheet_name='Data', max_rows=MAX_ROWS):
+        self.file = file
+        self.sheet_name = re.sub(r'[\[\]:*?/\\]', '', sheet_name)[:31] or \
+            'Data'
+        self.max_rows = max_rows
+        self.sheet_paths = []
+        self.sheet = None
+        self.header = None
+        self.refs = []
+        self.count = 0
+        self.add_sheet()
+
+    def add_sheet(self):
+        if self.sheet is not None:
+            self.sheet.write(SHEET_END)
+            self.sheet.close()
+        fd, path = tempfile.mkstemp(suffix='.xml')
+        self.sheet_paths.append(path)
+        self.sheet = os.fdopen(fd, 'wb')
+        self.sheet.write(SHEET_START)
+        self.count = 0
+
+    def write_row(self, values, style=0):
+        if self.count == self.max_rows:
+            self.add_sheet()
+            if self.header is not None:
+                self.write_row(*self.header)
+        elif self.count == 0 and style == HEADER_STYLE:
+            self.header = (values, style)
+        self.count += 1
+        while len(self.refs) < len(values):
+            self.refs.append(column_letters(len(self.refs)))
+        self.sheet.write('<row r="%d">%s</row>' % (self.count, ''.join([
+            encode_cell('%s%d' % (letters, self.count), value, style)
+            for letters, value in zip(self.refs, values)])))
+
+    def write_rows(self, rows, style=0):
+        for values in rows:
+            self.write_row(values, style)
+
+    def close(self):
+        try:
+            self.sheet.write(SHEET_END)
+            self.sheet.close()
+            numbers = range(1, len(self.sheet_paths) + 1)
+            # The sheets can exceed the 2 GiB zip files are limited to
+            # without the ZIP64 extensions.
+            archive = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED,
+                                      allowZip64=True)
+            archive.writestr('[Content_Types].xml', CONTENT_TYPES % (
+                '\n'.join([SHEET_CONTENT_TYPE % number
+                           for number in numbers])))
+            archive.writestr('_rels/.rels', RELS)
+            archive.writestr('xl/workbook.xml', WORKBOOK % ''.join([
+                SHEET % (quoteattr(force_unicode(get_sheet_name(
+                    self.sheet_name, number))).encode('utf-8'),
+                    number, number)
+                for number in numbers]))
+            archive.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS % (
+                '\n'.join([SHEET_REL % (number, number)
+                           for number in numbers]),
+                len(numbers) + 1))
+            archive.writestr('xl/styles.xml', STYLES)
+            for number, path in zip(numbers, self.sheet_paths):
+                archive.write(path, 'xl/worksheets/sheet%d.xml' % number)
+            archive.close()
+        finally:
+            for path in self.sheet_paths:
+                os.remove(path)
@@ -35,10 +35,11 @@ class DataGridWithDictonaryData(DataGrid):
         ]
 
 class BlogGrid(DataGrid):
-    created_by = Column(sortable=True,
-                        link=True,
-                        cell_clickable=True,
-                        css_class='red')
+    created_by = ForeignKeyLabelColumn("Created by",
+                                       label_field='username',
+                                       link=True,
+                                       cell_clickable=True,
+                                       css_class='red')
 
     created_on = DateTimeColumn("created on",
                                 format='d b, Y',
@@ -68,6 +69,10 @@ class BlogGrid(DataGrid):
     blog_title = NonDatabaseColumn("Second Title", sortable=True, link=True, data_func=non_db_col_value)
     col1 = NonDatabaseColumn(sortable=True, link=True, data_func=non_db_col_value)
 
+def make_blog_grid(request):
+    posts = BlogEntry.objects.all()
+    return BlogGrid(request=request, queryset=posts, title='Blog Grid View')
+
 def blog_grid(request):
     posts = BlogEntry.objects.all()
 #    blog_grid = BlogGrid(request=request, queryset=posts, title='Blog Grid View')
@@ -326,8 +326,38 @@ jQuery.fn.datagrid = function() {
     return this;
 };
 
+/*
+ * Completes the autocompleted filter fields from the grid's autocomplete
+ * endpoint, filling the datalist of the input as the user types.
+ */
+jQuery.fn.filterAutocomplete = function() {
+    return this.each(function() {
+        var input = $(this);
+        var datalist = $("#" + input.attr("list"));
+        var lastTerm = null;
+
+        input.keyup(function() {
+            var term = input.val();
+
+            if (term == lastTerm) {
+                return;
+            }
+
+            lastTerm = term;
+            $.getJSON(input.attr("data-autocomplete-url"), {term: term},
+                function(values) {
+                    datalist.empty();
+                    $.each(values, function(i, value) {
+                        $("<option/>").attr("value", value).appendTo(datalist);
+                    });
+                });
+        });
+    });
+};
+
 $(document).ready(function() {
     $("div.datagrid-wrapper").datagrid();
+    $("input.filter-autocomplete").filterAutocomplete();
 });
 
 })(jQuery);